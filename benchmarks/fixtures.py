@@ -0,0 +1,163 @@
+# -*- coding: utf-8 -*-
+"""Synthetic TXT/EPUB/DOCX/PDF books for the benchmarks.
+
+The text is generated from a fixed seed, so every size and format contains the
+same paragraphs and runs are comparable. A running header repeats every few
+paragraphs, like the page headers of a real PDF, and bare page numbers (which
+need no translation) are interspersed.
+
+    python benchmarks/fixtures.py [--output benchmarks/fixtures] [--sizes small,medium]
+"""
+
+import argparse
+import os
+import random
+
+# 每种规模的段落数
+SIZES = {"small": 40, "medium": 400, "large": 2000}
+FORMATS = ["txt", "epub", "docx", "pdf"]
+PARAGRAPHS_PER_CHAPTER = 40
+PARAGRAPHS_PER_PAGE = 6
+
+_WORDS = (
+    "the river city council harbour winter morning letter station garden village road light "
+    "people government election history family window market evening question answer story "
+    "quietly slowly walked said found remembered promised opened carried watched returned "
+    "old new long small bright cold early late distant familiar"
+).split()
+
+
+def paragraphs(count, seed=1):
+    rng = random.Random(seed)
+    result = []
+    for i in range(count):
+        if i % 10 == 0:
+            # 重复出现的页眉
+            result.append(f"The Synthetic Book - Chapter {i // PARAGRAPHS_PER_CHAPTER + 1}")
+            continue
+        if i % 10 == 5:
+            # 页码
+            result.append(str(i // 10 + 1))
+            continue
+        sentences = []
+        for _ in range(rng.randint(2, 6)):
+            words = [rng.choice(_WORDS) for _ in range(rng.randint(6, 18))]
+            sentences.append(" ".join(words).capitalize() + ".")
+        result.append(" ".join(sentences))
+    return result
+
+
+def chapters(paras):
+    return [paras[i:i + PARAGRAPHS_PER_CHAPTER] for i in range(0, len(paras), PARAGRAPHS_PER_CHAPTER)]
+
+
+def write_txt(path, paras):
+    with open(path, "w", encoding="utf-8") as f:
+        f.write("\n\n".join(paras) + "\n")
+
+
+def write_epub(path, paras):
+    from ebooklib import epub
+
+    book = epub.EpubBook()
+    book.set_identifier("synthetic-book")
+    book.set_title("The Synthetic Book")
+    book.set_language("en")
+    items = []
+    for n, chapter in enumerate(chapters(paras), 1):
+        item = epub.EpubHtml(title=f"Chapter {n}", file_name=f"chapter_{n}.xhtml", lang="en")
+        body = "".join(f"<p>{p}</p>" for p in chapter[1:])
+        item.content = f"<html><head><title>Chapter {n}</title></head><body><h1>{chapter[0]}</h1>{body}</body></html>"
+        book.add_item(item)
+        items.append(item)
+    book.toc = [epub.Link(item.file_name, item.title, f"chapter_{n}") for n, item in enumerate(items, 1)]
+    book.add_item(epub.EpubNcx())
+    book.add_item(epub.EpubNav())
+    book.spine = ["nav"] + items
+    epub.write_epub(path, book)
+
+
+def write_docx(path, paras):
+    import docx
+
+    document = docx.Document()
+    document.core_properties.title = "The Synthetic Book"
+    for p in paras:
+        document.add_paragraph(p)
+    document.save(path)
+
+
+def _pdf_lines(paragraph, width=90):
+    line, lines = "", []
+    for word in paragraph.split():
+        if line and len(line) + len(word) + 1 > width:
+            lines.append(line)
+            line = word
+        else:
+            line = f"{line} {word}" if line else word
+    lines.append(line)
+    return lines + [""]
+
+
+def write_pdf(path, paras):
+    """Minimal text PDF (Helvetica, one stream per page) without a PDF library"""
+    pages = [paras[i:i + PARAGRAPHS_PER_PAGE] for i in range(0, len(paras), PARAGRAPHS_PER_PAGE)]
+    objects = [None, None, b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>"]
+    page_ids = []
+    for page in pages:
+        text = []
+        for p in page:
+            for line in _pdf_lines(p):
+                escaped = line.replace("\\", "\\\\").replace("(", "\\(").replace(")", "\\)")
+                text.append(f"({escaped}) '")
+        stream = ("BT /F1 10 Tf 12 TL 50 780 Td " + " ".join(text) + " ET").encode("latin-1")
+        objects.append(b"<< /Length %d >>\nstream\n" % len(stream) + stream + b"\nendstream")
+        content_id = len(objects)
+        objects.append(b"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 595 842] "
+                       b"/Resources << /Font << /F1 3 0 R >> >> /Contents %d 0 R >>" % content_id)
+        page_ids.append(len(objects))
+    objects[0] = b"<< /Type /Catalog /Pages 2 0 R >>"
+    objects[1] = b"<< /Type /Pages /Kids [%s] /Count %d >>" % (
+        b" ".join(b"%d 0 R" % i for i in page_ids), len(page_ids))
+    objects.append(b"<< /Title (The Synthetic Book) >>")
+    info_id = len(objects)
+
+    out = bytearray(b"%PDF-1.4\n")
+    offsets = []
+    for number, body in enumerate(objects, 1):
+        offsets.append(len(out))
+        out += b"%d 0 obj\n" % number + body + b"\nendobj\n"
+    xref = len(out)
+    out += b"xref\n0 %d\n0000000000 65535 f \n" % (len(objects) + 1)
+    out += b"".join(b"%010d 00000 n \n" % offset for offset in offsets)
+    out += b"trailer\n<< /Size %d /Root 1 0 R /Info %d 0 R >>\nstartxref\n%d\n%%%%EOF\n" % (
+        len(objects) + 1, info_id, xref)
+    with open(path, "wb") as f:
+        f.write(out)
+
+
+WRITERS = {"txt": write_txt, "epub": write_epub, "docx": write_docx, "pdf": write_pdf}
+
+
+def make_fixture(directory, size, file_format):
+    """Create (or reuse) <directory>/<size>.<format> and return its path"""
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, f"{size}.{file_format}")
+    if not os.path.exists(path):
+        WRITERS[file_format](path, paragraphs(SIZES[size]))
+    return path
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--output", default=os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures"))
+    parser.add_argument("--sizes", default=",".join(SIZES), help="Comma-separated sizes: " + ", ".join(SIZES))
+    parser.add_argument("--formats", default=",".join(FORMATS), help="Comma-separated formats: " + ", ".join(FORMATS))
+    args = parser.parse_args()
+    for size in args.sizes.split(","):
+        for file_format in args.formats.split(","):
+            print(make_fixture(args.output, size, file_format))
+
+
+if __name__ == "__main__":
+    main()
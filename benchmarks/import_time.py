@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+"""Measure how long `import text_translation` takes in a fresh interpreter.
+
+Also checks that none of the format/backend libraries are loaded by the
+import, since they must only be imported when a file of that type (or that
+backend) is actually used.
+
+    python benchmarks/import_time.py [--runs 10] [--max-ms 300] [--output import_time.json]
+"""
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# 这些库只能按需导入
+LAZY_MODULES = ["pdfminer", "ebooklib", "bs4", "docx", "mobi", "pandas", "ollama", "openai", "lxml", "chardet"]
+
+PROBE = """
+import json, sys, time
+started = time.perf_counter()
+import text_translation
+elapsed = time.perf_counter() - started
+print(json.dumps({
+    "wall": elapsed,
+    "module": text_translation.import_time,
+    "loaded": [m for m in %r if m in sys.modules],
+}))
+""" % (LAZY_MODULES,)
+
+
+def measure(runs):
+    samples = []
+    for _ in range(runs):
+        output = subprocess.run(
+            [sys.executable, "-c", PROBE], cwd=ROOT, check=True, capture_output=True, text=True
+        ).stdout
+        samples.append(json.loads(output))
+    walls = [s["wall"] * 1000 for s in samples]
+    return {
+        "runs": runs,
+        "median_ms": statistics.median(walls),
+        "min_ms": min(walls),
+        "max_ms": max(walls),
+        "module_median_ms": statistics.median(s["module"] * 1000 for s in samples),
+        "eager_imports": sorted({m for s in samples for m in s["loaded"]}),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--runs", type=int, default=10, help="Number of fresh interpreters to start")
+    parser.add_argument("--max-ms", type=float, help="Fail if the median import time is above this")
+    parser.add_argument("--output", help="Write the result as JSON to this file")
+    args = parser.parse_args()
+
+    result = measure(args.runs)
+    print(json.dumps(result, indent=4))
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(result, f, indent=4)
+
+    if result["eager_imports"]:
+        sys.exit(f"Loaded at import time: {', '.join(result['eager_imports'])}")
+    if args.max_ms is not None and result["median_ms"] > args.max_ms:
+        sys.exit(f"Median import time {result['median_ms']:.1f} ms is above {args.max_ms} ms")
+
+
+if __name__ == "__main__":
+    main()
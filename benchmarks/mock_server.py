@@ -0,0 +1,361 @@
+# -*- coding: utf-8 -*-
+"""Local stand-in for the Ollama generate API and the OpenAI chat-completions API.
+
+Answers every translation prompt of text_translation.py with a well-formed
+JSON translation (the source text prefixed with "译 "), after a latency drawn
+from a configurable distribution plus the time needed to "generate" the
+completion at a fixed token rate. A share of the requests fails with a
+retryable status, so retries, breakers and failover are exercised too, and
+a share can answer with commentary instead of JSON, unless the request
+constrains the output with a JSON schema (Ollama "format", OpenAI
+"response_format"). Requests with
+"stream": true are answered as NDJSON (Ollama) or server-sent events (OpenAI).
+Like Ollama, a model that is not loaded (first request, or idle longer than
+the request's keep_alive, 5 minutes by default) pays a cold start, reported
+as load_duration; an empty prompt only loads the model. Like a local model
+server, it can process only --parallel requests at a time and queue the
+rest, rejecting requests with 429 once --max-queue are waiting.
+
+    python benchmarks/mock_server.py [--port 11434] [--latency-ms 300] [--latency-dist lognormal]
+                                     [--error-rate 0.02] [--tokens-per-second 80] [--cold-start-ms 3000]
+                                     [--parallel 4] [--max-queue 8]
+
+Point the translator at it with OLLAMA_HOST=http://127.0.0.1:<port> and
+OPENAI_BASE_URL=http://127.0.0.1:<port>/v1.
+"""
+
+import argparse
+import json
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# 提示词中 ``` 之间的部分是待翻译的原文
+_SOURCE_RE = re.compile(r"```(.*)```", re.S)
+
+
+def estimate_tokens(text):
+    return max(1, len(text) // 4)
+
+
+def keep_alive_seconds(value, default=300.0):
+    """Seconds of an Ollama keep_alive value: a number of seconds or a duration like "30m"; negative = forever"""
+    if value is None:
+        return default
+    if isinstance(value, (int, float)):
+        seconds = float(value)
+    else:
+        match = re.fullmatch(r"\s*(-?[\d.]+)\s*(ms|s|m|h)?\s*", str(value))
+        if not match:
+            return default
+        seconds = float(match.group(1)) * {"ms": 0.001, "s": 1, "m": 60, "h": 3600, None: 1}[match.group(2)]
+    return float("inf") if seconds < 0 else seconds
+
+
+class MockOptions:
+    def __init__(self, latency_ms=300.0, latency_jitter_ms=100.0, latency_dist="normal",
+                 error_rate=0.0, error_status=503, tokens_per_second=0.0, seed=None, malformed_rate=0.0,
+                 cold_start_ms=0.0, parallel=0, max_queue=0):
+        self.latency_ms = latency_ms
+        self.latency_jitter_ms = latency_jitter_ms
+        self.latency_dist = latency_dist
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.tokens_per_second = tokens_per_second
+        self.malformed_rate = malformed_rate
+        self.cold_start_ms = cold_start_ms
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        # 同时处理的请求数上限（0 表示不限），其余请求排队
+        self.parallel = threading.Semaphore(parallel) if parallel > 0 else None
+        self.max_queue = max_queue
+        self.queued = self.in_flight = 0
+        # 已加载的模型及其卸载时间
+        self.loaded = {}
+        self.stats = {"requests": 0, "errors": 0, "prompt_tokens": 0, "completion_tokens": 0, "cold_starts": 0,
+                      "rejected": 0, "peak_in_flight": 0}
+
+    def latency(self):
+        """Time to first token in seconds"""
+        with self.lock:
+            if self.latency_dist == "fixed":
+                ms = self.latency_ms
+            elif self.latency_dist == "uniform":
+                ms = self.random.uniform(self.latency_ms - self.latency_jitter_ms, self.latency_ms + self.latency_jitter_ms)
+            elif self.latency_dist == "lognormal":
+                # 长尾分布：中位数为 latency_ms
+                sigma = self.latency_jitter_ms / max(self.latency_ms, 1.0)
+                ms = self.latency_ms * self.random.lognormvariate(0.0, sigma)
+            else:
+                ms = self.random.gauss(self.latency_ms, self.latency_jitter_ms)
+        return max(0.0, ms) / 1000
+
+    def fails(self):
+        with self.lock:
+            return self.random.random() < self.error_rate
+
+    def malformed(self):
+        with self.lock:
+            return self.random.random() < self.malformed_rate
+
+    def admit(self):
+        """Wait for a processing slot; False when the queue is full"""
+        with self.lock:
+            if self.parallel is not None and self.max_queue and self.queued >= self.max_queue:
+                self.stats["rejected"] += 1
+                return False
+            self.queued += 1
+        if self.parallel is not None:
+            self.parallel.acquire()
+        with self.lock:
+            self.queued -= 1
+            self.in_flight += 1
+            self.stats["peak_in_flight"] = max(self.stats["peak_in_flight"], self.in_flight)
+        return True
+
+    def done(self):
+        with self.lock:
+            self.in_flight -= 1
+        if self.parallel is not None:
+            self.parallel.release()
+
+    def load(self, model, keep_alive):
+        """Seconds needed to load `model` (0 when it is still loaded); keeps it loaded for keep_alive"""
+        now = time.monotonic()
+        with self.lock:
+            cold = self.loaded.get(model, 0.0) < now
+            seconds = self.cold_start_ms / 1000 if cold else 0.0
+            self.loaded[model] = now + seconds + keep_alive_seconds(keep_alive)
+            if cold and seconds:
+                self.stats["cold_starts"] += 1
+        return seconds
+
+
+def translate_prompt(prompt):
+    """Build the JSON answer text_translation.py expects for a single or a batched translation prompt"""
+    match = _SOURCE_RE.search(prompt)
+    source = match.group(1).strip() if match else prompt.strip()
+    if '"translations"' in prompt:
+        try:
+            segments = json.loads(source)
+        except ValueError:
+            segments = []
+        return json.dumps({"translations": [{"id": s["id"], "translation": "译 " + s["text"]} for s in segments]},
+                          ensure_ascii=False)
+    return json.dumps({"translation": "译 " + source}, ensure_ascii=False)
+
+
+class MockHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    options = MockOptions()
+
+    def log_message(self, format, *args):
+        pass
+
+    def handle(self):
+        try:
+            super().handle()
+        except (BrokenPipeError, ConnectionResetError):
+            # 客户端中止流后关闭了保持的连接
+            pass
+
+    def send_json(self, status, payload, headers=()):
+        body = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in headers:
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path.rstrip("/") == "/stats":
+            with self.options.lock:
+                self.send_json(200, dict(self.options.stats))
+        else:
+            self.send_json(404, {"error": "not found"})
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        request = json.loads(self.rfile.read(length) or b"{}")
+        if not self.options.admit():
+            # 队列已满，像繁忙的服务器一样拒绝
+            self.send_json(429, {"error": {"message": "server busy", "type": "rate_limit_error"}},
+                           [("Retry-After", "1")])
+            return
+        try:
+            self.answer(request)
+        finally:
+            self.options.done()
+
+    def answer(self, request):
+        if self.path.startswith("/api/generate"):
+            prompt = request.get("prompt", "")
+        elif self.path.rstrip("/").endswith("/chat/completions"):
+            prompt = "\n".join(str(m.get("content", "")) for m in request.get("messages", []))
+        else:
+            self.send_json(404, {"error": "not found"})
+            return
+
+        options = self.options
+        model = request.get("model", "mock")
+        load_seconds = 0.0
+        if self.path.startswith("/api/generate"):
+            load_seconds = options.load(model, request.get("keep_alive"))
+            time.sleep(load_seconds)
+            if not prompt:
+                # 空 prompt 只加载模型
+                self.send_json(200, {"model": model, "response": "", "done": True, "done_reason": "load",
+                                     "load_duration": int(load_seconds * 1e9)})
+                return
+        time.sleep(options.latency())
+        if options.fails():
+            with options.lock:
+                options.stats["requests"] += 1
+                options.stats["errors"] += 1
+            headers = [("Retry-After", "0")] if options.error_status == 429 else []
+            self.send_json(options.error_status, {"error": {"message": "mock failure", "type": "server_error"}}, headers)
+            return
+
+        content = translate_prompt(prompt)
+        # 按 JSON schema 约束输出时，模型只能生成合法的 JSON
+        structured = isinstance(request.get("format"), dict) or "response_format" in request
+        if not structured and options.malformed():
+            content = "Sure! Here is the translation you asked for, with a few notes on style.\n" + content
+        prompt_tokens, completion_tokens = estimate_tokens(prompt), estimate_tokens(content)
+        if request.get("stream"):
+            self.send_stream(model, content, prompt_tokens, completion_tokens, load_seconds)
+            return
+        if options.tokens_per_second > 0:
+            time.sleep(completion_tokens / options.tokens_per_second)
+        with options.lock:
+            options.stats["requests"] += 1
+            options.stats["prompt_tokens"] += prompt_tokens
+            options.stats["completion_tokens"] += completion_tokens
+
+        if self.path.startswith("/api/generate"):
+            self.send_json(200, {
+                "model": model,
+                "created_at": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+                "response": content,
+                "done": True,
+                "done_reason": "stop",
+                "load_duration": int(load_seconds * 1e9),
+                "prompt_eval_count": prompt_tokens,
+                "eval_count": completion_tokens,
+            })
+        else:
+            self.send_json(200, {
+                "id": "chatcmpl-mock",
+                "object": "chat.completion",
+                "created": int(time.time()),
+                "model": model,
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": content}, "finish_reason": "stop"}],
+                "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens,
+                          "total_tokens": prompt_tokens + completion_tokens},
+            })
+
+
+    def send_chunk(self, data):
+        self.wfile.write(b"%x\r\n%s\r\n" % (len(data), data))
+        self.wfile.flush()
+
+    def send_stream(self, model, content, prompt_tokens, completion_tokens, load_seconds=0.0):
+        """Send the completion a few characters at a time, at the configured token rate"""
+        ollama = self.path.startswith("/api/generate")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/x-ndjson" if ollama else "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        pieces = [content[i:i + 8] for i in range(0, len(content), 8)]
+        delay = 2 / self.options.tokens_per_second if self.options.tokens_per_second > 0 else 0
+        sent = 0
+        try:
+            for piece in pieces:
+                time.sleep(delay)
+                sent += 1
+                if ollama:
+                    event = {"model": model, "response": piece, "done": False}
+                else:
+                    event = {"id": "chatcmpl-mock", "object": "chat.completion.chunk", "model": model,
+                             "choices": [{"index": 0, "delta": {"content": piece}, "finish_reason": None}]}
+                self.send_chunk(self.encode_event(event, ollama))
+            if ollama:
+                final = {"model": model, "response": "", "done": True, "done_reason": "stop",
+                         "load_duration": int(load_seconds * 1e9),
+                         "prompt_eval_count": prompt_tokens, "eval_count": completion_tokens}
+                self.send_chunk(self.encode_event(final, True))
+            else:
+                usage = {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens,
+                         "total_tokens": prompt_tokens + completion_tokens}
+                self.send_chunk(self.encode_event({"id": "chatcmpl-mock", "object": "chat.completion.chunk",
+                                                   "model": model, "choices": [], "usage": usage}, False))
+                self.send_chunk(b"data: [DONE]\n\n")
+            self.wfile.write(b"0\r\n\r\n")
+        except (BrokenPipeError, ConnectionResetError):
+            # 客户端提前中止了流
+            pass
+        with self.options.lock:
+            self.options.stats["requests"] += 1
+            self.options.stats["prompt_tokens"] += prompt_tokens
+            self.options.stats["completion_tokens"] += max(1, completion_tokens * sent // max(1, len(pieces)))
+
+    @staticmethod
+    def encode_event(event, ollama):
+        data = json.dumps(event, ensure_ascii=False).encode("utf-8")
+        return data + b"\n" if ollama else b"data: " + data + b"\n\n"
+
+
+def start_server(options, host="127.0.0.1", port=0):
+    """Serve in a background thread; returns (server, base_url)"""
+    handler = type("Handler", (MockHandler,), {"options": options})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://{host}:{server.server_address[1]}"
+
+
+def add_arguments(parser):
+    parser.add_argument("--latency-ms", type=float, default=300.0, help="Median time to first token")
+    parser.add_argument("--latency-jitter-ms", type=float, default=100.0, help="Spread of the latency distribution")
+    parser.add_argument("--latency-dist", choices=["fixed", "normal", "uniform", "lognormal"], default="normal")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Share of requests that fail")
+    parser.add_argument("--error-status", type=int, default=503, help="HTTP status of failed requests (503, 429, ...)")
+    parser.add_argument("--tokens-per-second", type=float, default=0.0, help="Generation speed, 0 = instant")
+    parser.add_argument("--malformed-rate", type=float, default=0.0, help="Share of answers with commentary before the JSON")
+    parser.add_argument("--cold-start-ms", type=float, default=0.0,
+                        help="Time to load a model that is not loaded (Ollama API only)")
+    parser.add_argument("--parallel", type=int, default=0,
+                        help="Requests processed at the same time, the rest are queued (0 = unlimited)")
+    parser.add_argument("--max-queue", type=int, default=0,
+                        help="Queued requests beyond which new ones get a 429 (0 = unlimited)")
+    parser.add_argument("--seed", type=int, help="Seed of the latency/error random generator")
+
+
+def options_from_args(args):
+    return MockOptions(args.latency_ms, args.latency_jitter_ms, args.latency_dist,
+                       args.error_rate, args.error_status, args.tokens_per_second, args.seed,
+                       args.malformed_rate, args.cold_start_ms, args.parallel, args.max_queue)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=11434)
+    add_arguments(parser)
+    args = parser.parse_args()
+
+    server, url = start_server(options_from_args(args), args.host, args.port)
+    print(f"Mock Ollama/OpenAI server on {url} (OpenAI base URL {url}/v1). Ctrl+C to stop.")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
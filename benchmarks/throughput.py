@@ -0,0 +1,180 @@
+# -*- coding: utf-8 -*-
+"""End-to-end translation throughput against the local mock backend.
+
+Starts benchmarks/mock_server.py in-process, builds the synthetic fixtures
+(benchmarks/fixtures.py) and translates each one in a fresh interpreter for
+every format, size and concurrency level, with an empty translation memory.
+Ollama is the main backend and the mock OpenAI endpoint is the failover.
+
+Reports segments/s, tokens/s, the time spent in translation memory
+(checkpoint) reads and writes, connection reuse, model cold starts, the
+segments that needed no model call and the peak RSS of each run. With
+--adaptive the concurrency levels are the starting limits of the adaptive
+controller, and the limit it ends at is reported too.
+
+    python benchmarks/throughput.py [--formats txt,epub,docx,pdf] [--sizes small,medium]
+                                    [--concurrency 1,4,8] [--batch-size 1] [--stream] [--unstructured] [--latency-ms 300]
+                                    [--adaptive] [--max-concurrency 16] [--parallel 4] [--max-queue 8]
+                                    [--error-rate 0.02] [--malformed-rate 0.05] [--cold-start-ms 3000]
+                                    [--output throughput.json]
+"""
+
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import fixtures
+import mock_server
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+PROBE = r"""
+import json, os, resource, sys, time
+sys.path.insert(0, %r)
+import text_translation
+
+# 统计翻译记忆库（检查点）读写耗时
+checkpoint_io = {"seconds": 0.0, "calls": 0}
+
+def timed(fn):
+    def wrapper(*args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            checkpoint_io["seconds"] += time.perf_counter() - started
+            checkpoint_io["calls"] += 1
+    return wrapper
+
+for name in ("__init__", "__setitem__", "get", "items", "update", "import_json", "close"):
+    setattr(text_translation.TranslationMemory, name, timed(getattr(text_translation.TranslationMemory, name)))
+
+
+class CountingTranslator(text_translation.Translator):
+    segments = 0
+
+    def iter_translate_segments(self, segments, headings=()):
+        for translation in super().iter_translate_segments(segments, headings):
+            self.segments += 1
+            yield translation
+
+
+filename, overrides = sys.argv[1], json.loads(sys.argv[2])
+settings = text_translation.read_settings(os.path.join(%r, "settings.cfg.example"))
+settings.update(overrides)
+translator = CountingTranslator(settings)
+started = time.perf_counter()
+translator.translate_file(filename)
+elapsed = time.perf_counter() - started
+
+run = translator.report["run"]
+peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+# Linux 以 KB 为单位，macOS 以字节为单位
+peak_mb = peak / 1024 / 1024 if sys.platform == "darwin" else peak / 1024
+print("BENCH " + json.dumps({
+    "seconds": round(elapsed, 3),
+    "segments": translator.segments,
+    "segments_per_second": round(translator.segments / elapsed, 2),
+    "requests": run["requests"],
+    "total_tokens": run["total_tokens"],
+    "tokens_per_second": round(run["total_tokens"] / elapsed, 1),
+    "latency_ms": run["latency_ms"],
+    "checkpoint_io_ms": round(checkpoint_io["seconds"] * 1000, 1),
+    "checkpoint_io_calls": checkpoint_io["calls"],
+    "failed_segments": translator.failed_segments,
+    "aborted_streams": translator.report["streaming"]["aborted"],
+    "parse_failures": translator.report["parsing"]["failures"],
+    "skipped_segments": translator.report["skipped_segments"]["calls_saved"],
+    "connection_reuse": translator.report["backends"]["ollama"]["reuse_rate"],
+    "cold_starts": translator.report["backends"]["ollama"]["cold_starts"],
+    "final_concurrency": {k: v["limit"] for k, v in translator.report.get("concurrency", {}).items()},
+    "peak_rss_mb": round(peak_mb, 1),
+}))
+""" % (ROOT, ROOT)
+
+
+def run_once(path, base_url, overrides):
+    """Translate a copy of `path` in a fresh interpreter and return the probe result"""
+    workdir = tempfile.mkdtemp(prefix="bench-")
+    try:
+        copy = shutil.copy(path, workdir)
+        env = dict(os.environ, OLLAMA_HOST=base_url, OPENAI_BASE_URL=base_url + "/v1", OPENAI_API_KEY="mock")
+        completed = subprocess.run(
+            [sys.executable, "-c", PROBE, copy, json.dumps(overrides)],
+            cwd=workdir, env=env, capture_output=True, text=True,
+        )
+        lines = [line for line in completed.stdout.splitlines() if line.startswith("BENCH ")]
+        if completed.returncode or not lines:
+            raise RuntimeError(f"benchmark of {path} failed:\n{completed.stderr[-2000:]}")
+        return json.loads(lines[-1][len("BENCH "):])
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--formats", default=",".join(fixtures.FORMATS), help="Comma-separated input formats")
+    parser.add_argument("--sizes", default="small,medium", help="Comma-separated sizes: " + ", ".join(fixtures.SIZES))
+    parser.add_argument("--concurrency", default="1,4,8", help="Comma-separated concurrency levels")
+    parser.add_argument("--batch-size", type=int, default=1)
+    parser.add_argument("--stream", action="store_true", help="Stream the responses (see the stream option)")
+    parser.add_argument("--unstructured", action="store_true",
+                        help="Do not constrain the output with a JSON schema (see the structured-output option)")
+    parser.add_argument("--adaptive", action="store_true",
+                        help="Adapt the concurrency to the backend (see the adaptive-concurrency option)")
+    parser.add_argument("--max-concurrency", type=int, default=16, help="Upper limit of the adaptive concurrency")
+    parser.add_argument("--fixtures", default=os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures"))
+    parser.add_argument("--output", help="Write the results as JSON to this file")
+    mock_server.add_arguments(parser)
+    args = parser.parse_args()
+
+    options = mock_server.options_from_args(args)
+    server, base_url = mock_server.start_server(options)
+    results = []
+    print(f"{'format':<6} {'size':<7} {'conc':>4} {'segs':>6} {'seconds':>8} {'segs/s':>8} "
+          f"{'tokens/s':>9} {'ckpt ms':>8} {'rss MB':>7} {'failed':>6}")
+    try:
+        for size in args.sizes.split(","):
+            for file_format in args.formats.split(","):
+                path = fixtures.make_fixture(args.fixtures, size, file_format)
+                for concurrency in (int(c) for c in args.concurrency.split(",")):
+                    overrides = {
+                        "openai_apikey": "",
+                        "transliteration_list_file": "",
+                        "bilingual_output": "False",
+                        "startpage": 1,
+                        "endpage": -1,
+                        "concurrency": concurrency,
+                        "batch_size": args.batch_size,
+                        "stream": args.stream,
+                        "structured_output": not args.unstructured,
+                        "adaptive_concurrency": args.adaptive,
+                        "max_concurrency": args.max_concurrency,
+                        "failover": ["openai"],
+                        # 模拟的错误应很快重试，避免退避时间主导结果
+                        "backoff_base": 0.05,
+                        "backoff_max": 0.5,
+                    }
+                    result = dict(format=file_format, size=size, concurrency=concurrency,
+                                  batch_size=args.batch_size, **run_once(path, base_url, overrides))
+                    results.append(result)
+                    print(f"{file_format:<6} {size:<7} {concurrency:>4} {result['segments']:>6} "
+                          f"{result['seconds']:>8.2f} {result['segments_per_second']:>8.2f} "
+                          f"{result['tokens_per_second']:>9.1f} {result['checkpoint_io_ms']:>8.1f} "
+                          f"{result['peak_rss_mb']:>7.1f} {result['failed_segments']:>6}")
+    finally:
+        server.shutdown()
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump({"mock": vars(args), "mock_stats": options.stats, "results": results}, f, indent=4)
+
+
+if __name__ == "__main__":
+    main()
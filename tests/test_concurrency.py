@@ -0,0 +1,75 @@
+import text_translation as tt
+
+
+def test_share_restores_previous_semaphore():
+    controller = tt.ConcurrencyController()
+    assert controller.shared is None
+    with controller.share(2):
+        outer = controller.shared
+        assert outer is not None
+        with controller.share(1):
+            assert controller.shared is not outer
+        assert controller.shared is outer
+    assert controller.shared is None
+
+
+def test_share_restored_after_error():
+    controller = tt.ConcurrencyController()
+    try:
+        with controller.share(2):
+            raise RuntimeError
+    except RuntimeError:
+        pass
+    assert controller.shared is None
+
+
+def finish(limit, outcome, count=1, latency=0.0):
+    for _ in range(count):
+        started = limit.acquire()
+        limit.release(started - latency, outcome)
+
+
+def test_adaptive_limit_slow_start_doubles_then_cut_halves():
+    limit = tt.AdaptiveLimit(initial=2, maximum=16, latency_target=1.0)
+    finish(limit, "ok", 4)
+    assert limit.current == 4
+    finish(limit, "ok", 4)
+    assert limit.current == 8
+    finish(limit, "rate_limited")
+    assert limit.current == 4
+    # 回退后每个窗口只加一
+    finish(limit, "ok", 4)
+    assert limit.current == 5
+    assert limit.report()["decreases"]["rate_limited"] == 1
+
+
+def test_adaptive_limit_trims_on_errors_and_latency():
+    limit = tt.AdaptiveLimit(initial=8, maximum=8, latency_target=0.5)
+    finish(limit, "server_error", 8)
+    assert limit.current == 6
+    assert limit.report()["decreases"]["errors"] == 1
+    limit = tt.AdaptiveLimit(initial=8, maximum=8, latency_target=0.5)
+    finish(limit, "ok", 8, latency=2.0)
+    assert limit.current == 6
+    assert limit.report()["decreases"]["latency"] == 1
+    assert limit.report()["p95_ms"] >= 2000
+
+
+def test_adaptive_limit_ignores_requests_started_before_cut():
+    limit = tt.AdaptiveLimit(initial=8, maximum=8)
+    started = [limit.acquire() for _ in range(4)]
+    limit.release(started[0], "timeout")
+    assert limit.current == 4
+    # 同一批失败只减一次
+    for s in started[1:]:
+        limit.release(s, "timeout")
+    assert limit.current == 4
+
+
+def test_adaptive_limit_bounds():
+    limit = tt.AdaptiveLimit(initial=1, maximum=2, latency_target=1.0)
+    finish(limit, "ok", 8)
+    assert limit.current == 2
+    for _ in range(5):
+        finish(limit, "rate_limited")
+    assert limit.current == 1
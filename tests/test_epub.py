@@ -0,0 +1,31 @@
+import os
+import zipfile
+
+import text_translation as tt
+
+
+def test_part_path_stays_inside_parts_dir(tmp_path):
+    writer = tt._StagedEpub(str(tmp_path / "out" / "book.epub"))
+    parts_dir = os.path.abspath(writer.parts_dir)
+    assert writer._part_path("OEBPS/chap1.xhtml") == os.path.join(parts_dir, "OEBPS", "chap1.xhtml")
+    for name in ("../../evil.xhtml", "OEBPS/../../evil.xhtml", "/tmp/evil.xhtml", "..", "."):
+        path = writer._part_path(name)
+        assert os.path.commonpath((parts_dir, path)) == parts_dir
+        assert path != parts_dir
+
+
+def test_crafted_names_are_staged_and_zipped(tmp_path):
+    (tmp_path / "out").mkdir()
+    writer = tt._StagedEpub(str(tmp_path / "out" / "book.epub"))
+    names = ["../../evil.xhtml", "OEBPS/chap1.xhtml"]
+    for name in names:
+        writer.stage(name, name.encode("utf-8"))
+        assert writer.staged(name)
+    assert not (tmp_path / "evil.xhtml").exists()
+    assert sorted(os.listdir(tmp_path / "out")) == ["book.epub.parts"]
+
+    writer._assemble((name, None) for name in names)
+    with zipfile.ZipFile(writer.filename) as zf:
+        assert zf.namelist()[0] == "mimetype"
+        assert sorted(zf.read(info).decode("utf-8") for info in zf.infolist()[1:]) == sorted(names)
+    assert not os.path.exists(writer.parts_dir)
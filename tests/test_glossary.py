@@ -0,0 +1,44 @@
+import re
+
+import text_translation as tt
+
+
+def glossary(mapping, case_sensitive=True):
+    pattern = re.compile(r"(?<!\w)" + tt._glossary_trie_regex(mapping) + r"(?!\w)",
+                         0 if case_sensitive else re.IGNORECASE)
+    return pattern, mapping, case_sensitive
+
+
+def test_trie_regex_prefers_longest_word():
+    pattern, mapping, _ = glossary({"New": "新", "New York": "紐約", "New Yorker": "紐約客", "a.b": "甲乙"})
+    text = "New Yorker in New York, New and a.b but not axb"
+    assert pattern.sub(lambda m: mapping[m.group(0)], text) == "紐約客 in 紐約, 新 and 甲乙 but not axb"
+
+
+def test_trie_regex_matches_whole_words_only():
+    pattern, _, _ = glossary({"cat": "貓"})
+    assert pattern.findall("cat concat cats cat.") == ["cat", "cat"]
+
+
+def test_classifier_pass_through():
+    classifier = tt.SegmentClassifier("zh-TW")
+    for text in ("12", "— 3 —", "https://example.com/a?b=1", "user@example.com", "ISBN 978-0-306-40615-7",
+                 "10.1000/xyz123", "print(x)", "x = a + b", "IV.", "這是中文。", "<g1>42</g1>"):
+        assert classifier.classify(text) == (tt.PASS_THROUGH, text), text
+
+
+def test_classifier_roman_numerals_and_prose():
+    classifier = tt.SegmentClassifier("zh-TW")
+    assert classifier.classify("IV", heading=True) == (tt.PASS_THROUGH, "IV")
+    assert classifier.classify("I")[0] == tt.NEEDS_TRANSLATION
+    assert classifier.classify("The total = the sum of all parts.")[0] == tt.NEEDS_TRANSLATION
+    # 拉丁字母的目标语言不按文字判断
+    assert tt.SegmentClassifier("fr").classify("Bonjour le monde")[0] == tt.NEEDS_TRANSLATION
+
+
+def test_classifier_glossary_only():
+    classifier = tt.SegmentClassifier("zh", glossary({"london": "倫敦", "paris": "巴黎"}, case_sensitive=False))
+    assert classifier.classify("London, Paris!") == (tt.GLOSSARY_ONLY, "倫敦, 巴黎!")
+    # 已替换过的译名也算覆盖
+    assert classifier.classify("London — 巴黎")[0] == tt.GLOSSARY_ONLY
+    assert classifier.classify("London is big")[0] == tt.NEEDS_TRANSLATION
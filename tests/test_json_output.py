@@ -0,0 +1,57 @@
+import json
+
+import pytest
+
+from text_translation import MalformedOutputError, StreamingJsonExtractor, parse_json_response
+
+
+def feed_all(extractor, text, size=3):
+    for i in range(0, len(text), size):
+        if extractor.feed(text[i:i + size]):
+            break
+    return extractor.result()
+
+
+@pytest.mark.parametrize("text", [
+    '{"translation": "你好"}',
+    '<think>reasoning</think>\n{"translation": "你好"}',
+    '```json\n{"translation": "你好"}\n```',
+])
+def test_parse_json_response_accepts_the_expected_object(text):
+    assert parse_json_response(text, "translation") == "你好"
+
+
+@pytest.mark.parametrize("text", [
+    'Sure! {"translation": "你好"}',
+    '{"translation": "你好"} Hope this helps.',
+    '{"text": "你好"}',
+    '{"translation": ["你好"]}',
+    '{"translation": "你好"',
+])
+def test_parse_json_response_rejects_malformed_output(text):
+    with pytest.raises(MalformedOutputError):
+        parse_json_response(text, "translation")
+
+
+def test_streaming_extractor_decodes_escapes_across_chunks():
+    value = 'Line "one"\n\\ tab\t😀 é'
+    text = json.dumps({"translation": value})
+    result = feed_all(StreamingJsonExtractor("translation", 1000), text)
+    assert json.loads(result)["translation"] == value
+
+
+def test_streaming_extractor_list_value():
+    text = '{"translations": [{"id": 1, "translation": "a"}]}'
+    result = feed_all(StreamingJsonExtractor("translations", 1000, string_value=False), text)
+    assert parse_json_response(result, "translations", list) == [{"id": 1, "translation": "a"}]
+
+
+@pytest.mark.parametrize("text", [
+    'Here is the translation: {"translation": "x"}',
+    '{"answer": "x"}',
+    '{"translation": "\\uZZZZ"}',
+    '{"translation": "' + "x" * 200 + '"}',
+])
+def test_streaming_extractor_fails_early(text):
+    with pytest.raises(MalformedOutputError):
+        feed_all(StreamingJsonExtractor("translation", 100), text)
@@ -0,0 +1,38 @@
+import pytest
+
+import text_translation as tt
+
+
+def test_token_bucket_refill_and_wait():
+    bucket = tt.TokenBucket(60)
+    bucket.updated = 0.0
+    bucket.take(60)
+    assert bucket.headroom() == 0.0
+    assert bucket.wait_time(30) == pytest.approx(30.0)
+    bucket.refill(15.0)
+    assert bucket.tokens == pytest.approx(15.0)
+    assert bucket.wait_time(10) == 0.0
+    # 补充不超过容量
+    bucket.refill(1000.0)
+    assert bucket.tokens == 60.0
+    # 超过容量的请求只等待到桶满
+    bucket.take(60)
+    assert bucket.wait_time(500) == pytest.approx(60.0)
+
+
+def test_token_bucket_unlimited():
+    bucket = tt.TokenBucket(0)
+    bucket.take(1000)
+    bucket.refill(bucket.updated + 60)
+    assert bucket.headroom() == 1.0
+    assert bucket.wait_time(10 ** 6) == 0.0
+
+
+def test_key_scheduler_prefers_headroom_and_skips_cooled_down_keys():
+    scheduler = tt.KeyScheduler(["sk-aaaa", "sk-bbbb"], rpm=10)
+    first = scheduler.acquire()
+    second = scheduler.acquire()
+    assert {first, second} == {"sk-aaaa", "sk-bbbb"}
+    scheduler.cooldown("sk-aaaa", 60)
+    assert [scheduler.acquire() for _ in range(3)] == ["sk-bbbb"] * 3
+    assert scheduler.utilisation()["…aaaa"]["rate_limited"] == 1
@@ -0,0 +1,17 @@
+import text_translation as tt
+
+
+def test_normalize_segment():
+    assert tt.normalize_segment("“Page  12”\n said ＡＢＣ") == '"Page #" said ABC'
+    assert tt.normalize_segment("Chapter 3") == tt.normalize_segment("Chapter  45")
+    assert tt.segment_key("It’s 1") == tt.segment_key("It's 2")
+
+
+def test_adapt_numbers():
+    assert tt.adapt_numbers("Page 12 of 30", "第 12 頁，共 30 頁", "Page 13 of 30") == "第 13 頁，共 30 頁"
+    # 数字相同时原样使用，即使前导零不同
+    assert tt.adapt_numbers("Room 7", "七號房", "Room 07") == "七號房"
+    # 译文中的数字与原文不一致时无法替换
+    assert tt.adapt_numbers("Page 12", "第十二頁", "Page 13") is None
+    assert tt.adapt_numbers("1 and 2", "2 與 1", "3 and 4") is None
+    assert tt.adapt_numbers("Page 12", "第 12 頁", "Page 12 13") is None
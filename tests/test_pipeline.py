@@ -0,0 +1,73 @@
+import threading
+import time
+
+import text_translation as tt
+
+
+class StubTranslator(tt.Translator):
+    """Translator whose model upper-cases each batch and records how many batches run at once"""
+
+    def __init__(self, workers, batch_size, delay=0.01):
+        self._reset_file_state()
+        self.workers = workers
+        self.batch_size = batch_size
+        self.adaptive_concurrency = False
+        self.delay = delay
+        self.batches = []
+        self.memory = {}
+        self.running = 0
+        self.peak = 0
+        self.counter_lock = threading.Lock()
+
+    def lookup(self, segment):
+        return self.memory.get(segment)
+
+    def translate_batch_and_store(self, batch):
+        with self.counter_lock:
+            self.batches.append(list(batch))
+            self.running += 1
+            self.peak = max(self.peak, self.running)
+        time.sleep(self.delay)
+        with self.counter_lock:
+            self.running -= 1
+            self.memory.update((s, s.upper()) for s in batch)
+        return [s.upper() for s in batch]
+
+
+def test_source_order_and_duplicates():
+    segments = [f"s{i % 7}" for i in range(40)]
+    translator = StubTranslator(workers=4, batch_size=3)
+    assert translator.translate_segments(segments) == [s.upper() for s in segments]
+    # 重复的段落只翻译一次
+    assert sorted(s for b in translator.batches for s in b) == sorted(set(segments))
+
+
+def test_in_flight_requests_bounded_by_workers():
+    segments = [f"s{i}" for i in range(60)]
+    translator = StubTranslator(workers=3, batch_size=2)
+    assert translator.translate_segments(segments) == [s.upper() for s in segments]
+    assert translator.peak <= 3
+    assert all(len(b) <= 2 for b in translator.batches)
+
+
+def test_stream_read_ahead_is_bounded():
+    read = []
+
+    def stream():
+        for i in range(1000):
+            read.append(i)
+            yield f"s{i}"
+
+    translator = StubTranslator(workers=2, batch_size=2, delay=0)
+    translations = translator.iter_translate_segments(stream())
+    assert next(translations) == "S0"
+    translations.close()
+    # 只预读 2 * workers * batch_size 个段落
+    assert len(read) <= 2 * 2 * 2
+
+
+def test_sequential():
+    segments = ["a", "b", "a", "c"]
+    translator = StubTranslator(workers=1, batch_size=2, delay=0)
+    assert list(translator.iter_translate_segments(iter(segments))) == ["A", "B", "A", "C"]
+    assert translator.peak == 1
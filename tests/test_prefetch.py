@@ -0,0 +1,38 @@
+import itertools
+import threading
+
+import pytest
+
+from text_translation import prefetch
+
+
+def test_prefetch_yields_in_order():
+    assert list(prefetch(iter(range(10)), maxsize=2)) == list(range(10))
+
+
+def test_prefetch_raises_source_errors():
+    def source():
+        yield 1
+        raise RuntimeError("broken page")
+
+    with pytest.raises(RuntimeError):
+        list(prefetch(source()))
+
+
+def test_closing_prefetch_closes_the_source():
+    closed = threading.Event()
+
+    def source():
+        try:
+            for n in itertools.count():
+                yield n
+        finally:
+            closed.set()
+
+    threads = threading.active_count()
+    items = prefetch(source(), maxsize=1)
+    assert list(itertools.islice(items, 3)) == [0, 1, 2]
+    items.close()
+    # 生产线程已结束，源生成器的 finally 已执行
+    assert closed.is_set()
+    assert threading.active_count() == threads
@@ -0,0 +1,60 @@
+import pytest
+
+import text_translation
+from text_translation import BackendError, CircuitBreaker, ResiliencePolicy
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(text_translation.time, "monotonic", lambda: now[0])
+    return now
+
+
+def test_breaker_opens_after_threshold_and_half_opens(clock):
+    breaker = CircuitBreaker(threshold=2, reset_timeout=10)
+    breaker.failure()
+    assert breaker.state == "closed"
+    breaker.failure()
+    assert breaker.state == "open"
+    assert not breaker.allow()
+    clock[0] += 10
+    assert breaker.state == "half-open"
+    # 半开状态只放行一个试探请求
+    assert breaker.allow()
+    assert not breaker.allow()
+    breaker.success()
+    assert breaker.state == "closed"
+
+
+def test_fatal_error_releases_half_open_trial(clock):
+    policy = ResiliencePolicy(max_retries=0, breaker_threshold=1, breaker_reset=10)
+    breaker = policy.breaker("ollama")
+    breaker.failure()
+    clock[0] += 10
+
+    def bad_request():
+        raise ValueError("bad request")
+
+    with pytest.raises(BackendError) as error:
+        policy.call("ollama", bad_request)
+    assert error.value.kind == "fatal"
+    # 试探请求已结束，下一个请求可以继续试探
+    assert policy.call("ollama", lambda: "ok") == "ok"
+    assert breaker.state == "closed"
+
+
+def test_malformed_output_is_retried_without_opening_the_circuit(monkeypatch):
+    monkeypatch.setattr(text_translation.time, "sleep", lambda seconds: None)
+    policy = ResiliencePolicy(max_retries=3, backoff_base=0, breaker_threshold=2)
+    answers = iter(["bad", "bad", "bad", "ok"])
+
+    def model():
+        answer = next(answers)
+        if answer == "bad":
+            raise text_translation.MalformedOutputError("text before the JSON object")
+        return answer
+
+    assert policy.call("ollama", model) == "ok"
+    assert policy.breaker("ollama").state == "closed"
+    assert policy.breaker("ollama").failures == 0
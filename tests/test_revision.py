@@ -0,0 +1,26 @@
+import text_translation as tt
+
+
+def test_revise_segments_keeps_unchanged_segments():
+    old = ["First sentence. Second sentence.", "Third sentence here.", "Fourth one."]
+    new = ["First sentence. Second sentence.", "Third sentence changed.", "Fourth one."]
+    segments, reused, counts = tt.revise_segments(old, new)
+    assert segments == ["First sentence. Second sentence.", "Third sentence changed.", "Fourth one."]
+    assert reused == [old[0], old[2]]
+    assert counts["unchanged"] >= 3
+
+
+def test_revise_segments_repacks_split_segments():
+    old = ["Alpha one. Beta two.", "Gamma three."]
+    # 新版在原段落中间插入了一句，原段落不再连续，需要重新切分
+    new = ["Alpha one. Inserted sentence. Beta two.", "Gamma three."]
+    segments, reused, _ = tt.revise_segments(old, new)
+    assert reused == ["Gamma three."]
+    assert segments[-1] == "Gamma three."
+    assert " ".join(segments[:-1]) == "Alpha one. Inserted sentence. Beta two."
+
+
+def test_revise_segments_identical_editions():
+    old = ["One. Two.", "Three."]
+    segments, reused, _ = tt.revise_segments(old, list(old))
+    assert segments == old == reused
@@ -0,0 +1,43 @@
+from text_translation import clean_paragraphs, estimate_tokens, iter_segments, split_text
+
+PARAGRAPHS = [
+    "The river was cold that winter. Nobody crossed it after dark.",
+    "Letters arrived late. The council met in the station.",
+    "She walked to the harbour and watched the boats come in.",
+]
+
+
+def test_split_text_keeps_paragraphs_whole():
+    segments = split_text("\n".join(PARAGRAPHS), max_tokens=40)
+    assert "\n".join(segments).split("\n") == PARAGRAPHS
+    assert all(estimate_tokens(s) <= 40 for s in segments)
+
+
+def test_split_text_splits_long_paragraph_at_sentences():
+    paragraph = " ".join(f"Sentence number {i} ends here." for i in range(20))
+    segments = split_text(paragraph, max_tokens=20)
+    assert len(segments) > 1
+    assert all(s.endswith("here.") for s in segments)
+    assert " ".join(segments) == paragraph
+
+
+def test_iter_segments_matches_split_text_across_chunks():
+    # 页面在单词之间断开，下一页接着上一页的最后一段
+    words = " ".join(PARAGRAPHS * 5).split(" ")
+    chunks = [" ".join(words[i:i + 7]) for i in range(0, len(words), 7)]
+    segments = list(iter_segments(chunks, max_tokens=30))
+    assert " ".join(segments).split() == words
+    assert all(s.endswith(".") for s in segments)
+
+
+def test_clean_paragraphs_one_paragraph_per_line():
+    assert clean_paragraphs("  One   line.\n\nTwo\tlines.\n") == "One line.\nTwo lines."
+
+
+def test_clean_paragraphs_joins_wrapped_pdf_lines():
+    page = "The garden was quiet in the\nevening market. Carried\nletters home.\n\nNext paragraph\nstarts here.\n"
+    cleaned = clean_paragraphs(page, wrapped_lines=True)
+    assert cleaned == "The garden was quiet in the evening market. Carried letters home.\nNext paragraph starts here."
+    # 段落在句子边界上切分，不会在句子中间断开
+    for segment in split_text(cleaned, max_tokens=12):
+        assert segment.endswith(".")
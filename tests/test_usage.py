@@ -0,0 +1,36 @@
+import time
+
+from text_translation import UsageTracker
+
+
+def record_calls(tracker, count, **labels):
+    with tracker.context(**labels):
+        for i in range(count):
+            tracker.record("ollama", "m", "translate", time.perf_counter() - 0.01, 10, 5, failed=(i == 0))
+
+
+def test_report_is_scoped_to_a_run():
+    tracker = UsageTracker()
+    first = tracker.new_run()
+    record_calls(tracker, 11, run_id=first, file="book.txt", chapter="a")
+    report = tracker.report(file="book.txt", run_id=first)["run"]
+    assert (report["requests"], report["failed_requests"]) == (10, 1)
+    assert report["prompt_tokens"] == 110
+    tracker.fold(run_id=first)
+
+    second = tracker.new_run()
+    report = tracker.report(file="book.txt", run_id=second)["run"]
+    assert report["requests"] == 0 and report["total_tokens"] == 0
+
+
+def test_fold_keeps_totals_and_drops_per_file_groups():
+    tracker = UsageTracker(max_samples=4)
+    for n in range(20):
+        run_id = tracker.new_run()
+        record_calls(tracker, 3, run_id=run_id, file=f"book{n}.txt", chapter="a")
+        tracker.fold(run_id=run_id)
+    # 只剩成功与失败两个分组
+    assert len(tracker.groups) == 2
+    assert all(len(g["latencies"]) <= 4 for g in tracker.groups.values())
+    run = tracker.report()["run"]
+    assert (run["requests"], run["failed_requests"]) == (40, 20)
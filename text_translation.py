@@ -1,114 +1,1350 @@
 # -*- coding: utf-8 -*- 
 
-import pdfminer.high_level
-import re
-import openai
-from tqdm import tqdm
-import ollama
 import time
-from typing import Dict, Optional, List, Tuple
-from openai import OpenAI
 
-# import nltk
-# nltk.download('punkt')
-# from nltk.tokenize import sent_tokenize
-import ebooklib
-from ebooklib import epub
+_import_started = time.perf_counter()
+
+import re
 import os
 import tempfile
-import shutil
-from bs4 import BeautifulSoup
 import configparser
-from pdfminer.pdfdocument import PDFDocument
-from pdfminer.pdfparser import PDFParser
-from pdfminer.pdfinterp import PDFResourceManager, PDFPageInterpreter
-from pdfminer.converter import TextConverter
-from pdfminer.layout import LAParams
-from pdfminer.pdfpage import PDFPage
+import argparse
 from io import StringIO
 import random
-import json
-import docx
+import copy
+import difflib
+import posixpath
+import shutil
+import sys
 import zipfile
-from lxml import etree
-from docx import Document
-import mobi
-import pandas as pd
-
-openai_client = OpenAI(
-    api_key=os.getenv("OPENAI_API_KEY"),
-    #api_key="sk-JzkGqfheJ6TJacmtSGBlZrh4LxuWa51MX2p2WzGZfhOd7cHy",
-    base_url="https://api.fe8.cn/v1",
-)
+import hashlib
+import json
+import queue
+import sqlite3
+import threading
+import unicodedata
+import weakref
+import zlib
+from collections import Counter, deque
+from itertools import islice, tee
+from contextlib import contextmanager, nullcontext
+from xml.sax.saxutils import escape as xml_escape
+from urllib.parse import unquote
+import html
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
+from typing import Dict, Optional, List
 
-def beep_forever():
-    while True:
-        print('\a')
-        os.system('afplay /System/Library/Sounds/Ping.aiff')
-        time.sleep(1)
+from tqdm import tqdm
 
-def safe_json_parse(text: str, fallback_key: str = "improved_text") -> Dict:
-    """Parsear JSON de forma segura con fallback"""
-    if not text or text.strip() == "":
-        return {fallback_key: ""}
-    
+# import nltk
+# nltk.download('punkt')
+# from nltk.tokenize import sent_tokenize
+
+# pdfminer, ebooklib, bs4, docx, mobi, pandas, ollama 和 openai 只在需要时才导入，
+# 这样导入本模块或运行 --help 时不必加载它们
+
+def get_openai_client(api_key=None):
+    """Shared OpenAI client for api_key (default: $OPENAI_API_KEY), created on first use"""
+    return backends.openai_client(api_key)
+
+
+def _field(response, name):
+    """Read a field from a backend response that may be a dict or an object"""
+    if response is None:
+        return None
+    if isinstance(response, dict):
+        return response.get(name)
+    return getattr(response, name, None)
+
+
+def _percentile(values, q):
+    """Nearest-rank percentile of a list of numbers (q in 0..100)"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = max(1, -(-len(ordered) * q // 100))
+    return ordered[int(rank) - 1]
+
+
+class UsageTracker:
+    """Thread-safe token, latency and outcome counts of backend calls, grouped by their labels"""
+
+    def __init__(self, max_samples=2048):
+        self.lock = threading.Lock()
+        self.groups = {}
+        self.max_samples = max_samples
+        self.random = random.Random(0)
+        self.runs = 0
+        self.local = threading.local()
+
+    def current(self):
+        return getattr(self.local, "context", {})
+
+    @contextmanager
+    def context(self, **labels):
+        previous = self.current()
+        self.local.context = {**previous, **labels}
+        try:
+            yield
+        finally:
+            self.local.context = previous
+
+    def wrap(self, fn):
+        labels = self.current()
+
+        def run(*args, **kwargs):
+            with self.context(**labels):
+                return fn(*args, **kwargs)
+        return run
+
+    def new_run(self):
+        """A fresh run_id label for one translate_file() or library run"""
+        with self.lock:
+            self.runs += 1
+            return self.runs
+
+    def _merge(self, labels, requests, prompt_tokens, completion_tokens, started, ended,
+               latency_total, latency_max, latencies):
+        """Add counts to the group of labels. Must be called with lock held."""
+        key = tuple(sorted(labels.items()))
+        group = self.groups.get(key)
+        if group is None:
+            group = self.groups[key] = {
+                "labels": labels, "requests": 0, "prompt_tokens": 0, "completion_tokens": 0,
+                "started": started, "ended": ended, "latency_total": 0.0, "latency_max": 0.0, "latencies": [],
+            }
+        group["requests"] += requests
+        group["prompt_tokens"] += prompt_tokens
+        group["completion_tokens"] += completion_tokens
+        group["started"] = min(group["started"], started)
+        group["ended"] = max(group["ended"], ended)
+        group["latency_total"] += latency_total
+        group["latency_max"] = max(group["latency_max"], latency_max)
+        samples = group["latencies"]
+        for latency in latencies:
+            # reservoir sampling：最多保留 max_samples 个耗时
+            if len(samples) < self.max_samples:
+                samples.append(latency)
+            else:
+                slot = self.random.randrange(group["requests"])
+                if slot < self.max_samples:
+                    samples[slot] = latency
+
+    def record(self, backend, model, kind, started, prompt_tokens=None, completion_tokens=None, failed=False):
+        """Account one request attempt; failed attempts are counted apart with their latency and tokens"""
+        ended = time.perf_counter()
+        latency = ended - started
+        labels = {"backend": backend, "model": model, "kind": kind, **self.current(), "failed": failed}
+        with self.lock:
+            self._merge(labels, 1, prompt_tokens or 0, completion_tokens or 0, started, ended,
+                        latency, latency, [latency])
+
+    def fold(self, drop=("run_id", "file", "chapter"), **labels):
+        """Merge the groups matching labels into groups without the `drop` labels, once they are reported"""
+        with self.lock:
+            for key, group in list(self.groups.items()):
+                if all(group["labels"].get(k) == v for k, v in labels.items()):
+                    del self.groups[key]
+                    self._merge({k: v for k, v in group["labels"].items() if k not in drop},
+                                group["requests"], group["prompt_tokens"], group["completion_tokens"],
+                                group["started"], group["ended"], group["latency_total"],
+                                group["latency_max"], group["latencies"])
+
+    def select(self, **labels):
+        """The aggregated groups whose labels match"""
+        with self.lock:
+            return [dict(g, latencies=list(g["latencies"])) for g in self.groups.values()
+                    if all(g["labels"].get(k) == v for k, v in labels.items())]
+
+    @staticmethod
+    def summarize(groups, cost_per_1k_tokens=0.0):
+        """Aggregate groups of calls into counts, token totals, latency percentiles and throughput.
+
+        Latency and request rates cover the successful requests; tokens and
+        wall time include the failed attempts, which are reported apart.
+        """
+        ok = [g for g in groups if not g["labels"]["failed"]]
+        failed = [g for g in groups if g["labels"]["failed"]]
+        requests = sum(g["requests"] for g in ok)
+        failed_requests = sum(g["requests"] for g in failed)
+        latencies = [round(latency * 1000, 1) for g in ok for latency in g["latencies"]]
+        prompt_tokens = sum(g["prompt_tokens"] for g in groups)
+        completion_tokens = sum(g["completion_tokens"] for g in groups)
+        total_tokens = prompt_tokens + completion_tokens
+        wall = (max(g["ended"] for g in groups) - min(g["started"] for g in groups)) if groups else 0.0
+
+        def mean_ms(groups, count):
+            return round(sum(g["latency_total"] for g in groups) / count * 1000, 1) if count else None
+
+        def max_ms(groups):
+            return round(max(g["latency_max"] for g in groups) * 1000, 1) if groups else None
+
+        return {
+            "requests": requests,
+            "failed_requests": failed_requests,
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "total_tokens": total_tokens,
+            "cost": round(total_tokens / 1000 * cost_per_1k_tokens, 6),
+            "wall_seconds": round(wall, 3),
+            "requests_per_second": round(requests / wall, 3) if wall else None,
+            "tokens_per_second": round(total_tokens / wall, 3) if wall else None,
+            "completion_tokens_per_second": round(completion_tokens / wall, 3) if wall else None,
+            "latency_ms": {
+                "mean": mean_ms(ok, requests),
+                "p50": _percentile(latencies, 50),
+                "p90": _percentile(latencies, 90),
+                "p95": _percentile(latencies, 95),
+                "p99": _percentile(latencies, 99),
+                "max": max_ms(ok),
+            },
+            "failed_latency_ms": {
+                "mean": mean_ms(failed, failed_requests),
+                "max": max_ms(failed),
+            },
+        }
+
+    def report(self, cost_per_1k_tokens=0.0, **labels):
+        """Per-run, per-backend and per-chapter report of the calls matching labels"""
+        groups = self.select(**labels)
+        by_backend, chapters = {}, {}
+        for g in groups:
+            by_backend.setdefault(g["labels"]["backend"], []).append(g)
+            chapters.setdefault(g["labels"].get("chapter"), []).append(g)
+        return {
+            **labels,
+            "cost_per_1k_tokens": cost_per_1k_tokens,
+            "run": self.summarize(groups, cost_per_1k_tokens),
+            "by_backend": {k: self.summarize(v, cost_per_1k_tokens) for k, v in by_backend.items()},
+            "chapters": [
+                {"chapter": k, **self.summarize(v, cost_per_1k_tokens)} for k, v in chapters.items()
+            ],
+        }
+
+
+# 记录所有后端请求的 token 与耗时
+usage_tracker = UsageTracker()
+
+
+class StageProfiler:
+    """Wall time, CPU time, calls and bytes of each pipeline stage (``--profile``)"""
+
+    def __init__(self):
+        self.enabled = False
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.stages = {}
+        self.events = None
+        self.threads = {}
+        self.cprofile = None
+        self.streams = None
+        self.started = self.cpu_started = 0.0
+        self.elapsed = self.cpu = None
+
+    def start(self, trace=False, cprofile=False):
+        self.stages = {}
+        self.events = [] if trace else None
+        self.threads = {}
+        self.elapsed = self.cpu = None
+        self.started, self.cpu_started = time.perf_counter(), time.process_time()
+        # print 与 tqdm 的输出经过计时的包装
+        self.streams = (sys.stdout, sys.stderr)
+        sys.stdout, sys.stderr = _ProfiledStream(sys.stdout, self), _ProfiledStream(sys.stderr, self)
+        self.cprofile = None
+        if cprofile:
+            import cProfile
+            self.cprofile = cProfile.Profile()
+            self.cprofile.enable()
+        self.enabled = True
+
+    def stop(self):
+        if not self.enabled:
+            return
+        self.enabled = False
+        if self.cprofile is not None:
+            self.cprofile.disable()
+        sys.stdout, sys.stderr = self.streams
+        self.elapsed = time.perf_counter() - self.started
+        self.cpu = time.process_time() - self.cpu_started
+
+    def stage(self, name, size=0, calls=1):
+        """Context manager timing stage `name`; `size` is a byte count or the str/bytes processed.
+
+        Use calls=0 for the continuation of a call already counted (e.g. reading a stream).
+        """
+        if not self.enabled:
+            return nullcontext()
+        return self._measure(name, size, calls)
+
+    @contextmanager
+    def _measure(self, name, size, calls):
+        stack = self.local.__dict__.setdefault("stack", [])
+        # 内层阶段的耗时累加到这里，从本阶段中扣除
+        nested = [0.0, 0.0]
+        stack.append(nested)
+        wall_started, cpu_started = time.perf_counter(), time.thread_time()
+        try:
+            yield
+        finally:
+            wall, cpu = time.perf_counter() - wall_started, time.thread_time() - cpu_started
+            stack.pop()
+            if stack:
+                stack[-1][0] += wall
+                stack[-1][1] += cpu
+            self._add(name, calls, wall - nested[0], cpu - nested[1], size)
+            if self.events is not None:
+                thread = threading.current_thread()
+                with self.lock:
+                    self.threads[thread.ident] = thread.name
+                    self.events.append({"name": name, "ph": "X", "pid": os.getpid(), "tid": thread.ident,
+                                        "ts": round((wall_started - self.started) * 1e6, 1),
+                                        "dur": round(wall * 1e6, 1)})
+
+    def add_bytes(self, name, size):
+        """Count bytes processed by stage `name` outside a stage() block"""
+        if self.enabled:
+            self._add(name, 0, 0.0, 0.0, size)
+
+    def _add(self, name, calls, wall, cpu, size):
+        if isinstance(size, str):
+            size = len(size.encode("utf-8"))
+        elif isinstance(size, (bytes, bytearray)):
+            size = len(size)
+        with self.lock:
+            stats = self.stages.setdefault(name, {"calls": 0, "wall": 0.0, "cpu": 0.0, "bytes": 0})
+            stats["calls"] += calls
+            stats["wall"] += wall
+            stats["cpu"] += cpu
+            stats["bytes"] += size or 0
+
+    def report(self):
+        """Stages sorted by wall time, with their share of the run, and the CPU time outside every stage"""
+        elapsed = self.elapsed if self.elapsed is not None else time.perf_counter() - self.started
+        cpu = self.cpu if self.cpu is not None else time.process_time() - self.cpu_started
+        with self.lock:
+            stages = sorted(self.stages.items(), key=lambda item: item[1]["wall"], reverse=True)
+        return {
+            "elapsed_seconds": round(elapsed, 3),
+            "cpu_seconds": round(cpu, 3),
+            "stages": {
+                name: {
+                    "calls": stats["calls"],
+                    "wall_seconds": round(stats["wall"], 3),
+                    "cpu_seconds": round(stats["cpu"], 3),
+                    "bytes": stats["bytes"],
+                    "wall_share": round(stats["wall"] / elapsed, 4) if elapsed else None,
+                }
+                for name, stats in stages
+            },
+            # 不属于任何阶段的 CPU 时间（分段、记忆库查找、JSON 解析等）
+            "other_cpu_seconds": round(max(0.0, cpu - sum(stats["cpu"] for _, stats in stages)), 3),
+        }
+
+    def write(self, base):
+        """Write <base>_profile.json and, when recorded, <base>_profile.pstats and <base>_trace.json"""
+        files = [base + "_profile.json"]
+        with open(files[0], "w", encoding="utf-8") as f:
+            json.dump(self.report(), f, ensure_ascii=False, indent=4)
+        if self.cprofile is not None:
+            files.append(base + "_profile.pstats")
+            self.cprofile.dump_stats(files[-1])
+        if self.events is not None:
+            files.append(base + "_trace.json")
+            with self.lock:
+                names = [{"name": "thread_name", "ph": "M", "pid": os.getpid(), "tid": ident,
+                          "args": {"name": name}} for ident, name in self.threads.items()]
+                events = names + self.events
+            # chrome://tracing 或 https://ui.perfetto.dev 可以打开
+            with open(files[-1], "w", encoding="utf-8") as f:
+                json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
+        return files
+
+
+class _ProfiledStream:
+    """sys.stdout/sys.stderr wrapper that times console output as the "console" stage"""
+
+    def __init__(self, stream, profiler):
+        self.stream = stream
+        self.profiler = profiler
+
+    def write(self, text):
+        with self.profiler.stage("console", text):
+            return self.stream.write(text)
+
+    def flush(self):
+        with self.profiler.stage("console", calls=0):
+            return self.stream.flush()
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+
+
+# 各处理阶段的耗时统计，--profile 时启用
+profiler = StageProfiler()
+
+
+# Ollama 报告的 load_duration 超过这个值（秒）时，认为请求遇到了模型冷启动
+COLD_START_SECONDS = 0.5
+
+
+class BackendPool:
+    """Pooled Ollama and OpenAI clients shared by every thread"""
+
+    def __init__(self, **options):
+        self.options = None
+        self.configure(**options)
+
+    def configure(self, ollama_host="", openai_base_url="", keep_alive="30m", num_ctx=0, pool_size=1):
+        options = dict(ollama_host=ollama_host, openai_base_url=openai_base_url, keep_alive=keep_alive,
+                       num_ctx=num_ctx, pool_size=pool_size)
+        if options == self.options:
+            # 配置不变时保留已建立的连接与已预热的模型
+            return
+        self.options = options
+        # 未设置时由 ollama 读取 $OLLAMA_HOST
+        self.ollama_host = ollama_host or None
+        self.openai_base_url = openai_base_url or os.getenv("OPENAI_BASE_URL", "https://api.fe8.cn/v1")
+        # 纯数字表示秒数（负数表示一直保持加载），否则是 "30m" 这样的时长
+        keep_alive = str(keep_alive).strip()
+        self.keep_alive = int(keep_alive) if re.fullmatch(r"-?\d+", keep_alive) else keep_alive or None
+        self.num_ctx = num_ctx
+        self.pool_size = max(1, pool_size)
+        self.lock = threading.Lock()
+        self.clients = {}
+        self.warmed = set()
+        # 每个连接（按底层网络流区分）已发送的请求数
+        self.connections = weakref.WeakKeyDictionary()
+        self.stats = {
+            backend: {"requests": 0, "connections": 0, "reused": 0, "max_requests_per_connection": 0,
+                      "cold_starts": 0, "load_seconds": 0.0, "warm_ups": 0, "warm_up_seconds": 0.0}
+            for backend in ("ollama", "openai")
+        }
+
+    def _client(self, key, factory):
+        with self.lock:
+            if key not in self.clients:
+                self.clients[key] = factory()
+            return self.clients[key]
+
+    def _http_options(self, backend):
+        """httpx options of a pooled client: connection limits and a hook counting connection reuse"""
+        import httpx
+
+        def hook(response):
+            self._count_connection(backend, response)
+        return {
+            "limits": httpx.Limits(max_connections=max(100, self.pool_size),
+                                   max_keepalive_connections=max(20, self.pool_size)),
+            "event_hooks": {"response": [hook]},
+        }
+
+    def _count_connection(self, backend, response):
+        stream = response.extensions.get("network_stream")
+        with self.lock:
+            stats = self.stats[backend]
+            stats["requests"] += 1
+            if stream is None:
+                return
+            count = self.connections.get(stream, 0) + 1
+            self.connections[stream] = count
+            if count == 1:
+                stats["connections"] += 1
+            else:
+                stats["reused"] += 1
+            stats["max_requests_per_connection"] = max(stats["max_requests_per_connection"], count)
+
+    def ollama_client(self):
+        import ollama
+        return self._client("ollama", lambda: ollama.Client(host=self.ollama_host, **self._http_options("ollama")))
+
+    def openai_client(self, api_key=None):
+        import openai
+        return self._client(("openai", api_key), lambda: openai.OpenAI(
+            api_key=api_key or os.getenv("OPENAI_API_KEY"),
+            base_url=self.openai_base_url,
+            http_client=openai.DefaultHttpxClient(**self._http_options("openai")),
+        ))
+
+    def ollama_options(self, kwargs):
+        """Add keep_alive and num_ctx to the arguments of an Ollama request"""
+        if self.keep_alive is not None:
+            kwargs.setdefault("keep_alive", self.keep_alive)
+        if self.num_ctx:
+            kwargs["options"] = {"num_ctx": self.num_ctx, **(kwargs.get("options") or {})}
+        return kwargs
+
+    def record_load(self, load_duration):
+        """Account the model load time Ollama reports for a request (in nanoseconds)"""
+        seconds = (load_duration or 0) / 1e9
+        with self.lock:
+            stats = self.stats["ollama"]
+            stats["load_seconds"] += seconds
+            if seconds >= COLD_START_SECONDS:
+                stats["cold_starts"] += 1
+
+    def warm_up(self, model):
+        """Load `model` into Ollama before the first request, once per model; False when it failed"""
+        with self.lock:
+            if model in self.warmed:
+                return True
+        started = time.perf_counter()
+        try:
+            # 空 prompt 只加载模型，不生成内容
+            with profiler.stage("llm_wait"):
+                self.ollama_client().generate(**self.ollama_options({"model": model, "prompt": ""}))
+        except Exception as e:
+            print(f"✗ ollama warm-up of {model} failed: {e}")
+            return False
+        with self.lock:
+            # 只记录成功的预热，失败的模型下一个文件再试
+            self.warmed.add(model)
+            self.stats["ollama"]["warm_ups"] += 1
+            self.stats["ollama"]["warm_up_seconds"] += time.perf_counter() - started
+        return True
+
+    def report(self):
+        """Per-backend requests, connections, reuse rate, cold starts and model load time"""
+        with self.lock:
+            return {
+                backend: dict(
+                    stats,
+                    reuse_rate=round(stats["reused"] / max(1, stats["requests"]), 4),
+                    load_seconds=round(stats["load_seconds"], 3),
+                    warm_up_seconds=round(stats["warm_up_seconds"], 3),
+                )
+                for backend, stats in self.stats.items()
+            }
+
+
+# 所有后端请求共用的连接池与 Ollama 模型加载设置
+backends = BackendPool()
+
+
+def ollama_generate(kind="translate", **kwargs):
+    """ollama.generate() with token and latency accounting"""
+    started = time.perf_counter()
     try:
-        # Intentar parsear directamente
-        return json.loads(text)
-    except json.JSONDecodeError:
+        with concurrency_control.slot("ollama", kwargs.get("model")), profiler.stage("llm_wait"):
+            response = backends.ollama_client().generate(**backends.ollama_options(kwargs))
+    except Exception:
+        usage_tracker.record("ollama", kwargs.get("model"), kind, started, failed=True)
+        raise
+    profiler.add_bytes("llm_wait", _field(response, "response") or "")
+    backends.record_load(_field(response, "load_duration"))
+    usage_tracker.record("ollama", kwargs.get("model"), kind, started,
+                         _field(response, "prompt_eval_count"), _field(response, "eval_count"))
+    return response
+
+
+def _estimate_request_tokens(messages):
+    # 请求前只能估算：prompt 的 token 数，再预留同样多的 completion
+    return 2 * sum(estimate_tokens(str(m.get("content", ""))) for m in messages)
+
+
+def openai_chat_completion(kind="translate", **kwargs):
+    """OpenAI chat.completions.create() with token and latency accounting.
+
+    The API key is chosen by key_scheduler; a key that gets a 429 is cooled down.
+    """
+    estimated = _estimate_request_tokens(kwargs.get("messages", []))
+    api_key = key_scheduler.acquire(estimated)
+    started = time.perf_counter()
+    try:
+        with concurrency_control.slot("openai", kwargs.get("model")), profiler.stage("llm_wait"):
+            response = get_openai_client(api_key).chat.completions.create(**kwargs)
+    except Exception as e:
+        # 请求失败，返还预留的 token
+        key_scheduler.settle(api_key, estimated, 0)
+        usage_tracker.record("openai", kwargs.get("model"), kind, started, failed=True)
+        if classify_error(e) == "rate_limited":
+            key_scheduler.cooldown(api_key, _retry_after(e))
+        raise
+    choices = _field(response, "choices") or []
+    profiler.add_bytes("llm_wait", _field(_field(choices[0], "message"), "content") or "" if choices else "")
+    usage = _field(response, "usage")
+    prompt_tokens, completion_tokens = _field(usage, "prompt_tokens"), _field(usage, "completion_tokens")
+    key_scheduler.settle(api_key, estimated, (prompt_tokens or 0) + (completion_tokens or 0))
+    usage_tracker.record("openai", kwargs.get("model"), kind, started, prompt_tokens, completion_tokens)
+    return response
+
+
+class MalformedOutputError(Exception):
+    """Output that cannot be the expected JSON (commentary, wrong key, invalid or truncated JSON) or that runs away"""
+
+
+# 流式请求统计：请求数、提前中止数与中止时已收到的字符数
+stream_stats = {"streams": 0, "aborted": 0, "aborted_chars": 0}
+_stream_stats_lock = threading.Lock()
+
+_JSON_ESCAPES = {'"': '"', '\\': '\\', '/': '/', 'b': '\b', 'f': '\f', 'n': '\n', 'r': '\r', 't': '\t'}
+_HEX4_RE = re.compile(r'[0-9a-fA-F]{4}')
+_JSON_KEY_RE = re.compile(r'\s*"((?:[^"\\]|\\.)*)"\s*:\s*')
+
+
+class StreamingJsonExtractor:
+    """Incremental parser for a streamed {"<key>": ...} completion.
+
+    feed() takes the chunks as they arrive. A leading <think> block and a
+    ``` fence are skipped; anything else before the opening brace, a different
+    first key, or more than ``max_chars`` characters raises
+    MalformedOutputError at once, so the request can be aborted. For a string
+    value the text is decoded as it arrives (``value``) and feed() returns True
+    once its closing quote has been seen; other values are only checked for
+    their key and parsed at the end.
+    """
+
+    def __init__(self, key, max_chars, string_value=True):
+        self.key = key
+        self.max_chars = max_chars
+        self.string_value = string_value
+        self.buffer = ""
+        self.start = None
+        self.position = None
+        self.value = ""
+        self.done = False
+
+    def fail(self, reason):
+        raise MalformedOutputError(f"{reason} after {len(self.buffer)} characters: {self.buffer[:80]!r}")
+
+    def _find_start(self):
+        """Offset just after the opening brace, or None while more text is needed"""
+        text = self.buffer.lstrip()
+        offset = len(self.buffer) - len(text)
+        for opening, closing in (("<think>", "</think>"), ("<thinking>", "</thinking>"), ("```", "\n")):
+            if len(text) < len(opening) and opening.startswith(text):
+                return None
+            if text.startswith(opening):
+                end = text.find(closing, len(opening))
+                if end == -1:
+                    return None
+                rest = text[end + len(closing):].lstrip()
+                offset += len(text) - len(rest)
+                text = rest
+        if not text:
+            return None
+        if text[0] != "{":
+            self.fail("text before the JSON object")
+        return offset + 1
+
+    def feed(self, chunk):
+        if self.done:
+            return True
+        self.buffer += chunk
+        if len(self.buffer) > self.max_chars:
+            self.fail("runaway output")
+        if self.start is None:
+            self.start = self._find_start()
+            if self.start is None:
+                return False
+        if self.position is None:
+            match = _JSON_KEY_RE.match(self.buffer, self.start)
+            if not match or match.end() == len(self.buffer):
+                # 键还没有收完整
+                remainder = self.buffer[self.start:].lstrip()
+                if remainder and remainder[0] != '"':
+                    self.fail("unexpected JSON")
+                return False
+            if json.loads(f'"{match.group(1)}"') != self.key:
+                self.fail(f"unexpected key {match.group(1)!r}")
+            if not self.string_value:
+                self.position = len(self.buffer)
+                return False
+            if self.buffer[match.end()] != '"':
+                self.fail("value is not a string")
+            self.position = match.end() + 1
+        if self.string_value:
+            self._decode()
+        return self.done
+
+    def _decode(self):
+        buffer, i = self.buffer, self.position
+        parts = []
+        while i < len(buffer):
+            char = buffer[i]
+            if char == '"':
+                self.done = True
+                i += 1
+                break
+            if char == "\\":
+                if i + 1 >= len(buffer):
+                    break
+                escape = buffer[i + 1]
+                if escape == "u":
+                    if i + 6 > len(buffer):
+                        break
+                    digits = buffer[i + 2:i + 6]
+                    if not _HEX4_RE.fullmatch(digits):
+                        self.fail("invalid \\u escape")
+                    parts.append(chr(int(digits, 16)))
+                    i += 6
+                    continue
+                parts.append(_JSON_ESCAPES.get(escape, escape))
+                i += 2
+                continue
+            parts.append(char)
+            i += 1
+        self.value += "".join(parts)
+        self.position = i
+
+    def result(self):
+        """The completion as JSON text, for the same parsing as a non-streamed response"""
+        if self.string_value:
+            if not self.done:
+                self.fail("truncated output")
+            # \uXXXX 代理对在逐字解码后需要重新组合
+            value = self.value.encode("utf-16", "surrogatepass").decode("utf-16")
+            return json.dumps({self.key: value}, ensure_ascii=False)
+        return self.buffer[self.start - 1:] if self.start is not None else self.buffer
+
+
+def _record_stream(extractor, aborted):
+    with _stream_stats_lock:
+        stream_stats["streams"] += 1
+        if aborted:
+            stream_stats["aborted"] += 1
+            stream_stats["aborted_chars"] += len(extractor.buffer)
+
+
+def ollama_generate_stream(extractor, kind="translate", **kwargs):
+    """Streaming ollama.generate(), fed to `extractor`; stops reading once it has the value.
+
+    Returns extractor.result(). Off-format or runaway output closes the
+    stream and raises MalformedOutputError.
+    """
+    started = time.perf_counter()
+    stream = backends.ollama_client().generate(stream=True, **backends.ollama_options(kwargs))
+    prompt_tokens = completion_tokens = None
+    aborted = True
+    try:
+        # 流在开始迭代时才发出请求
+        with concurrency_control.slot("ollama", kwargs.get("model")), profiler.stage("llm_wait"):
+            for chunk in stream:
+                if _field(chunk, "done"):
+                    prompt_tokens, completion_tokens = _field(chunk, "prompt_eval_count"), _field(chunk, "eval_count")
+                    backends.record_load(_field(chunk, "load_duration"))
+                if extractor.feed(_field(chunk, "response") or ""):
+                    break
+        aborted = False
+    finally:
+        # 关闭流，服务器停止生成
+        close = getattr(stream, "close", None)
+        if close:
+            close()
+        _record_stream(extractor, aborted)
+        profiler.add_bytes("llm_wait", extractor.buffer)
+        # 提前结束时服务器不返回用量，按已收到的文本估算
+        usage_tracker.record("ollama", kwargs.get("model"), kind, started,
+                             prompt_tokens or estimate_tokens(kwargs.get("prompt", "")),
+                             completion_tokens or estimate_tokens(extractor.buffer), failed=aborted)
+    return extractor.result()
+
+
+def openai_chat_completion_stream(extractor, kind="translate", **kwargs):
+    """Streaming chat.completions.create(), fed to `extractor`; see ollama_generate_stream()"""
+    estimated = _estimate_request_tokens(kwargs.get("messages", []))
+    api_key = key_scheduler.acquire(estimated)
+    started = time.perf_counter()
+    # 从发出请求到读完流都占用一个并发名额
+    with concurrency_control.slot("openai", kwargs.get("model")):
         try:
-            # Intentar extraer y parsear JSON
-            json_content = extraer_contenido_json(text)
-            return json.loads(json_content)
-        except json.JSONDecodeError:
-            # Si todo falla, devolver el texto original
-            return {fallback_key: text.strip()}
-        
-def remove_think_tag(text: str) -> str:
-    """Remover etiquetas de pensamiento si existen"""
-    if not text:
-        return ""
-    
-    # Remover patrones como <think>...</think>
-    text = re.sub(r'<think>.*?</think>', '', text, flags=re.DOTALL)
-    # Remover otros patrones similares
-    text = re.sub(r'<thinking>.*?</thinking>', '', text, flags=re.DOTALL)
-    return text.strip()
-
-# filepath: /Users/chunhaulai/Documents/workspace-personal/ebook-GPT-translator/text_translation.py
-def extraer_contenido_json(text: str) -> str:
-    """Extraer contenido JSON de la respuesta, eliminando delimitadores de bloque de código"""
-    if not text:
-        return "{}"
-    
-    # Limpiar el texto
-    text = text.strip()
-    # Eliminar delimitadores de bloque de código como ```json ... ```
-    text = re.sub(r"^```json\s*|^```|\s*```$", "", text, flags=re.MULTILINE).strip()
-    
-    # Buscar JSON entre llaves
-    json_match = re.search(r'\{.*\}', text, re.DOTALL)
-    if json_match:
-        json_content = json_match.group(0)
-        # Validar que sea JSON válido
+            with profiler.stage("llm_wait"):
+                stream = get_openai_client(api_key).chat.completions.create(
+                    stream=True, stream_options={"include_usage": True}, **kwargs
+                )
+        except Exception as e:
+            key_scheduler.settle(api_key, estimated, 0)
+            usage_tracker.record("openai", kwargs.get("model"), kind, started, failed=True)
+            if classify_error(e) == "rate_limited":
+                key_scheduler.cooldown(api_key, _retry_after(e))
+            raise
+        usage = None
+        aborted = True
         try:
-            json.loads(json_content)
-            return json_content
-        except json.JSONDecodeError:
-            pass
-    
-    # Si no se encuentra JSON válido, intentar crear uno
-    lines = text.split('\n')
-    content = ""
-    for line in lines:
-        line = line.strip()
-        if line and not line.startswith('{') and not line.startswith('}'):
-            content += line + " "
-    
-    if content.strip():
-        return json.dumps({"improved_text": content.strip()}, ensure_ascii=False)
-    
-    return "{}"
+            with profiler.stage("llm_wait", calls=0):
+                for chunk in stream:
+                    usage = _field(chunk, "usage") or usage
+                    choices = _field(chunk, "choices") or []
+                    delta = _field(_field(choices[0], "delta"), "content") if choices else None
+                    if delta and extractor.feed(delta):
+                        break
+            aborted = False
+        finally:
+            close = getattr(stream, "close", None)
+            if close:
+                close()
+            _record_stream(extractor, aborted)
+            profiler.add_bytes("llm_wait", extractor.buffer)
+            prompt_tokens = _field(usage, "prompt_tokens") or estimated // 2
+            completion_tokens = _field(usage, "completion_tokens") or estimate_tokens(extractor.buffer)
+            key_scheduler.settle(api_key, estimated, prompt_tokens + completion_tokens)
+            usage_tracker.record("openai", kwargs.get("model"), kind, started, prompt_tokens, completion_tokens,
+                                 failed=aborted)
+    return extractor.result()
+
+
+class BackendError(Exception):
+    """A backend call that failed after retries, was rejected as fatal, or hit an open circuit.
+
+    ``kind`` is one of "rate_limited", "timeout", "retryable", "fatal" or "unavailable".
+    """
+
+    def __init__(self, backend, kind, message):
+        super().__init__(f"{backend}: {kind}: {message}")
+        self.backend = backend
+        self.kind = kind
+
+
+def classify_error(error):
+    """Classify a backend exception as rate_limited, timeout, retryable or fatal"""
+    status = _field(error, "status_code")
+    if status is None:
+        status = _field(_field(error, "response"), "status_code")
+    name = type(error).__name__.lower()
+    if status == 429 or "ratelimit" in name:
+        return "rate_limited"
+    if status in (408, 504) or "timeout" in name or isinstance(error, TimeoutError):
+        return "timeout"
+    if isinstance(error, MalformedOutputError):
+        # 模型偶尔输出格式错误，重新生成通常就能得到正确的结果
+        return "retryable"
+    if isinstance(status, int):
+        # 5xx 是服务器的临时错误，4xx（除 408/429）重试也没用
+        return "retryable" if status >= 500 else "fatal"
+    if "connect" in name or isinstance(error, ConnectionError):
+        return "retryable"
+    if isinstance(error, (ValueError, TypeError, KeyError, AttributeError, NameError)):
+        return "fatal"
+    return "retryable"
+
+
+def _retry_after(error):
+    """Seconds from a Retry-After header, if the error carries one"""
+    headers = _field(_field(error, "response"), "headers")
+    try:
+        return float(headers.get("retry-after"))
+    except (AttributeError, TypeError, ValueError):
+        return None
+
+
+class CircuitBreaker:
+    """Per-backend circuit breaker.
+
+    After ``threshold`` consecutive failures the circuit opens and calls fail
+    immediately for ``reset_timeout`` seconds; then one trial call is let
+    through (half-open) and its outcome closes or re-opens the circuit.
+    """
+
+    def __init__(self, threshold=5, reset_timeout=30.0):
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self.trial_running = False
+        self.lock = threading.Lock()
+
+    def allow(self):
+        with self.lock:
+            if self.opened_at is None:
+                return True
+            if time.monotonic() - self.opened_at >= self.reset_timeout and not self.trial_running:
+                self.trial_running = True
+                return True
+            return False
+
+    def success(self):
+        with self.lock:
+            self.failures = 0
+            self.opened_at = None
+            self.trial_running = False
+
+    def release(self):
+        """End a half-open trial whose outcome says nothing about the backend"""
+        with self.lock:
+            self.trial_running = False
+
+    def failure(self):
+        with self.lock:
+            self.failures += 1
+            self.trial_running = False
+            if self.failures >= self.threshold:
+                self.opened_at = time.monotonic()
+
+    @property
+    def state(self):
+        with self.lock:
+            if self.opened_at is None:
+                return "closed"
+            return "half-open" if time.monotonic() - self.opened_at >= self.reset_timeout else "open"
+
+
+class ResiliencePolicy:
+    """Retries with jittered exponential backoff, circuit breakers and backend failover"""
+
+    def __init__(self, max_retries=4, backoff_base=1.0, backoff_max=60.0,
+                 breaker_threshold=5, breaker_reset=30.0, failover=()):
+        self.configure(max_retries, backoff_base, backoff_max, breaker_threshold, breaker_reset, failover)
+
+    def configure(self, max_retries=4, backoff_base=1.0, backoff_max=60.0,
+                  breaker_threshold=5, breaker_reset=30.0, failover=()):
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.breaker_threshold = breaker_threshold
+        self.breaker_reset = breaker_reset
+        # 主后端失败后依次尝试的后端，例如 ("openai",)
+        self.failover = tuple(failover)
+        self.breakers = {}
+        self.lock = threading.Lock()
+
+    def breaker(self, backend):
+        with self.lock:
+            if backend not in self.breakers:
+                self.breakers[backend] = CircuitBreaker(self.breaker_threshold, self.breaker_reset)
+            return self.breakers[backend]
+
+    def backoff(self, attempt, error=None):
+        # full jitter：在 [0, base * 2^attempt] 之间随机等待，限流时至少等待 Retry-After
+        delay = random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+        retry_after = _retry_after(error) if error is not None else None
+        return max(delay, retry_after or 0)
+
+    def call(self, backend, fn):
+        """Call fn(), retrying retryable errors; raise BackendError when it gives up"""
+        breaker = self.breaker(backend)
+        for attempt in range(self.max_retries + 1):
+            if not breaker.allow():
+                raise BackendError(backend, "unavailable", "circuit open")
+            try:
+                result = fn()
+            except Exception as e:
+                kind = classify_error(e)
+                if kind == "fatal":
+                    # 请求本身有问题，不算作后端故障；半开状态的试探请求也要结束
+                    breaker.release()
+                    raise BackendError(backend, kind, e) from e
+                if isinstance(e, MalformedOutputError):
+                    # 格式错误的输出要重试，但后端本身是正常的，不计入熔断
+                    breaker.release()
+                else:
+                    breaker.failure()
+                if attempt == self.max_retries:
+                    raise BackendError(backend, kind, e) from e
+                delay = self.backoff(attempt, e)
+                print(f"✗ {backend} {kind}: {e} → retry {attempt + 1}/{self.max_retries} in {delay:.1f}s")
+                with profiler.stage("retry_backoff"):
+                    time.sleep(delay)
+            else:
+                breaker.success()
+                return result
+
+    def call_backends(self, calls, prefer_openai=False):
+        """Try the backends in calls ({name: fn}) in failover order; return (result, backend)"""
+        order = ["openai", "ollama"] if prefer_openai else ["ollama"]
+        order += [b for b in self.failover if b not in order]
+        last_error = None
+        for backend in order:
+            if backend not in calls:
+                continue
+            if last_error is not None:
+                print(f"→ Failover a {backend} ({last_error})")
+            try:
+                return self.call(backend, calls[backend]), backend
+            except BackendError as e:
+                last_error = e
+        raise last_error
+
+
+# 所有后端调用共用的重试、熔断与故障转移策略
+resilience = ResiliencePolicy()
+
+
+class TokenBucket:
+    """Token bucket refilled continuously at rate_per_minute; a rate of 0 means unlimited"""
+
+    def __init__(self, rate_per_minute):
+        self.capacity = float(rate_per_minute)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    def refill(self, now):
+        if self.capacity > 0:
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.capacity / 60)
+        self.updated = now
+
+    def headroom(self):
+        """Fraction of the bucket currently available (1.0 when unlimited)"""
+        return 1.0 if self.capacity <= 0 else max(0.0, self.tokens / self.capacity)
+
+    def wait_time(self, amount):
+        """Seconds until amount can be taken"""
+        if self.capacity <= 0:
+            return 0.0
+        amount = min(amount, self.capacity)
+        return max(0.0, (amount - self.tokens) * 60 / self.capacity)
+
+    def take(self, amount):
+        if self.capacity > 0:
+            self.tokens -= amount
+
+
+class KeyScheduler:
+    """Routes OpenAI requests over several API keys within their RPM/TPM limits"""
+
+    def __init__(self, keys=(), rpm=0, tpm=0, cooldown=20.0):
+        self.configure(keys, rpm, tpm, cooldown)
+
+    def configure(self, keys=(), rpm=0, tpm=0, cooldown=20.0):
+        self.lock = threading.Lock()
+        self.default_cooldown = cooldown
+        self.keys = {}
+        for key in keys:
+            self.keys[key] = {
+                "requests": TokenBucket(rpm),
+                "tokens": TokenBucket(tpm),
+                "cooldown_until": 0.0,
+                "stats": {"requests": 0, "tokens": 0, "rate_limited": 0},
+            }
+        self.started = time.monotonic()
+        self.rpm, self.tpm = rpm, tpm
+
+    def acquire(self, tokens=0):
+        """Reserve one request and tokens on the best key; None when no keys are configured"""
+        if not self.keys:
+            return None
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                best, best_headroom, wait = None, -1.0, None
+                for key, state in self.keys.items():
+                    state["requests"].refill(now)
+                    state["tokens"].refill(now)
+                    key_wait = max(state["cooldown_until"] - now,
+                                   state["requests"].wait_time(1),
+                                   state["tokens"].wait_time(tokens))
+                    if key_wait > 0:
+                        wait = key_wait if wait is None else min(wait, key_wait)
+                        continue
+                    headroom = min(state["requests"].headroom(), state["tokens"].headroom())
+                    if headroom > best_headroom:
+                        best, best_headroom = key, headroom
+                if best is not None:
+                    state = self.keys[best]
+                    state["requests"].take(1)
+                    state["tokens"].take(tokens)
+                    state["stats"]["requests"] += 1
+                    return best
+            time.sleep(wait)
+
+    def settle(self, key, estimated, actual):
+        """Correct the token bucket once the real usage of a request is known"""
+        if key not in self.keys:
+            return
+        with self.lock:
+            state = self.keys[key]
+            state["tokens"].take(actual - estimated)
+            state["stats"]["tokens"] += actual
+
+    def cooldown(self, key, seconds=None):
+        if key not in self.keys:
+            return
+        with self.lock:
+            state = self.keys[key]
+            state["cooldown_until"] = time.monotonic() + (seconds or self.default_cooldown)
+            state["stats"]["rate_limited"] += 1
+
+    def utilisation(self):
+        """Per-key requests, tokens, 429s and share of the configured RPM/TPM used so far"""
+        with self.lock:
+            minutes = max(time.monotonic() - self.started, 1e-9) / 60
+            report = {}
+            for key, state in self.keys.items():
+                stats = state["stats"]
+                # 不在报告中暴露完整的 API key
+                report["…" + key[-4:]] = {
+                    **stats,
+                    "rpm_used": round(stats["requests"] / minutes / self.rpm, 3) if self.rpm else None,
+                    "tpm_used": round(stats["tokens"] / minutes / self.tpm, 3) if self.tpm else None,
+                }
+            return report
+
+
+# 多个 OpenAI API key 的调度器
+key_scheduler = KeyScheduler()
+
+
+class AdaptiveLimit:
+    """AIMD limit on the requests in flight to one backend and model"""
+
+    CUT = 0.5
+    TRIM = 0.75
+    LATENCY_TOLERANCE = 1.5
+
+    def __init__(self, initial=1, maximum=16, latency_target=0.0, error_target=0.1):
+        self.cond = threading.Condition()
+        self.maximum = max(1, maximum)
+        self.limit = float(max(1, min(initial, self.maximum)))
+        self.latency_target = latency_target
+        self.error_target = error_target
+        self.in_flight = 0
+        self.slow_start = True
+        self.last_cut = 0.0
+        self.latencies = []
+        self.errors = 0
+        self.baseline = None
+        self.stats = {"requests": 0, "increases": 0, "peak_limit": int(self.limit),
+                      "decreases": dict.fromkeys(("rate_limited", "timeout", "latency", "errors"), 0),
+                      "p95_ms": None, "target_ms": None}
+
+    @property
+    def current(self):
+        return int(self.limit)
+
+    def acquire(self):
+        """Wait for a free slot; returns the start time to pass to release()"""
+        with self.cond:
+            while self.in_flight >= self.current:
+                self.cond.wait()
+            self.in_flight += 1
+        return time.perf_counter()
+
+    def release(self, started, outcome):
+        """End a request. `outcome` is "ok", a classify_error() kind, or None when it says nothing about load"""
+        latency = time.perf_counter() - started
+        with self.cond:
+            self.in_flight -= 1
+            self.stats["requests"] += 1
+            if outcome is not None and started >= self.last_cut:
+                if outcome in ("rate_limited", "timeout"):
+                    self._cut(outcome, self.CUT)
+                else:
+                    if outcome == "ok":
+                        self.latencies.append(latency)
+                    else:
+                        self.errors += 1
+                    if len(self.latencies) + self.errors >= max(4, self.current):
+                        self._evaluate()
+            self.cond.notify_all()
+
+    def _evaluate(self):
+        samples = len(self.latencies) + self.errors
+        error_rate = self.errors / samples
+        p95 = _percentile(self.latencies, 95)
+        if p95 is not None and error_rate <= self.error_target:
+            self.baseline = p95 if self.baseline is None else min(self.baseline, p95)
+        target = self.latency_target or (self.LATENCY_TOLERANCE * self.baseline if self.baseline else None)
+        self.stats["p95_ms"] = round(p95 * 1000, 1) if p95 is not None else None
+        self.stats["target_ms"] = round(target * 1000, 1) if target else None
+        self.latencies, self.errors = [], 0
+        if error_rate > self.error_target:
+            self._cut("errors", self.TRIM)
+        elif p95 is not None and target and p95 > target:
+            self._cut("latency", self.TRIM)
+        elif self.limit < self.maximum:
+            self.limit = min(self.maximum, self.limit * 2 if self.slow_start else self.limit + 1)
+            self.stats["increases"] += 1
+            self.stats["peak_limit"] = max(self.stats["peak_limit"], self.current)
+
+    def _cut(self, reason, factor):
+        self.limit = max(1.0, self.limit * factor)
+        self.slow_start = False
+        self.last_cut = time.perf_counter()
+        self.latencies, self.errors = [], 0
+        self.stats["decreases"][reason] += 1
+
+    def report(self):
+        with self.cond:
+            return dict(self.stats, limit=self.current, maximum=self.maximum,
+                        decreases=dict(self.stats["decreases"]))
+
+
+class ConcurrencyController:
+    """Adaptive concurrency of the backend requests, with one AdaptiveLimit per backend and model"""
+
+    def __init__(self):
+        self.options = None
+        self.shared = None
+        self.configure()
+
+    @contextmanager
+    def share(self, size):
+        """Bound the requests of every Translator in the process (the books of a Library) to `size` at a time"""
+        previous = self.shared
+        self.shared = threading.BoundedSemaphore(max(1, size)) if size else None
+        try:
+            yield
+        finally:
+            self.shared = previous
+
+    def configure(self, enabled=False, initial=1, maximum=16, latency_target=0.0):
+        options = dict(enabled=enabled, initial=initial, maximum=maximum, latency_target=latency_target)
+        if options == self.options:
+            return
+        self.options = options
+        self.enabled = enabled
+        self.initial = max(1, initial)
+        self.maximum = max(self.initial, maximum)
+        self.latency_target = latency_target
+        self.lock = threading.Lock()
+        self.limits = {}
+
+    def limit(self, backend, model):
+        with self.lock:
+            key = f"{backend}/{model}"
+            if key not in self.limits:
+                self.limits[key] = AdaptiveLimit(self.initial, self.maximum, self.latency_target)
+            return self.limits[key]
+
+    def slot(self, backend, model):
+        """Context manager holding one request slot of backend/model while the request runs.
+
+        With share(), the slot also holds one of the process-wide request slots,
+        only for this attempt: retries, backoff and failover wait outside it.
+        """
+        shared = self.shared if self.shared is not None else nullcontext()
+        if not self.enabled:
+            return shared
+        return self._slot(shared, self.limit(backend, model))
+
+    @contextmanager
+    def _slot(self, shared, limit):
+        with shared:
+            started = limit.acquire()
+            outcome = "ok"
+            try:
+                yield
+            except MalformedOutputError:
+                # 格式错误的输出与后端负载无关
+                outcome = None
+                raise
+            except Exception as e:
+                outcome = classify_error(e)
+                if outcome == "fatal":
+                    outcome = None
+                raise
+            except BaseException:
+                outcome = None
+                raise
+            finally:
+                limit.release(started, outcome)
+
+    def describe(self):
+        """Current limit of each backend/model, for the progress bar"""
+        with self.lock:
+            limits = list(self.limits.items())
+        return ", ".join(f"{key} ×{limit.current}" for key, limit in limits)
+
+    def report(self):
+        with self.lock:
+            limits = list(self.limits.items())
+        return {key: limit.report() for key, limit in limits}
+
+
+# 各后端与模型的自适应并发上限
+concurrency_control = ConcurrencyController()
+
+# 结构化输出：要求后端按 JSON schema 生成，只能输出这个对象
+TRANSLATION_SCHEMA = {
+    "type": "object",
+    "properties": {"translation": {"type": "string"}},
+    "required": ["translation"],
+    "additionalProperties": False,
+}
+BATCH_TRANSLATION_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "translations": {
+            "type": "array",
+            "items": {
+                "type": "object",
+                "properties": {"id": {"type": "integer"}, "translation": {"type": "string"}},
+                "required": ["id", "translation"],
+                "additionalProperties": False,
+            },
+        },
+    },
+    "required": ["translations"],
+    "additionalProperties": False,
+}
+IMPROVED_TEXT_SCHEMA = {
+    "type": "object",
+    "properties": {"improved_text": {"type": "string"}},
+    "required": ["improved_text"],
+    "additionalProperties": False,
+}
+
+
+# 支持 json_schema response_format 的 OpenAI 模型前缀，其他模型退回 JSON mode
+OPENAI_JSON_SCHEMA_MODELS = ("gpt-4o", "gpt-4.1", "gpt-5", "o1", "o3", "o4")
+
+
+def structured_output(schema, name, openai_model=""):
+    """Request arguments constraining the output to `schema`: (Ollama kwargs, OpenAI kwargs)
+
+    OpenAI models without structured outputs (e.g. gpt-3.5-turbo) reject a
+    json_schema response_format, so they get JSON mode instead; the prompt
+    still describes the expected keys and the response is parsed the same way.
+    """
+    if openai_model.startswith(OPENAI_JSON_SCHEMA_MODELS) and openai_model not in ("o1-mini", "o1-preview"):
+        openai_format = {"type": "json_schema", "json_schema": {"name": name, "schema": schema, "strict": True}}
+    else:
+        openai_format = {"type": "json_object"}
+    return {"format": schema}, {"response_format": openai_format}
+
+
+# 响应解析统计：解析的响应数与格式错误的响应数
+parse_stats = {"responses": 0, "failures": 0}
+_parse_stats_lock = threading.Lock()
+
+_JSON_DECODER = json.JSONDecoder()
+_WHITESPACE_RE = re.compile(r"\s*")
+# JSON 之前允许出现的推理过程与代码块标记：(开始, 结束)
+_JSON_PREFIXES = (("<think>", "</think>"), ("<thinking>", "</thinking>"), ("```", "\n"))
+
+
+def _parse_json_response(text, key, value_type):
+    position = _WHITESPACE_RE.match(text).end()
+    for opening, closing in _JSON_PREFIXES:
+        if text.startswith(opening, position):
+            end = text.find(closing, position + len(opening))
+            if end == -1:
+                raise MalformedOutputError(f"unterminated {opening}: {text[:80]!r}")
+            position = _WHITESPACE_RE.match(text, end + len(closing)).end()
+    if not text.startswith("{", position):
+        raise MalformedOutputError(f"text before the JSON object: {text[position:position + 80]!r}")
+    try:
+        data, end = _JSON_DECODER.raw_decode(text, position)
+    except json.JSONDecodeError as e:
+        raise MalformedOutputError(f"invalid JSON ({e.msg} at {e.pos}): {text[:80]!r}") from None
+    rest = text[end:].strip()
+    # 只允许代码块的结束标记
+    if rest and rest != "```":
+        raise MalformedOutputError(f"text after the JSON object: {rest[:80]!r}")
+    if key not in data:
+        raise MalformedOutputError(f"missing key {key!r}: {text[:80]!r}")
+    if not isinstance(data[key], value_type):
+        raise MalformedOutputError(f"{key!r} is not a {value_type.__name__}: {text[:80]!r}")
+    return data[key]
+
+
+def parse_json_response(text, key, value_type=str):
+    """Value of `key` in a {"<key>": ...} completion, parsed in one pass.
+
+    A leading <think> block and a ``` fence are skipped. Anything else around
+    the object, invalid JSON, a missing key or a value of another type raises
+    MalformedOutputError, which is retried like a failed request, so a
+    malformed answer is never taken for the translation. Outcomes are counted
+    in parse_stats.
+    """
+    try:
+        value = _parse_json_response(text or "", key, value_type)
+    except MalformedOutputError:
+        with _parse_stats_lock:
+            parse_stats["responses"] += 1
+            parse_stats["failures"] += 1
+        raise
+    with _parse_stats_lock:
+        parse_stats["responses"] += 1
+    return value
 
 
 def concatenar_parrafos(texto):
@@ -126,7 +1362,8 @@ def complet_text_ollama(
     target_lang: str,
     model: str = "gpt-oss:120b-cloud",
     use_openai_api: bool = False,
-    openai_model: str = "gpt-3.5-turbo"
+    openai_model: str = "gpt-3.5-turbo",
+    structured: bool = False
 ) -> Dict:
     
     prompt = f"""
@@ -148,58 +1385,50 @@ def complet_text_ollama(
     請遵循這些規則，並按以下JSON格式返回優化結果： {{"improved_text": "優化後的文本內容"}}
     """
     
+    ollama_format, openai_format = structured_output(IMPROVED_TEXT_SCHEMA, "improved_text", openai_model) if structured else ({}, {})
+
     def try_ollama_local():
         """Función para usar Ollama local"""
-        response = ollama.generate(
+        response = ollama_generate(
+            kind="complete",
             model=model,
             prompt=prompt,
             system=system_message,
-            think=False
+            think=False,
+            **ollama_format
         )
-        return response['response'].strip()
+        return parse_json_response(response['response'], "improved_text")
     
     def try_openai_api():
         """Función para usar OpenAI API"""
-        response = openai_client.chat.completions.create(
+        response = openai_chat_completion(
+            kind="complete",
             model=openai_model,
             messages=[
                 {"role": "system", "content": system_message},
                 {"role": "user", "content": prompt}
             ],
-            temperature=0.7
+            temperature=0.7,
+            **openai_format
         )
-        return response.choices[0].message.content.strip()
+        return parse_json_response(response.choices[0].message.content, "improved_text")
     
     try:
-        # Intentar usar OpenAI API si está habilitado
-        if use_openai_api:
-            try:
-                translation_text = try_openai_api()
-            except Exception as openai_error:
-                print(f"✗ Error con OpenAI API: {openai_error}")
-                print("→ Fallback a Ollama local...")
-                translation_text = try_ollama_local()
-                print("✓ Ollama local utilizado como fallback")
-        else:
-            # Usar Ollama local directamente
-            translation_text = try_ollama_local()
-        
-        translation_text = remove_think_tag(translation_text)
-        
-        # Parse the JSON response de forma segura
-        translation_json = safe_json_parse(translation_text, "improved_text")
-        translation_result = translation_json.get("improved_text", translation_text)
+        # 按故障转移顺序调用后端，临时错误与格式错误的输出自动重试
+        translation_result, used_api = resilience.call_backends(
+            {"ollama": try_ollama_local, "openai": try_openai_api},
+            prefer_openai=use_openai_api
+        )
         
         return {
             "success": True,
             "source_text": text,
             "translation": translation_result,
-            "used_api": "openai" if use_openai_api else "ollama"
+            "used_api": used_api
         }
             
-    except Exception as e:
-        print(f"Error general: {str(e)}")
-        beep_forever()
+    except BackendError as e:
+        print(f"✗ {e}")
         return {
             "success": False,
             "error": str(e),
@@ -211,7 +1440,8 @@ def complet_text_ollama_simple(
     target_lang: str = "智利西班牙文",
     model: str = "gpt-oss:120b-cloud",
     use_openai_api: bool = False,
-    openai_model: str = "gpt-3.5-turbo"
+    openai_model: str = "gpt-3.5-turbo",
+    structured: bool = False
 ) -> str:
     
     prompt = f"""
@@ -230,51 +1460,43 @@ def complet_text_ollama_simple(
     請遵循這些規則，並按以下JSON格式返回優化結果： {{"improved_text": "修改後的文本內容"}}
     """
     
+    ollama_format, openai_format = structured_output(IMPROVED_TEXT_SCHEMA, "improved_text", openai_model) if structured else ({}, {})
+
     def try_ollama_local():
         """Función para usar Ollama local"""
-        response = ollama.generate(
+        response = ollama_generate(
+            kind="complete",
             model=model,
             prompt=prompt,
             system=system_message,
-            think=False
+            think=False,
+            **ollama_format
         )
-        return response['response'].strip()
+        return parse_json_response(response['response'], "improved_text")
     
     def try_openai_api():
         """Función para usar OpenAI API"""
-        response = openai_client.chat.completions.create(
+        response = openai_chat_completion(
+            kind="complete",
             model=openai_model,
             messages=[
                 {"role": "system", "content": system_message},
                 {"role": "user", "content": prompt}
             ],
-            temperature=0.7
+            temperature=0.7,
+            **openai_format
         )
-        return response.choices[0].message.content.strip()
+        return parse_json_response(response.choices[0].message.content, "improved_text")
     
     try:
-        # Intentar usar OpenAI API si está habilitado
-        if use_openai_api:
-            try:
-                translation_text = try_openai_api()
-            except Exception as openai_error:
-                print(f"✗ Error con OpenAI API: {openai_error}")
-                print("→ Fallback a Ollama local...")
-                translation_text = try_ollama_local()
-                print("✓ Ollama local utilizado como fallback")
-        else:
-            # Usar Ollama local directamente
-            translation_text = try_ollama_local()
-        
-        translation_text = remove_think_tag(translation_text)
-        
-        # Parse the JSON response de forma segura
-        translation_json = safe_json_parse(translation_text, "improved_text")
-        return translation_json.get("improved_text", translation_text)
+        improved_text, used_api = resilience.call_backends(
+            {"ollama": try_ollama_local, "openai": try_openai_api},
+            prefer_openai=use_openai_api
+        )
+        return improved_text
             
-    except Exception as e:
-        print(f"Error general: {str(e)}")
-        beep_forever()
+    except BackendError as e:
+        print(f"✗ {e}")
         return text   # Retornar el texto original en caso de error
 
 def translate_text_ollama(
@@ -283,7 +1505,9 @@ def translate_text_ollama(
     source_language: Optional[str] = None,
     model: str = "gpt-oss:120b-cloud",
     use_openai_api: bool = False,
-    openai_model: str = "gpt-3.5-turbo"
+    openai_model: str = "gpt-3.5-turbo",
+    stream: bool = False,
+    structured: bool = False
 ) -> Dict:
     
     prompt = f"""
@@ -302,6 +1526,7 @@ def translate_text_ollama(
         3. **專有名詞處理**：
         - 保留原文中人名、地名、城市名、政黨名、地區名、大學名、河流名等{source_language}專有名稱
         - 不翻譯專有名詞，直接使用原文形式
+        - 段落中的 <g1>…</g1>、<x2/> 等標記代表原文的格式，請原樣保留並放在譯文中對應的位置
 
         4. **輸出格式**：
         - 嚴格按照以下JSON格式輸出：{{"translation": "翻譯內容"}}
@@ -321,46 +1546,62 @@ def translate_text_ollama(
         ```
     """
     
+    # 流式输出的上限：译文远长于原文时视为失控
+    max_chars = 4 * len(text) + 400
+    ollama_format, openai_format = structured_output(TRANSLATION_SCHEMA, "translation", openai_model) if structured else ({}, {})
+
     def try_ollama_local():
         """Función para usar Ollama local"""
-        response = ollama.generate(
-            model=model,
-            prompt=prompt,
-            think=False
-        )
-        return response['response'].strip()
+        if stream:
+            response_text = ollama_generate_stream(
+                StreamingJsonExtractor("translation", max_chars),
+                kind="translate",
+                model=model,
+                prompt=prompt,
+                think=False,
+                **ollama_format
+            )
+        else:
+            response_text = ollama_generate(
+                kind="translate",
+                model=model,
+                prompt=prompt,
+                think=False,
+                **ollama_format
+            )['response']
+        # 格式错误的输出抛出 MalformedOutputError 并重试，不会被当作译文
+        return parse_json_response(response_text, "translation")
     
     def try_openai_api():
         """Función para usar OpenAI API"""
-        response = openai_client.chat.completions.create(
-            model=openai_model,
-            messages=[
-                {"role": "system", "content": system_message},
-                {"role": "user", "content": prompt}
-            ],
-            temperature=0.7
-        )
-        return response.choices[0].message.content.strip()
+        if stream:
+            response_text = openai_chat_completion_stream(
+                StreamingJsonExtractor("translation", max_chars),
+                kind="translate",
+                model=openai_model,
+                messages=[
+                    {"role": "user", "content": prompt}
+                ],
+                temperature=0.7,
+                **openai_format
+            )
+        else:
+            response_text = openai_chat_completion(
+                kind="translate",
+                model=openai_model,
+                messages=[
+                    {"role": "user", "content": prompt}
+                ],
+                temperature=0.7,
+                **openai_format
+            ).choices[0].message.content
+        return parse_json_response(response_text, "translation")
     
     try:
-        # Intentar usar OpenAI API si está habilitado
-        if use_openai_api:
-            try:
-                translation_text = try_openai_api()
-            except Exception as openai_error:
-                print(f"✗ Error con OpenAI API: {openai_error}")
-                print("→ Fallback a Ollama local...")
-                translation_text = try_ollama_local()
-                print("✓ Ollama local utilizado como fallback")
-        else:
-            # Usar Ollama local directamente
-            translation_text = try_ollama_local()
-        
-        translation_text = remove_think_tag(translation_text)
-        
-        # Parse the JSON response de forma segura
-        translation_json = safe_json_parse(translation_text, "translation")
-        translation_result = translation_json.get("translation", translation_text)
+        translation_result, used_api = resilience.call_backends(
+            {"ollama": try_ollama_local, "openai": try_openai_api},
+            prefer_openai=use_openai_api
+        )
         
         return {
             "success": True,
@@ -368,11 +1609,11 @@ def translate_text_ollama(
             "target_language": target_language,
             "source_language": source_language,
             "translation": translation_result,
-            "used_api": "openai" if use_openai_api else "ollama"
+            "used_api": used_api
         }
             
-    except Exception as e:
-        beep_forever()
+    except BackendError as e:
+        print(f"✗ {e}")
         return {
             "success": False,
             "error": str(e),
@@ -381,7 +1622,151 @@ def translate_text_ollama(
             "source_language": source_language
         }
 
+def translate_batch_ollama(
+    texts: List[str],
+    target_language: str,
+    source_language: Optional[str] = None,
+    model: str = "gpt-oss:120b-cloud",
+    use_openai_api: bool = False,
+    openai_model: str = "gpt-3.5-turbo",
+    stream: bool = False,
+    structured: bool = False
+) -> Dict:
+    """Translate several numbered segments in one request.
+
+    The model must answer with one item per input segment, in the same order;
+    otherwise the result is marked as misaligned (success False).
+    """
+
+    segments_json = json.dumps(
+        [{"id": i, "text": t} for i, t in enumerate(texts, 1)],
+        ensure_ascii=False, indent=1
+    )
+    prompt = f"""
+        請將我提供的{source_language}段落翻譯成{target_language}。
+
+        【翻譯要求】
+        1. **僅輸出翻譯內容**：不要添加任何額外評論、解釋或分析
+        2. **翻譯原則**：
+        - 使用多樣化的句式結構，巧妙融入日常俚語與成語俗語
+        - 保持翻譯既正式又不失親切感
+        - 段落間的邏輯過渡要自然流暢
+        - 語言風格符合目標讀者群體的習慣與期待
+        - 避免生硬的術語堆砌或機械式重複
+        - 讓翻譯讀起來像是與讀者進行真誠對話
+
+        3. **專有名詞處理**：
+        - 保留原文中人名、地名、城市名、政黨名、地區名、大學名、河流名等{source_language}專有名稱
+        - 不翻譯專有名詞，直接使用原文形式
+        - 段落中的 <g1>…</g1>、<x2/> 等標記代表原文的格式，請原樣保留並放在譯文中對應的位置
+
+        4. **輸出格式**：
+        - 輸入是一個包含 {len(texts)} 個段落的JSON陣列，每個段落都有編號 id
+        - 每個段落單獨翻譯，不要合併或拆分段落，順序與編號必須與輸入一致
+        - 嚴格按照以下JSON格式輸出：{{"translations": [{{"id": 1, "translation": "翻譯內容"}}, ...]}}
+        - JSON必須使用雙引號
+        - **不要輸出JSON以外的任何文字**
+
+        請將以下的段落翻譯成{target_language}
+        ```
+        {segments_json}
+        ```
+    """
+
+    # 流式输出的上限：译文远长于原文时视为失控
+    max_chars = 4 * len(segments_json) + 400
+    ollama_format, openai_format = (
+        structured_output(BATCH_TRANSLATION_SCHEMA, "translations", openai_model) if structured else ({}, {})
+    )
+
+    def try_ollama_local():
+        """Función para usar Ollama local"""
+        if stream:
+            response_text = ollama_generate_stream(
+                StreamingJsonExtractor("translations", max_chars, string_value=False),
+                kind="translate_batch",
+                model=model,
+                prompt=prompt,
+                think=False,
+                **ollama_format
+            )
+        else:
+            response_text = ollama_generate(
+                kind="translate_batch",
+                model=model,
+                prompt=prompt,
+                think=False,
+                **ollama_format
+            )['response']
+        return parse_json_response(response_text, "translations", list)
+
+    def try_openai_api():
+        """Función para usar OpenAI API"""
+        if stream:
+            response_text = openai_chat_completion_stream(
+                StreamingJsonExtractor("translations", max_chars, string_value=False),
+                kind="translate_batch",
+                model=openai_model,
+                messages=[
+                    {"role": "user", "content": prompt}
+                ],
+                temperature=0.7,
+                **openai_format
+            )
+        else:
+            response_text = openai_chat_completion(
+                kind="translate_batch",
+                model=openai_model,
+                messages=[
+                    {"role": "user", "content": prompt}
+                ],
+                temperature=0.7,
+                **openai_format
+            ).choices[0].message.content
+        return parse_json_response(response_text, "translations", list)
+
+    try:
+        items, used_api = resilience.call_backends(
+            {"ollama": try_ollama_local, "openai": try_openai_api},
+            prefer_openai=use_openai_api
+        )
+
+        # 检查返回的数量与顺序是否与输入一致
+        aligned = (
+            len(items) == len(texts)
+            and all(isinstance(item, dict) and item.get("id") == i and isinstance(item.get("translation"), str)
+                    for i, item in enumerate(items, 1))
+        )
+        if not aligned:
+            return {
+                "success": False,
+                "misaligned": True,
+                "error": "misaligned batch response",
+                "source_texts": texts,
+            }
+
+        return {
+            "success": True,
+            "source_texts": texts,
+            "target_language": target_language,
+            "source_language": source_language,
+            "translations": [item["translation"] for item in items],
+            "used_api": used_api
+        }
+
+    except BackendError as e:
+        print(f"✗ {e}")
+        return {
+            "success": False,
+            "error": str(e),
+            "source_texts": texts,
+        }
+
+
 def get_docx_title(docx_filename):
+    import zipfile
+    from lxml import etree
+
     with zipfile.ZipFile(docx_filename) as zf:
         core_properties = etree.fromstring(zf.read("docProps/core.xml"))
 
@@ -400,31 +1785,33 @@ def get_docx_title(docx_filename):
 
 def get_pdf_title(pdf_filename):
     try:
-        with open(pdf_filename, 'rb') as file:
-            parser = PDFParser(file)
-            document = PDFDocument(parser)
-            if 'Title' in document.info:
-                return document.info['Title']
-            else:
-                text = pdfminer.high_level.extract_text(file)
-                match = re.search(r'(?<=\n)([^]+)(?=\n)', text)
-                if match:
-                    return match.group(1)
-                else:
-                    return "Unknown title"
-    except:
+        index = pdf_index(pdf_filename)
+        if index["title"]:
+            return index["title"]
+        # 元数据中没有标题时，只提取第一页，使用其第一行
+        for _, text in _iter_pdf_page_texts(pdf_filename, [1], refs=index["page_refs"]):
+            for line in text.splitlines():
+                if line.strip():
+                    return line.strip()
+        return "Unknown title"
+    except Exception:
         return "Unknown title"
 
 
 def get_mobi_title(mobi_filename):
+    import mobi
+
     try:
         metadata = mobi.read_metadata(mobi_filename)
         title = metadata.get("Title", None)
-    except:
+    except Exception:
         return "Unknown title"
 
 
 def convert_mobi_to_text(mobi_filename):
+    import mobi
+    from bs4 import BeautifulSoup
+
     # Extract MOBI contents to a temporary directory
     with tempfile.TemporaryDirectory() as tempdir:
         tempdir, filepath = mobi.extract(mobi_filename)
@@ -443,13 +1830,16 @@ def convert_mobi_to_text(mobi_filename):
 
         # Parse the HTML file with BeautifulSoup to get the text
         with open(html_file, "r", encoding="utf-8") as f:
-            soup = BeautifulSoup(f.read(), "html.parser")
-            text = soup.get_text()
+            content = f.read()
+        with profiler.stage("html_parse", content):
+            text = BeautifulSoup(content, "html.parser").get_text()
 
     return text
 
 
 def get_epub_title(epub_filename):
+    from ebooklib import epub
+
     try:
         book = epub.read_epub(epub_filename)
         metadata = book.get_metadata('DC', {})
@@ -458,96 +1848,12 @@ def get_epub_title(epub_filename):
                 return metadata['title'][0]
         else:
             return "Unknown title"
-    except:
+    except Exception:
         return "Unknown title"
 
-    # 读取option文件
-
-
-import chardet
-
-with open('settings.cfg', 'rb') as f:
-    content = f.read()
-    encoding = chardet.detect(content)['encoding']
-
-with open('settings.cfg', encoding=encoding) as f:
-    config_text = f.read()
-    config = configparser.ConfigParser()
-    config.read_string(config_text)
-
-# 获取openai_apikey和language
-openai_apikey = config.get('option', 'openai-apikey')
-# language_name = config.get('option', 'target-language')
-prompt = config.get('option', 'prompt')
-bilingual_output = config.get('option', 'bilingual-output')
-language_code = config.get('option', 'langcode')
-api_proxy=config.get('option', 'openai-proxy')
-# Get startpage and endpage as integers with default values
-startpage = config.getint('option', 'startpage', fallback=1)
-endpage = config.getint('option', 'endpage', fallback=-1)
-# 设置译名表文件路径
-transliteration_list_file = config.get('option', 'transliteration-list')
-# 译名表替换是否开启大小写匹配？
-case_matching = config.get('option', 'case-matching')
-
-# 设置openai的API密钥
-openai.api_key = openai_apikey
-
-# 将openai的API密钥分割成数组
-key_array = openai_apikey.split(',')
-
-def random_api_key():
-    return random.choice(key_array)
-
-def create_chat_completion(prompt, text, model="gpt-3.5-turbo", **kwargs):
-    openai.api_key = random_api_key()
-    return openai.ChatCompletion.create(
-        model=model,
-        messages=[
-            {
-                "role": "user",
-                "content": f"{prompt}: \n{text}",
-            }
-        ],
-        **kwargs
-    )
-
-import argparse
-
-
-
-# 创建参数解析器
-parser = argparse.ArgumentParser()
-parser.add_argument("filename", help="Name of the input file")
-parser.add_argument("--test", help="Only translate the first 3 short texts", action="store_true")
-# 是否使用译名表？
-parser.add_argument("--tlist", help="Use the translated name table", action="store_true")
-args = parser.parse_args()
-
-# 获取命令行参数
-filename = args.filename
-base_filename, file_extension = os.path.splitext(filename)
-new_filename = base_filename + "_translated.epub"
-new_filenametxt = base_filename + "_translated.txt"
-jsonfile = base_filename + "_process.json"
-sentences_json_file = base_filename + "_sentences.json"
-# 从文件中加载已经翻译的文本
-translated_dict = {}
-try:
-    with open(jsonfile, "r", encoding="utf-8") as f:
-        translated_dict = json.load(f)
-except FileNotFoundError:
-    pass
-# 从文件中加载已经分割的句子
-sentences_dict = {}
-try:
-    with open(sentences_json_file, "r", encoding="utf-8") as f:
-        sentences_dict = json.load(f)
-except FileNotFoundError:
-    pass
-
-
 def convert_docx_to_text(docx_filename):
+    import docx
+
     doc = docx.Document(docx_filename)
 
     text = ""
@@ -558,6 +1864,10 @@ def convert_docx_to_text(docx_filename):
 
 
 def convert_epub_to_text(epub_filename):
+    import ebooklib
+    from ebooklib import epub
+    from bs4 import BeautifulSoup
+
     # 打开epub文件
     book = epub.read_epub(epub_filename)
 
@@ -573,367 +1883,2499 @@ def convert_epub_to_text(epub_filename):
     return text
 
 
-def text_to_epub(text, filename, language_code='en', title="Title"):
-    text = text.replace("\n", "<br>")
-    # 创建epub书籍对象
-    book = epub.EpubBook()
+_CONTAINER_NS = "urn:oasis:names:tc:opendocument:xmlns:container"
+_OPF_NS = "http://www.idpf.org/2007/opf"
+# 新建的 EPUB 每个章节文件包含的段落数
+EPUB_CHAPTER_PARAGRAPHS = 200
+
+
+class _StagedEpub:
+    """Finished chapters are staged as files in <epub>.parts/ and zipped by close().
+
+    Only one chapter is held in memory at a time, and the chapters finished so
+    far are already on disk while the translation is running.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.parts_dir = filename + ".parts"
+        os.makedirs(self.parts_dir, exist_ok=True)
+
+    def _part_path(self, name):
+        path = os.path.abspath(os.path.join(self.parts_dir, *name.split("/")))
+        root = os.path.abspath(self.parts_dir)
+        try:
+            inside = path != root and os.path.commonpath((root, path)) == root
+        except ValueError:
+            inside = False
+        if not inside:
+            # 含 ../、绝对路径或盘符的条目名不能写到 <epub>.parts/ 之外，改用摘要作为文件名
+            path = os.path.join(root, ".unsafe", hashlib.sha1(name.encode("utf-8")).hexdigest())
+        return path
+
+    def stage(self, name, content):
+        """Write the finished document `name` (its path inside the zip)"""
+        path = self._part_path(name)
+        with profiler.stage("output", content):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path + ".tmp", "wb") as f:
+                f.write(content)
+            os.replace(path + ".tmp", path)
+
+    def staged(self, name):
+        return os.path.exists(self._part_path(name))
+
+    def _assemble(self, entries):
+        """Zip the (name, bytes or staged part) entries; the mimetype must come first and uncompressed"""
+        with profiler.stage("output"), zipfile.ZipFile(self.filename + ".tmp", "w", zipfile.ZIP_DEFLATED) as zf:
+            zf.writestr(zipfile.ZipInfo("mimetype"), "application/epub+zip", compress_type=zipfile.ZIP_STORED)
+            for name, content in entries:
+                if content is None:
+                    zf.write(self._part_path(name), name)
+                else:
+                    zf.writestr(name, content)
+        os.replace(self.filename + ".tmp", self.filename)
+        shutil.rmtree(self.parts_dir, ignore_errors=True)
+
+
+class EpubRewriter(_StagedEpub):
+    """Copy of an EPUB in which translated documents replace the originals.
+
+    Everything else (OPF, TOC, styles, images, fonts) is copied as is.
+    """
+
+    def __init__(self, source, filename):
+        from lxml import etree
+
+        super().__init__(filename)
+        self.source = zipfile.ZipFile(source)
+        self.lock = threading.Lock()
+        container = etree.fromstring(self.source.read("META-INF/container.xml"))
+        opf_path = container.find(f".//{{{_CONTAINER_NS}}}rootfile").get("full-path")
+        opf_dir = posixpath.dirname(opf_path)
+        opf = etree.fromstring(self.source.read(opf_path))
+        # 所有（X）HTML 文档（含导航文档），按 manifest 顺序
+        self.documents = [
+            posixpath.normpath(posixpath.join(opf_dir, unquote(item.get("href"))))
+            for item in opf.iter(f"{{{_OPF_NS}}}item")
+            if item.get("media-type") == "application/xhtml+xml"
+        ]
 
-    # 设置元数据
-    book.set_identifier(str(random.randint(100000, 999999)))
-    book.set_title(title)
-    book.set_language(language_code)
+    def read(self, name):
+        with profiler.stage("document_load"), self.lock:
+            content = self.source.read(name)
+        profiler.add_bytes("document_load", content)
+        return content
 
-    # 创建章节对象
-    c = epub.EpubHtml(title='Chapter 1', file_name='chap_1.xhtml', lang=language_code)
-    c.content = text
+    def close(self):
+        names = [info.filename for info in self.source.infolist() if info.filename != "mimetype"]
+        # 逐个条目复制，内存中只保留一个文件
+        self._assemble((name, None if self.staged(name) else self.read(name)) for name in names)
+        self.source.close()
 
-    # 将章节添加到书籍中
-    book.add_item(c)
 
-    # 添加toc
-    book.toc = (epub.Link('chap_1.xhtml', 'Chapter 1', 'chap_1'),)
-    # 设置书脊顺序
-    book.spine = ['nav', c]
-    # 添加导航
-    book.add_item(epub.EpubNcx())
-    book.add_item(epub.EpubNav())
+class EpubBookWriter(_StagedEpub):
+    """New EPUB built from a stream of text; every EPUB_CHAPTER_PARAGRAPHS paragraphs become a chapter"""
 
-    # 设置书籍封面
-    # book.set_cover('image.jpg', open('image.jpg', 'rb').read())
+    def __init__(self, filename, title="Title", language_code="en"):
+        super().__init__(filename)
+        self.title = title
+        self.language_code = language_code
+        self.paragraphs = []
+        self.chapters = 0
 
-    # 将书籍写入文件
-    epub.write_epub(filename, book, {})
+    def write(self, text):
+        self.paragraphs.extend(line for line in text.split("\n") if line.strip())
+        if len(self.paragraphs) >= EPUB_CHAPTER_PARAGRAPHS:
+            self.flush()
+
+    def flush(self):
+        if not self.paragraphs:
+            return
+        self.chapters += 1
+        body = "\n".join(f"<p>{html.escape(p, quote=False)}</p>" for p in self.paragraphs)
+        self.stage(f"EPUB/chap_{self.chapters}.xhtml", (
+            '<?xml version="1.0" encoding="utf-8"?>\n'
+            f'<html xmlns="http://www.w3.org/1999/xhtml" lang="{self.language_code}">'
+            f'<head><title>Chapter {self.chapters}</title></head>\n<body>\n{body}\n</body></html>\n'
+        ).encode("utf-8"))
+        self.paragraphs = []
+
+    def close(self):
+        self.flush()
+        title = xml_escape(self.title)
+        chapters = range(1, self.chapters + 1)
+        container = (
+            '<?xml version="1.0" encoding="utf-8"?>\n'
+            f'<container version="1.0" xmlns="{_CONTAINER_NS}"><rootfiles>'
+            '<rootfile full-path="EPUB/content.opf" media-type="application/oebps-package+xml"/>'
+            '</rootfiles></container>\n'
+        )
+        manifest = "".join(f'<item id="chap_{n}" href="chap_{n}.xhtml" media-type="application/xhtml+xml"/>'
+                           for n in chapters)
+        opf = (
+            '<?xml version="1.0" encoding="utf-8"?>\n'
+            f'<package xmlns="{_OPF_NS}" version="3.0" unique-identifier="id">'
+            '<metadata xmlns:dc="http://purl.org/dc/elements/1.1/">'
+            f'<dc:identifier id="id">{random.randint(100000, 999999)}</dc:identifier>'
+            f'<dc:title>{title}</dc:title><dc:language>{self.language_code}</dc:language>'
+            f'<meta property="dcterms:modified">{time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime())}</meta>'
+            '</metadata><manifest>'
+            '<item id="ncx" href="toc.ncx" media-type="application/x-dtbncx+xml"/>'
+            '<item id="nav" href="nav.xhtml" media-type="application/xhtml+xml" properties="nav"/>'
+            f'{manifest}</manifest><spine toc="ncx"><itemref idref="nav"/>'
+            + "".join(f'<itemref idref="chap_{n}"/>' for n in chapters)
+            + '</spine></package>\n'
+        )
+        ncx = (
+            '<?xml version="1.0" encoding="utf-8"?>\n'
+            '<ncx xmlns="http://www.daisy.org/z3986/2005/ncx/" version="2005-1">'
+            f'<head/><docTitle><text>{title}</text></docTitle><navMap>'
+            + "".join(f'<navPoint id="chap_{n}"><navLabel><text>Chapter {n}</text></navLabel>'
+                      f'<content src="chap_{n}.xhtml"/></navPoint>' for n in chapters)
+            + '</navMap></ncx>\n'
+        )
+        nav = (
+            '<?xml version="1.0" encoding="utf-8"?>\n'
+            '<html xmlns="http://www.w3.org/1999/xhtml" xmlns:epub="http://www.idpf.org/2007/ops">'
+            f'<head><title>{title}</title></head><body><nav epub:type="toc"><ol>'
+            + "".join(f'<li><a href="chap_{n}.xhtml">Chapter {n}</a></li>' for n in chapters)
+            + '</ol></nav></body></html>\n'
+        )
+        self._assemble(
+            [("META-INF/container.xml", container), ("EPUB/content.opf", opf),
+             ("EPUB/toc.ncx", ncx), ("EPUB/nav.xhtml", nav)]
+            + [(f"EPUB/chap_{n}.xhtml", None) for n in chapters]
+        )
+
+
+def text_to_epub(text, filename, language_code='en', title="Title"):
+    writer = EpubBookWriter(filename, title, language_code)
+    writer.write(text)
+    writer.close()
 
 
 # 将PDF文件转换为文本
 # For PDF files
 def get_total_pages(pdf_filename):
+    return pdf_index(pdf_filename)["pages"]
+
+
+# 已建立的 PDF 索引，按 (路径, 修改时间, 大小) 缓存在内存中
+_pdf_index_cache = {}
+
+
+def _pdf_string(value):
+    from pdfminer.pdftypes import resolve1
+    from pdfminer.utils import decode_text
+
+    value = resolve1(value)
+    if isinstance(value, bytes):
+        value = decode_text(value)
+    return value.strip() if isinstance(value, str) else None
+
+
+def pdf_index(pdf_filename, cache=None):
+    """Page count, metadata title, outline and page object ids of a PDF, built in one pass.
+
+    The index is kept in memory per file version and, when `cache` (a
+    dict-like such as TranslationMemory) is given, stored there under the
+    file hash so later runs do not parse the document at all.
+    """
+    from pdfminer.pdfdocument import PDFDocument, PDFNoOutlines
+    from pdfminer.pdfparser import PDFParser
+    from pdfminer.pdfpage import PDFPage
+    from pdfminer.pdftypes import resolve1
+
+    stat = os.stat(pdf_filename)
+    memo_key = (os.path.abspath(pdf_filename), stat.st_mtime_ns, stat.st_size)
+    if memo_key in _pdf_index_cache:
+        return _pdf_index_cache[memo_key]
+    sha256 = file_sha256(pdf_filename)
+    index = cache.get(sha256) if cache is not None else None
+
+    if index is None:
+        with open(pdf_filename, 'rb') as file:
+            document = PDFDocument(PDFParser(file))
+            page_refs = [page.pageid for page in PDFPage.create_pages(document)]
+            page_numbers = {objid: n for n, objid in enumerate(page_refs, 1)}
+            title = None
+            for info in document.info:
+                title = title or _pdf_string(info.get('Title'))
+
+            # 目录：(层级, 标题, 页码)，无法解析目标页时页码为 None
+            outline = []
+            try:
+                for level, entry_title, dest, action, _ in document.get_outlines():
+                    if dest is None and action is not None:
+                        dest = resolve1(action).get('D')
+                    dest = resolve1(dest)
+                    if isinstance(dest, (bytes, str)):
+                        try:
+                            dest = resolve1(document.get_dest(dest))
+                        except Exception:
+                            dest = None
+                    if isinstance(dest, dict):
+                        dest = resolve1(dest.get('D'))
+                    page = None
+                    if isinstance(dest, list) and dest:
+                        page = page_numbers.get(getattr(dest[0], 'objid', None))
+                    outline.append({"level": level, "title": _pdf_string(entry_title) or "", "page": page})
+            except PDFNoOutlines:
+                pass
+            except Exception:
+                # 目录损坏不影响翻译
+                pass
+        index = {"sha256": sha256, "pages": len(page_refs), "title": title,
+                 "outline": outline, "page_refs": page_refs}
+        if cache is not None:
+            cache[sha256] = index
+
+    _pdf_index_cache[memo_key] = index
+    return index
+
+
+def _load_pdf_page(document, objid):
+    """PDFPage for a page object id, with the attributes inherited from the page tree"""
+    from pdfminer.pdfpage import PDFPage
+    from pdfminer.pdftypes import dict_value
+
+    attrs = dict_value(document.getobj(objid)).copy()
+    parent = attrs.get('Parent')
+    while parent is not None:
+        node = dict_value(parent)
+        for key in PDFPage.INHERITABLE_ATTRS:
+            if key not in attrs and key in node:
+                attrs[key] = node[key]
+        parent = node.get('Parent')
+    try:
+        return PDFPage(document, objid, attrs)
+    except TypeError:
+        # 新版 pdfminer.six 需要页面标签参数
+        return PDFPage(document, objid, attrs, None)
+
+
+def convert_pdf_to_text(pdf_filename, start_page=1, end_page=-1, workers=1, cache=None):
+    return "".join(iter_pdf_pages(pdf_filename, start_page, end_page, workers, cache))
+
+
+def file_sha256(path):
+    """SHA-256 of a file, read in 1 MB blocks"""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def _iter_pdf_page_texts(pdf_filename, page_numbers, laparams=None, refs=None):
+    """Yield (page_number, text) for the given 1-based pages, parsing one page at a time.
+
+    With the page object ids of pdf_index() (`refs`), the pages are loaded
+    directly instead of walking the page tree from the start.
+    """
+    from pdfminer.pdfinterp import PDFResourceManager, PDFPageInterpreter
+    from pdfminer.converter import TextConverter
+    from pdfminer.layout import LAParams
+    from pdfminer.pdfdocument import PDFDocument
+    from pdfminer.pdfparser import PDFParser
+    from pdfminer.pdfpage import PDFPage
+
+    wanted = {n - 1 for n in page_numbers}
+    remaining = len(wanted)
+    if not remaining:
+        return
     with open(pdf_filename, 'rb') as file:
-        parser = PDFParser(file)
-        document = PDFDocument(parser)
-        return len(list(PDFPage.create_pages(document)))
+        rsrcmgr = PDFResourceManager()
+        params = LAParams(**(laparams or {}))
+        document = PDFDocument(PDFParser(file))
+        if refs:
+            pages = ((n - 1, _load_pdf_page(document, refs[n - 1])) for n in page_numbers if n <= len(refs))
+        else:
+            pages = enumerate(PDFPage.create_pages(document))
+        for index, page in pages:
+            if index not in wanted:
+                continue
+            output = StringIO()
+            device = TextConverter(rsrcmgr, output, laparams=params)
+            PDFPageInterpreter(rsrcmgr, device).process_page(page)
+            device.close()
+            yield index + 1, output.getvalue()
+            remaining -= 1
+            if not remaining:
+                break
 
 
-def convert_pdf_to_text(pdf_filename, start_page=1, end_page=-1):
-    if end_page == -1:
-        end_page = get_total_pages(pdf_filename)
-        # print("Total pages of the file:"+ str(end_page))
-        # print("Converting PDF from:"+ str(start_page)+" to "+ str(end_page) + " page")
-        text = pdfminer.high_level.extract_text(pdf_filename, page_numbers=list(range(start_page - 1, end_page)))
+def _extract_pdf_pages(pdf_filename, page_numbers, laparams=None, refs=None):
+    # 在工作进程中运行，返回 {页码: 文本}
+    return dict(_iter_pdf_page_texts(pdf_filename, page_numbers, laparams, refs))
+
+
+def iter_pdf_pages(pdf_filename, start_page=1, end_page=-1, workers=1, cache=None, laparams=None, index=None):
+    """Yield the text of each page from start_page to end_page, in order.
+
+    With workers > 1 the layout analysis is shared out to a process pool in
+    small contiguous shards. Pages found in `cache` (a dict-like such as
+    TranslationMemory, keyed by file hash, LAParams and page number) are not
+    extracted again, and extracted pages are added to it. The page range and
+    the page objects come from pdf_index() (or the given `index`).
+    """
+    from pdfminer.layout import LAParams
+
+    index = index or pdf_index(pdf_filename)
+    refs = index["page_refs"]
+    if end_page == -1 or end_page > index["pages"]:
+        end_page = index["pages"]
+    page_numbers = list(range(start_page, end_page + 1))
+    if cache is not None:
+        # 缓存键：文件哈希 + LAParams + 页码
+        params = json.dumps(vars(LAParams(**(laparams or {}))), sort_keys=True, default=str)
+        prefix = f"{index['sha256']}:{hashlib.sha1(params.encode('utf-8')).hexdigest()[:12]}:"
+        cached = {n: cache.get(prefix + str(n)) for n in page_numbers}
+        missing = [n for n in page_numbers if cached[n] is None]
     else:
-        # print("Converting PDF from:"+ str(start_page)+" to "+ str(end_page) + " page")
-        text = pdfminer.high_level.extract_text(pdf_filename, page_numbers=list(range(start_page - 1, end_page)))
-    return text
+        cached, missing = {}, page_numbers
+
+    executor = None
+    if workers <= 1 or len(missing) <= 1:
+        shards = ({n: text} for n, text in _iter_pdf_page_texts(pdf_filename, missing, laparams, refs))
+    else:
+        # 每个进程处理一小段连续的页面，executor.map 按顺序返回
+        size = max(1, min(16, -(-len(missing) // (workers * 4))))
+        chunks = [missing[i:i + size] for i in range(0, len(missing), size)]
+        executor = ProcessPoolExecutor(max_workers=workers)
+        shards = executor.map(_extract_pdf_pages, [pdf_filename] * len(chunks), chunks,
+                              [laparams] * len(chunks), [refs] * len(chunks))
 
-import ollama
+    extracted = {}
+    try:
+        for n in page_numbers:
+            text = cached.get(n)
+            if text is None:
+                while n not in extracted:
+                    # workers > 1 时这里只是等待工作进程
+                    with profiler.stage("pdf_extract"):
+                        shard = next(shards, None)
+                    if shard is None:
+                        # end_page 超出了文件的页数
+                        return
+                    extracted.update(shard)
+                text = extracted.pop(n)
+                profiler.add_bytes("pdf_extract", text)
+                if cache is not None:
+                    cache[prefix + str(n)] = text
+            yield text
+    finally:
+        if executor is not None:
+            executor.shutdown(cancel_futures=True)
 
-import ollama
 
-def split_text_into_sentences(text):
-    
-    if text in sentences_dict:
-        return sentences_dict[text]
-    
-    if True:
-        return [text]
-    
-    paragraphs = text.split('\n')
-    sentences = []
-    
-    for paragraph in paragraphs:
-        if not paragraph.strip():
-            continue
-            
-        try:
-            response = ollama.generate(
-                model='gpt-oss:120b-cloud',
-                #prompt=f"Divide este texto en oraciones completas y válidas según su significado, y sepáralas con '|' sin modificar el contenido original.\n--------------------------\n{paragraph}",   
-                prompt=f"Divide this text into valid complete sentences and then separate them by '|' without modifying the original content:\n--------------------------\n{paragraph}",
-                #prompt=f"請根據語意將以下段落劃分為有效且完整的小段落，並以「|」作為分隔符號，且不修改原始內容，也不必生成其他的解釋：\n--------------------------\n{paragraph}",
-                think=False
+class TranslationMemory:
+    """Persistent segment store backed by SQLite in WAL mode.
+
+    Behaves like a dict (``in``, ``[]``, ``get``) but writes a single row per
+    segment instead of rewriting a whole JSON checkpoint, so the cost of each
+    write does not grow with the size of the book.
+    """
+
+    def __init__(self, db_path, table="translations"):
+        self.table = table
+        self.lock = threading.Lock()
+        # 多本书共用一个数据库时，写入可能需要等待其他连接
+        self.conn = sqlite3.connect(db_path, timeout=60, check_same_thread=False, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute(f"CREATE TABLE IF NOT EXISTS {table} (source TEXT PRIMARY KEY, value TEXT NOT NULL)")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS imports (path TEXT, tbl TEXT, mtime REAL, PRIMARY KEY (path, tbl))")
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def __getitem__(self, key):
+        value = self.get(key)
+        if value is None:
+            raise KeyError(key)
+        return value
+
+    @staticmethod
+    def _dump(value):
+        text = json.dumps(value, ensure_ascii=False)
+        profiler.add_bytes("checkpoint", text)
+        return text
+
+    @staticmethod
+    def _load(text):
+        profiler.add_bytes("checkpoint", text)
+        return json.loads(text)
+
+    def __setitem__(self, key, value):
+        with profiler.stage("checkpoint"), self.lock:
+            self.conn.execute(
+                f"INSERT OR REPLACE INTO {self.table} (source, value) VALUES (?, ?)",
+                (key, self._dump(value)),
             )
-        except Exception as e:
-            print(f"Error in split_text_into_sentences: {e}")
-            beep_forever()
-        
-        split_sentences = response['response'].strip().split('|')
-        for sentence in split_sentences:
-            if sentence.strip():
-                sentences.append(sentence.strip())
-    
-    sentences_dict[text] = sentences
-    with open(sentences_json_file, "w", encoding="utf-8") as f:
-        json.dump(sentences_dict, f, ensure_ascii=False, indent=4)
-        
-    return sentences
 
-def split_text(text):
-    
-    #sentence_list = re.findall(r'.+?[。！？!?.]', text)
-    sentence_list = [s.strip() for s in text.split('\n') if s.strip()]
-    #sentence_list = split_text_into_sentences(text)
-    # 初始化短文本列表
-    short_text_list = []
-    # 初始化当前短文本
-    short_text = ""
-    # 遍历句子列表
-    for s in sentence_list:
-        short_text_list.append(s)
-    # 将最后的短文本加入短文本列表
-    short_text_list.append(short_text)
-    return short_text_list
+    def __len__(self):
+        with self.lock:
+            return self.conn.execute(f"SELECT COUNT(*) FROM {self.table}").fetchone()[0]
 
+    def get(self, key, default=None):
+        with profiler.stage("checkpoint"):
+            with self.lock:
+                row = self.conn.execute(f"SELECT value FROM {self.table} WHERE source = ?", (key,)).fetchone()
+            return self._load(row[0]) if row else default
 
-# 将句号替换为句号+回车
-def return_text(text):
-        # Verifica si text es un diccionario
-    if isinstance(text, dict):
-        # Si tiene la clave 'translation', se toma su valor
-        text = text.get('translation', '')
-    if isinstance(text, list):
-        text = ''.join(text)
-        
-    # Realiza los reemplazos como tenías definidos
-    text = text.replace(". ", ".\n")
-    text = text.replace("。", "。\n")
-    text = text.replace("！", "！\n")
-    return text
+    def items(self):
+        with profiler.stage("checkpoint"):
+            with self.lock:
+                rows = self.conn.execute(f"SELECT source, value FROM {self.table}").fetchall()
+            return [(key, self._load(value)) for key, value in rows]
 
+    def update(self, pairs, replace=True):
+        """Write many entries in one transaction; with replace=False existing entries are kept"""
+        verb = "INSERT OR REPLACE" if replace else "INSERT OR IGNORE"
+        with profiler.stage("checkpoint"), self.lock:
+            self.conn.execute("BEGIN")
+            self.conn.executemany(
+                f"{verb} INTO {self.table} (source, value) VALUES (?, ?)",
+                ((k, self._dump(v)) for k, v in pairs),
+            )
+            self.conn.execute("COMMIT")
 
-# Initialize a count variable of tokens cost.
-cost_tokens = 0
+    def import_json(self, json_path):
+        """One-time import of an old ``_process.json``/``_sentences.json`` checkpoint"""
+        if not os.path.exists(json_path):
+            return 0
+        mtime = os.path.getmtime(json_path)
+        with self.lock:
+            row = self.conn.execute("SELECT mtime FROM imports WHERE path = ? AND tbl = ?",
+                                    (os.path.abspath(json_path), self.table)).fetchone()
+        if row and row[0] >= mtime:
+            return 0
+        with open(json_path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+        with self.lock:
+            # 已存在的条目以数据库为准
+            self.conn.execute("BEGIN")
+            self.conn.executemany(
+                f"INSERT OR IGNORE INTO {self.table} (source, value) VALUES (?, ?)",
+                ((k, json.dumps(v, ensure_ascii=False)) for k, v in data.items()),
+            )
+            self.conn.execute("INSERT OR REPLACE INTO imports (path, tbl, mtime) VALUES (?, ?, ?)",
+                              (os.path.abspath(json_path), self.table, mtime))
+            self.conn.execute("COMMIT")
+        return len(data)
 
+    def backfilled(self, source_table):
+        """Whether this table was already filled from `source_table` (recorded in the imports table)"""
+        with self.lock:
+            row = self.conn.execute("SELECT 1 FROM imports WHERE path = ? AND tbl = ?",
+                                    (source_table, self.table)).fetchone()
+        return row is not None
 
-# 翻译短文本
-def translate_text(text):
-    if (text ==  ""):
-        return text
-    result = translate_text_ollama(
-        text,
-        "繁體中文",
-        "英文",
-        "deepseek-v3.1:671b-cloud"
-    )
+    def mark_backfilled(self, source_table):
+        with self.lock:
+            self.conn.execute("INSERT OR REPLACE INTO imports (path, tbl, mtime) VALUES (?, ?, ?)",
+                              (source_table, self.table, time.time()))
 
+    def close(self):
+        with self.lock:
+            self.conn.close()
 
-    
-    if(result["success"] == True):
-        source = result["translation"]
-        # result = translate_text_ollama(
-        #     text,
-            
-        #     "智利智利變體西班牙文變體",
-        #     "智利變體西班牙文",
-        #     "gpt-oss:120b-cloud"
-        # )
-        # if(result["success"] == True):
-        #     source = source + "\n" + result["translation"]
-        return source
-    else: 
-        return ""
 
+# 弯引号统一为直引号
+_QUOTE_TABLE = str.maketrans({"“": '"', "”": '"', "„": '"', "«": '"', "»": '"', "‘": "'", "’": "'", "‚": "'"})
+_NUMBER_RE = re.compile(r"\d+")
+# MinHash 的分词：中日韩文字逐字，其他按单词
+_SHINGLE_TOKEN_RE = re.compile(r"[\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uac00-\ud7af\uf900-\ufaff]|\w+")
+_MERSENNE_PRIME = (1 << 61) - 1
 
-def translate_and_store(text):
-    # 如果文本已经翻译过，直接返回翻译结果
-    if text in translated_dict:
-        return translated_dict[text]
 
-    # 否则，调用 translate_text 函数进行翻译，并将结果存储在字典中
-    translated_text = translate_text(text)
-    #print("\033[37m" + translated_text + "\033[0m")
-    #translated_text = complet_text_ollama_simple(concatenar_parrafos(return_text(translated_text)) )
-    translated_dict[text] = translated_text
+def normalize_segment(text):
+    """Lookup form of a segment: NFKC (full/half-width), straight quotes, collapsed whitespace, numbers masked"""
+    text = unicodedata.normalize("NFKC", text).translate(_QUOTE_TABLE)
+    return _NUMBER_RE.sub("#", " ".join(text.split()))
 
-    # 将字典保存为 JSON 文件
-    with open(jsonfile, "w", encoding="utf-8") as f:
-        json.dump(translated_dict, f, ensure_ascii=False, indent=4)
 
-    return translated_text
+def segment_key(text):
+    """Hashed key of the normalised segment"""
+    return hashlib.sha1(normalize_segment(text).encode("utf-8")).hexdigest()
 
 
-def text_replace(long_string, xlsx_path, case_sensitive):
-    # 读取excel文件，将第一列和第二列分别存为两个列表
-    df = pd.read_excel(xlsx_path)
-    old_words = df.iloc[:, 0].tolist()
-    new_words = df.iloc[:, 1].tolist()
-    # 对旧词列表按照长度降序排序，并同步调整新词列表
-    old_words, new_words = zip(*sorted(zip(old_words, new_words), key=lambda x: len(x[0]), reverse=True))
-    # 遍历两个列表，对字符串进行替换
-    for i in range(len(old_words)):
-        # 如果不区分大小写，就将字符串和被替换词都转为小写
-        if not case_sensitive:
-            lower_string = long_string.lower()
-            lower_old_word = old_words[i].lower()
-            # 使用正则表达式进行替换，注意要保留原字符串的大小写
-            long_string = re.sub(r"\b" + lower_old_word + r"\b", new_words[i], long_string, flags=re.IGNORECASE)
-        # 如果区分大小写，就直接使用正则表达式进行替换
-        else:
-            long_string = re.sub(r"\b" + old_words[i] + r"\b", new_words[i], long_string)
-    # 返回替换后的字符串
-    return long_string
-
-
-text = ""
-
-# 根据文件类型调用相应的函数
-if filename.endswith('.pdf'):
-    print("Converting PDF to text")
-    title = get_pdf_title(filename)
-    with tqdm(total=10, desc="Converting PDF to text") as pbar:
-        for i in range(10):
-            text = convert_pdf_to_text(filename, startpage, endpage)
-            pbar.update(1)
-elif filename.endswith('.epub'):
-    print("Converting epub to text")
-    book = epub.read_epub(filename)
-elif filename.endswith('.txt'):
-
-    with open(filename, 'r', encoding='utf-8') as file:
-        text = file.read()
-
-    title = os.path.basename(filename)
-elif filename.endswith('.docx'):
-    print("Converting DOCX file to text")
-    title = get_docx_title(filename)
-    with tqdm(total=10, desc="Converting DOCX to text") as pbar:
-        for i in range(10):
-            text = convert_docx_to_text(filename)
-            pbar.update(1)
-
-elif filename.endswith('.mobi'):
-    print("Converting MOBI file to text")
-    title = get_mobi_title(filename)
-    with tqdm(total=10, desc="Converting MOBI to text") as pbar:
-        for i in range(10):
-            text = convert_mobi_to_text(filename)
-            pbar.update(1)
-else:
-    print("Unsupported file type")
-
-if filename.endswith('.epub'):
-    # 获取所有章节
-    items = book.get_items()
-
-    # 遍历所有章节
-    translated_all = ''
-    count = 0
-    for item in tqdm(items):
-        # 如果章节类型为文档类型，则需要翻译
-        if item.get_type() == ebooklib.ITEM_DOCUMENT:
-            # 使用BeautifulSoup提取原文本
-            soup = BeautifulSoup(item.get_content(), 'html.parser')
-            text = soup.get_text().strip()
-            img_html = ''
-            img_tags = soup.find_all('img')
-            for img_tag in img_tags:
-                img_html += str(img_tag) + '<br>'
-            # 如果原文本为空，则跳过
-            if not text:
-                continue
-            # 将所有回车替换为空格
-            #text = text.replace("\n", " ")
+def adapt_numbers(source, translation, text):
+    """Reuse the translation of `source` for `text`, which may only differ in its numbers.
 
-            # 将多个空格替换为一个空格
-            import re
-            #text = re.sub(r"\s+", " ", text)
-            text = re.sub(r"[ ]{2,}", " ", text)
+    The numbers are substituted when the translation contains exactly the
+    numbers of its source in the same order; otherwise None is returned.
+    """
+    old = [int(n) for n in _NUMBER_RE.findall(source)]
+    new = _NUMBER_RE.findall(text)
+    if old == [int(n) for n in new]:
+        return translation
+    if len(old) != len(new) or [int(n) for n in _NUMBER_RE.findall(translation)] != old:
+        return None
+    numbers = iter(new)
+    return _NUMBER_RE.sub(lambda m: next(numbers), translation)
 
-            # 如果设置了译名表替换，则对文本进行翻译前的替换
-            if args.tlist:
-                text = text_replace(text, transliteration_list_file, case_matching)
-
-            # 将文本分成不大于1024字符的短文本list
-            short_text_list = split_text(text)
-            if args.test:
-                short_text_list = short_text_list[:3]
-
-            # 初始化翻译后的文本
-            translated_text = ""
-
-            # 遍历短文本列表，依次翻译每个短文本
-            for short_textOriginal in tqdm(short_text_list):
-                sentence_list = split_text_into_sentences(short_textOriginal)                            
-                for short_text in tqdm(sentence_list):
-                    #print(return_text(short_text))
-                    count += 1
-                    # 翻译当前短文本
-                    print("\033[34m" + short_text + "\033[0m")
-                    
-                    translated_short_text = translate_and_store(return_text(short_text))
-                    short_text = return_text(short_text)
-                    # Imprimir short_text en azul
-                    
 
-                    # Imprimir translated_short_text en verde
-                    print("\033[32m" + translated_short_text + "\033[0m")
+class MinHashIndex:
+    """MinHash/LSH index of source segments for near-duplicate lookup.
 
-                    # 将当前短文本和翻译后的文本加入总文本中
-                    if bilingual_output.lower() == 'true':
-                        translated_text += f"{short_text}<br>\n<span style='color: blue;'>{translated_short_text}</span><br>\n"
-                    else:
-                        translated_text += f"<span style='color: blue;'>{translated_short_text}</span><br>\n"
+    Segments are shingled into token bigrams; signatures of ``num_perm``
+    hashes are split into ``bands`` LSH buckets, and candidates sharing a
+    bucket are accepted when their estimated Jaccard similarity reaches
+    ``threshold``.
+    """
 
-                    # print(short_text)
-                # 使用翻译后的文本替换原有的章节内容
-                item.set_content((img_html + translated_text.replace('\n', '<br>')).encode('utf-8'))
-                translated_all += translated_text
-                if args.test and count >= 3:
-                    break
+    def __init__(self, threshold, num_perm=64, bands=16):
+        self.threshold = threshold
+        self.num_perm = num_perm
+        self.bands = bands
+        self.rows = num_perm // bands
+        rng = random.Random(1)
+        self.permutations = [(rng.randrange(1, _MERSENNE_PRIME), rng.randrange(_MERSENNE_PRIME))
+                             for _ in range(num_perm)]
+        self.buckets = {}
+        self.signatures = {}
 
-    # 将epub书籍写入文件
-    epub.write_epub(new_filename, book, {})
-    # 将翻译后的文本同时写入txt文件 in case epub插件出问题
-    with open(new_filenametxt, "w", encoding="utf-8") as f:
-        f.write(translated_all)
-
-else:
-    # 将所有回车替换为空格
-    text = text.replace("\n", " ")
-
-    # 将多个空格替换为一个空格
-    import re
-
-    text = re.sub(r"\s+", " ", text)
-
-    # 如果设置了译名表替换，则对文本进行翻译前的替换
-    if args.tlist:
-        text = text_replace(text, transliteration_list_file, case_matching)
-
-    # 将文本分成不大于1024字符的短文本list
-    short_text_list = split_text(text)
-    if args.test:
-        short_text_list = short_text_list[:3]
-    # 初始化翻译后的文本
-    translated_text = ""
-
-    # 遍历短文本列表，依次翻译每个短文本
-    for short_text in tqdm(short_text_list):
-        print(return_text(short_text))
-        # 翻译当前短文本
-        translated_short_text = translate_and_store(short_text)
-        short_text = return_text(short_text)
-        translated_short_text = return_text(translated_short_text)
-        # 将当前短文本和翻译后的文本加入总文本中
-        if bilingual_output.lower() == 'true':
-            translated_text += f"{short_text}\n{translated_short_text}\n"
-        else:
-            translated_text += f"{translated_short_text}\n"
-        # print(short_text)
-        print(translated_short_text)
-
-    # 将翻译后的文本写入epub文件
-    with tqdm(total=10, desc="Writing translated text to epub") as pbar:
-        text_to_epub(translated_text.replace('\n', '<br>'), new_filename, language_code, title)
-        pbar.update(1)
-
-    # 将翻译后的文本同时写入txt文件 in case epub插件出问题
-    with open(new_filenametxt, "w", encoding="utf-8") as f:
-        f.write(translated_text)
-cost = cost_tokens / 1000 * 0.002
-print(f"Translation completed. Total cost: {cost_tokens} tokens, ${cost}.")
-
-try:
-    #os.remove(jsonfile)
-    print(f"File '{jsonfile}' has been deleted.")
-except FileNotFoundError:
-    print(f"File '{jsonfile}' not found. No file was deleted.")
+    def signature(self, text):
+        tokens = _SHINGLE_TOKEN_RE.findall(normalize_segment(text).casefold())
+        shingles = {" ".join(tokens[i:i + 2]) for i in range(max(1, len(tokens) - 1))}
+        hashes = [zlib.crc32(shingle.encode("utf-8")) for shingle in shingles]
+        return [min((a * h + b) % _MERSENNE_PRIME for h in hashes) for a, b in self.permutations]
+
+    def _bands(self, signature):
+        for band in range(self.bands):
+            yield band, tuple(signature[band * self.rows:(band + 1) * self.rows])
+
+    def add(self, key, signature):
+        if key in self.signatures:
+            return
+        self.signatures[key] = signature
+        for band in self._bands(signature):
+            self.buckets.setdefault(band, []).append(key)
+
+    def query(self, signature):
+        """Return (key, similarity) of the closest indexed segment above the threshold, or (None, 0)"""
+        best, best_similarity = None, 0.0
+        seen = set()
+        for band in self._bands(signature):
+            for key in self.buckets.get(band, ()):
+                if key in seen:
+                    continue
+                seen.add(key)
+                other = self.signatures[key]
+                similarity = sum(1 for x, y in zip(signature, other) if x == y) / self.num_perm
+                if similarity > best_similarity:
+                    best, best_similarity = key, similarity
+        if best_similarity < self.threshold:
+            return None, 0.0
+        return best, best_similarity
+
+
+def read_settings(path='settings.cfg'):
+    """Read settings.cfg (any encoding) into a dict of options"""
+    import chardet
+
+    # 读取option文件
+    with open(path, 'rb') as f:
+        content = f.read()
+        encoding = chardet.detect(content)['encoding']
+
+    with open(path, encoding=encoding) as f:
+        config_text = f.read()
+        config = configparser.ConfigParser()
+        config.read_string(config_text)
+
+    # 每个翻译请求的原文 token 上限可按模型单独设置，例如 "gpt-oss:120b-cloud=2000, llama3=600"
+    segment_tokens_per_model = {}
+    for entry in config.get('option', 'segment-tokens-per-model', fallback="").split(','):
+        if '=' in entry:
+            model_name, budget = entry.rsplit('=', 1)
+            segment_tokens_per_model[model_name.strip()] = int(budget)
+
+    return {
+        # 获取openai_apikey和language
+        "openai_apikey": config.get('option', 'openai-apikey', fallback=""),
+        # "language_name": config.get('option', 'target-language'),
+        "prompt": config.get('option', 'prompt', fallback=""),
+        "bilingual_output": config.get('option', 'bilingual-output', fallback="True"),
+        "language_code": config.get('option', 'langcode', fallback="zh"),
+        "api_proxy": config.get('option', 'openai-proxy', fallback=""),
+        # Get startpage and endpage as integers with default values
+        "startpage": config.getint('option', 'startpage', fallback=1),
+        "endpage": config.getint('option', 'endpage', fallback=-1),
+        # 设置译名表文件路径
+        "transliteration_list_file": config.get('option', 'transliteration-list', fallback=""),
+        # 译名表替换是否开启大小写匹配？
+        "case_matching": config.get('option', 'case-matching', fallback="True"),
+        # 同时翻译的段落数量
+        "concurrency": config.getint('option', 'concurrency', fallback=1),
+        # 按延迟、限流与超时自动调整同时进行的请求数（AIMD），concurrency 为初始值，max-concurrency 为上限
+        "adaptive_concurrency": config.get('option', 'adaptive-concurrency', fallback="False"),
+        "max_concurrency": config.getint('option', 'max-concurrency', fallback=16),
+        # 自适应并发的 p95 延迟目标（秒），0 表示空载延迟的 1.5 倍
+        "latency_target": config.getfloat('option', 'latency-target', fallback=0.0),
+        # 翻译使用的模型
+        "translation_model": config.get('option', 'model', fallback="deepseek-v3.1:671b-cloud"),
+        # 使用 OpenAI 后端（failover）时的模型
+        "openai_model": config.get('option', 'openai-model', fallback="gpt-3.5-turbo"),
+        # 每个请求包含的段落数量，1 表示每个段落单独请求
+        "batch_size": config.getint('option', 'batch-size', fallback=1),
+        # EPUB 同时翻译的章节数量
+        "chapter_concurrency": config.getint('option', 'chapter-concurrency', fallback=1),
+        # 提取 PDF 文本的进程数量
+        "pdf_workers": config.getint('option', 'pdf-workers', fallback=1),
+        # 流式接收模型输出，格式错误或失控时提前中止
+        "stream": config.get('option', 'stream', fallback="False"),
+        # 翻译前在本地识别无需翻译的段落（页码、网址、已是目标语言等），直接输出
+        "pre_filter": config.get('option', 'pre-filter', fallback="True"),
+        # 要求后端按 JSON schema 输出（Ollama format / OpenAI response_format）
+        "structured_output": config.get('option', 'structured-output', fallback="True"),
+        # --library 模式下同时翻译的书籍数量
+        "book_concurrency": config.getint('option', 'book-concurrency', fallback=2),
+        # 每个翻译请求的原文 token 上限
+        "segment_tokens": config.getint('option', 'segment-tokens', fallback=800),
+        "segment_tokens_per_model": segment_tokens_per_model,
+        # Ollama 服务器地址（空则使用 $OLLAMA_HOST），模型在两次请求之间保持加载的时间与上下文长度
+        "ollama_host": config.get('option', 'ollama-host', fallback=""),
+        "keep_alive": config.get('option', 'keep-alive', fallback="30m"),
+        "num_ctx": config.getint('option', 'num-ctx', fallback=0),
+        # 翻译第一个章节前先加载模型
+        "warm_up": config.get('option', 'warm-up', fallback="True"),
+        # 每 1000 个 token 的费用，用于统计报告
+        "cost_per_1k_tokens": config.getfloat('option', 'cost-per-1k-tokens', fallback=0.002),
+        # 临时错误的重试次数与指数退避参数（秒）
+        "max_retries": config.getint('option', 'max-retries', fallback=4),
+        "backoff_base": config.getfloat('option', 'backoff-base', fallback=1.0),
+        "backoff_max": config.getfloat('option', 'backoff-max', fallback=60.0),
+        # 连续失败多少次后熔断，以及熔断多久后再试
+        "breaker_threshold": config.getint('option', 'breaker-threshold', fallback=5),
+        "breaker_reset": config.getfloat('option', 'breaker-reset', fallback=30.0),
+        # 主后端失败后依次尝试的后端，例如 "openai"
+        "failover": [b.strip() for b in config.get('option', 'failover', fallback="").split(',') if b.strip()],
+        # 每个 API key 每分钟的请求数与 token 数上限，0 表示不限制
+        "openai_rpm": config.getint('option', 'openai-rpm', fallback=0),
+        "openai_tpm": config.getint('option', 'openai-tpm', fallback=0),
+        # 近似重复段落复用译文的相似度阈值（0 到 1），0 表示关闭
+        "fuzzy_match_threshold": config.getfloat('option', 'fuzzy-match-threshold', fallback=0.0),
+    }
+
+
+# 句子结尾：中日文标点可直接结束句子，西文标点后面必须跟空白或文本结尾
+_SENTENCE_RE = re.compile(r'.+?(?:[。！？；]+[」』”’）]*|[.!?…]+["”’)\]]*(?=\s|$)|$)\s*', re.S)
+_CJK_RE = re.compile(r'[\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uac00-\ud7af\uf900-\ufaff]')
+
+
+def estimate_tokens(text):
+    """Rough token count: one token per CJK character, four characters per token otherwise"""
+    cjk = len(_CJK_RE.findall(text))
+    return cjk + (len(text) - cjk + 3) // 4
+
+
+def split_sentences(paragraph):
+    return [s.strip() for s in _SENTENCE_RE.findall(paragraph) if s.strip()]
+
+
+def split_text(text, max_tokens=800):
+    """Pack paragraphs into segments of at most max_tokens (estimated) tokens.
+
+    Paragraphs are never split unless a single paragraph exceeds the budget, in
+    which case it is split at sentence boundaries. A single sentence longer than
+    the budget becomes a segment of its own.
+    """
+    # 初始化短文本列表
+    short_text_list = []
+    # 初始化当前短文本
+    current, current_tokens = [], 0
+
+    def flush(separator):
+        nonlocal current, current_tokens
+        if current:
+            short_text_list.append(separator.join(current))
+        current, current_tokens = [], 0
+
+    for paragraph in (p.strip() for p in text.split('\n')):
+        if not paragraph:
+            continue
+        tokens = estimate_tokens(paragraph)
+        if tokens > max_tokens:
+            # 段落过长，按句子切分
+            flush('\n')
+            for sentence in split_sentences(paragraph):
+                sentence_tokens = estimate_tokens(sentence)
+                if current and current_tokens + sentence_tokens > max_tokens:
+                    flush('')
+                # 西文句子之间保留空格，中日文句子直接相连
+                if current and not _CJK_RE.match(sentence) and sentence[0] not in '「『（“':
+                    sentence = ' ' + sentence
+                current.append(sentence)
+                current_tokens += sentence_tokens
+            flush('')
+            continue
+        if current and current_tokens + tokens > max_tokens:
+            flush('\n')
+        current.append(paragraph)
+        current_tokens += tokens
+    # 将最后的短文本加入短文本列表
+    flush('\n')
+    return short_text_list
+
+
+def clean_paragraphs(text, wrapped_lines=False):
+    """One paragraph per line with whitespace collapsed.
+
+    By default every line is a paragraph (TXT, DOCX, MOBI). With
+    wrapped_lines (PDF text) lines are joined and only blank lines separate
+    paragraphs.
+    """
+    blocks = re.split(r"\n\s*\n", text) if wrapped_lines else text.splitlines()
+    return "\n".join(paragraph for paragraph in (" ".join(block.split()) for block in blocks) if paragraph)
+
+
+def iter_segments(chunks, max_tokens=800):
+    """Streaming split_text(): pack text arriving in chunks (e.g. PDF pages) into segments.
+
+    The last segment of each chunk may end mid-sentence, so it is carried over
+    and re-packed with the next chunk; only that carry stays in memory.
+    """
+    carry = ""
+    for chunk in chunks:
+        segments = split_text((carry + " " + chunk).strip(), max_tokens)
+        carry = segments.pop() if segments else ""
+        yield from segments
+    if carry:
+        yield carry
+
+
+def prefetch(iterable, maxsize=2):
+    """Run iterable in a background thread so the next items are produced while the current one is consumed.
+
+    Closing the returned generator stops the thread and closes `iterable`
+    there, so an early stop does not leave the source running.
+    """
+    items = queue.Queue(maxsize=maxsize)
+    done = object()
+    stop = threading.Event()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                items.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def produce():
+        iterator = iter(iterable)
+        try:
+            for item in iterator:
+                if not put(item):
+                    return
+            put(done)
+        except Exception as e:
+            put(e)
+        finally:
+            # 在生产线程中关闭源生成器，执行它的 finally（例如关闭进程池）
+            close = getattr(iterator, "close", None)
+            if close:
+                close()
+
+    producer = threading.Thread(target=produce, daemon=True)
+    producer.start()
+    try:
+        while True:
+            item = items.get()
+            if item is done:
+                return
+            if isinstance(item, Exception):
+                raise item
+            yield item
+    finally:
+        stop.set()
+        producer.join()
+
+
+# 将句号替换为句号+回车
+def return_text(text):
+        # Verifica si text es un diccionario
+    if isinstance(text, dict):
+        # Si tiene la clave 'translation', se toma su valor
+        text = text.get('translation', '')
+    if isinstance(text, list):
+        text = ''.join(text)
+        
+    # Realiza los reemplazos como tenías definidos
+    text = text.replace(". ", ".\n")
+    text = text.replace("。", "。\n")
+    text = text.replace("！", "！\n")
+    return text
+
+
+# 已编译的译名表，按 (路径, 修改时间, 是否区分大小写) 缓存
+_glossary_cache = {}
+
+
+def _glossary_trie_regex(words):
+    """Build one regex alternation from words, shared prefixes merged into a trie"""
+    trie = {}
+    for word in words:
+        node = trie
+        for char in word:
+            node = node.setdefault(char, {})
+        node[''] = True
+
+    def build(node):
+        branches = [re.escape(char) + build(child) for char, child in sorted(node.items()) if char != '']
+        if not branches:
+            return ''
+        body = branches[0] if len(branches) == 1 else '(?:' + '|'.join(branches) + ')'
+        # 贪婪匹配：优先尝试更长的词
+        return '(?:' + body + ')?' if '' in node else body
+
+    return build(trie)
+
+
+def _read_glossary_entries(xlsx_path, mtime):
+    # 读取excel很慢，解析结果缓存到磁盘，xlsx文件修改后自动失效
+    cache_path = xlsx_path + ".cache.json"
+    try:
+        with open(cache_path, "r", encoding="utf-8") as f:
+            cached = json.load(f)
+        if cached["mtime"] == mtime:
+            return cached["entries"]
+    except (FileNotFoundError, ValueError, KeyError):
+        pass
+
+    import pandas as pd
+
+    # 读取excel文件，第一列为原词，第二列为译名
+    df = pd.read_excel(xlsx_path)
+    entries = [
+        [str(old_word), str(new_word)]
+        for old_word, new_word in zip(df.iloc[:, 0], df.iloc[:, 1])
+        if not pd.isna(old_word) and not pd.isna(new_word) and str(old_word)
+    ]
+    try:
+        with open(cache_path, "w", encoding="utf-8") as f:
+            json.dump({"mtime": mtime, "entries": entries}, f, ensure_ascii=False)
+    except OSError:
+        pass
+    return entries
+
+
+def load_glossary(xlsx_path, case_sensitive):
+    """Load the transliteration list once and compile it into a single regex.
+
+    Returns (pattern, mapping, case_sensitive); when case matching is off the
+    mapping is keyed by the lower-cased source word.
+    """
+    case_sensitive = str(case_sensitive).lower() == 'true'
+    mtime = os.path.getmtime(xlsx_path)
+    key = (os.path.abspath(xlsx_path), mtime, case_sensitive)
+    if key not in _glossary_cache:
+        mapping = {}
+        for old_word, new_word in _read_glossary_entries(xlsx_path, mtime):
+            mapping.setdefault(old_word if case_sensitive else old_word.lower(), new_word)
+        pattern = None
+        if mapping:
+            pattern = re.compile(
+                r"(?<!\w)" + _glossary_trie_regex(mapping) + r"(?!\w)",
+                0 if case_sensitive else re.IGNORECASE
+            )
+        _glossary_cache[key] = (pattern, mapping, case_sensitive)
+    return _glossary_cache[key]
+
+
+def text_replace(long_string, xlsx_path, case_sensitive):
+    # 一次扫描完成所有替换，长词优先
+    with profiler.stage("glossary", long_string):
+        pattern, mapping, case_sensitive = load_glossary(xlsx_path, case_sensitive)
+        if pattern is None:
+            return long_string
+        if case_sensitive:
+            return pattern.sub(lambda m: mapping[m.group(0)], long_string)
+        return pattern.sub(lambda m: mapping[m.group(0).lower()], long_string)
+
+
+# 预分类结果：原样输出、只需译名表替换、需要模型翻译
+PASS_THROUGH = "pass_through"
+GLOSSARY_ONLY = "glossary_only"
+NEEDS_TRANSLATION = "translate"
+
+_LETTER_RE = re.compile(r"[^\W\d_]")
+# 网址、电子邮件、ISBN、DOI 与函数调用
+_PASS_THROUGH_RE = re.compile(
+    r"(?:(?:https?://|ftp://|www\.)\S+"
+    r"|[\w.+-]+@[\w-]+(?:\.[\w-]+)+"
+    r"|ISBN(?:-1[03])?:?\s*[\dXx][\dXx\s-]{8,16}"
+    r"|(?:doi:\s*)?10\.\d{4,9}/\S+"
+    r"|[A-Za-z_][\w.]*\(.*\)\s*;?)"
+)
+# 罗马数字章节号："I"、"MIX" 也是单词，只有带句点或位于标题中时才视为章节号
+_ROMAN_RE = re.compile(r"(?=[MDCLXVI])M{0,4}(?:CM|CD|D?C{0,3})(?:XC|XL|L?X{0,3})(?:IX|IV|V?I{0,3})(\.?)")
+# 赋值语句：右边以 ; 或 ) 结尾，或不含连续的普通单词与句中标点，例如 "x = a + b"
+_ASSIGNMENT_RE = re.compile(r"[A-Za-z_][\w.]*(?:\[[^\]]*\])?\s*(?://|\*\*|<<|>>|[-+*/%|&^])?=\s*([^=].*)")
+_WORD_RUN_RE = re.compile(r"[^\W\d_]+\s+[^\W\d_]+|[.!?]\s")
+_SCRIPT_CHARS = {
+    "han": "\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff",
+    "kana": "\u3040-\u30ff",
+    "hangul": "\u1100-\u11ff\uac00-\ud7af",
+    "cyrillic": "\u0400-\u04ff",
+    "greek": "\u0370-\u03ff",
+    "arabic": "\u0600-\u06ff",
+    "hebrew": "\u0590-\u05ff",
+    "thai": "\u0e00-\u0e7f",
+}
+# 目标语言使用的文字；使用拉丁字母的语言无法只凭文字与原文区分，不做判断
+_LANGUAGE_SCRIPTS = {
+    "zh": ("han",), "ja": ("han", "kana"), "ko": ("hangul", "han"),
+    "ru": ("cyrillic",), "uk": ("cyrillic",), "bg": ("cyrillic",), "sr": ("cyrillic",),
+    "el": ("greek",), "ar": ("arabic",), "fa": ("arabic",), "he": ("hebrew",), "th": ("thai",),
+}
+
+
+def _is_code_line(text):
+    """True for an assignment whose right-hand side reads like code rather than prose"""
+    match = _ASSIGNMENT_RE.fullmatch(text)
+    if match is None:
+        return False
+    value = match.group(1).rstrip()
+    return value.endswith((";", ")")) or not _WORD_RUN_RE.search(value)
+
+
+class SegmentClassifier:
+    """Local pre-filter deciding which segments need the model.
+
+    classify() returns (PASS_THROUGH, text) for segments that are copied as
+    they are: no letters (page numbers, punctuation), a lone Roman numeral
+    followed by a period or forming a whole heading, a URL, e-mail address, ISBN, DOI or line of code, or text already written
+    in the script of the target language. It returns (GLOSSARY_ONLY,
+    replaced) when the transliteration list covers every word, and
+    (NEEDS_TRANSLATION, None) otherwise.
+    """
+
+    def __init__(self, language_code, glossary=None, target_share=0.9):
+        scripts = _LANGUAGE_SCRIPTS.get(language_code.lower().split("-")[0].split("_")[0], ())
+        self.target_re = re.compile("[" + "".join(_SCRIPT_CHARS[s] for s in scripts) + "]") if scripts else None
+        self.target_share = target_share
+        self.glossary = glossary
+        self.glossary_words = None
+        if glossary is not None and glossary[0] is not None:
+            pattern, mapping, _ = glossary
+            # 开启 --tlist 时原文已替换过，原词与译名都算作译名表覆盖的内容
+            values = re.compile(r"(?<!\w)" + _glossary_trie_regex(set(mapping.values())) + r"(?!\w)")
+            self.glossary_words = (pattern, values)
+
+    def classify(self, text, heading=False):
+        stripped = _PLACEHOLDER_RE.sub("", text).strip()
+        letters = _LETTER_RE.findall(stripped)
+        if not letters or _PASS_THROUGH_RE.fullmatch(stripped) or _is_code_line(stripped):
+            return PASS_THROUGH, text
+        roman = _ROMAN_RE.fullmatch(stripped)
+        if roman and (roman.group(1) or heading):
+            return PASS_THROUGH, text
+        if self.target_re is not None:
+            target = sum(1 for char in letters if self.target_re.match(char))
+            if target >= self.target_share * len(letters):
+                return PASS_THROUGH, text
+        if self.glossary_words is not None:
+            pattern, values = self.glossary_words
+            if not _LETTER_RE.search(values.sub("", pattern.sub("", stripped))):
+                _, mapping, case_sensitive = self.glossary
+                replaced = pattern.sub(lambda m: mapping[m.group(0) if case_sensitive else m.group(0).lower()], text)
+                return GLOSSARY_ONLY, replaced
+        return NEEDS_TRANSLATION, None
+
+
+# EPUB 章节按块级元素翻译，行内标记用 <gN>…</gN>/<xN/> 占位符保留
+_BLOCK_TAGS = frozenset(
+    "address article aside blockquote body caption dd details div dl dt fieldset figcaption figure "
+    "footer form h1 h2 h3 h4 h5 h6 header hr li main nav ol p section summary table tbody td tfoot "
+    "th thead tr ul".split()
+)
+_HEADING_TAGS = frozenset("h1 h2 h3 h4 h5 h6".split())
+_SKIP_TAGS = frozenset("head script style pre code svg math noscript template".split())
+_PLACEHOLDER_RE = re.compile(r"</?[gx]\d+/?>")
+
+
+def _tag(el):
+    """Lower-case local name of an element, None for comments and processing instructions"""
+    if not isinstance(el.tag, str):
+        return None
+    return el.tag.rsplit('}', 1)[-1].lower()
+
+
+def _has_text(el):
+    return bool(''.join(el.itertext()).strip())
+
+
+def _has_block_descendant(el):
+    return any(_tag(d) in _BLOCK_TAGS for d in el.iterdescendants())
+
+
+def _wrap_inline_runs(el):
+    """Wrap each run of loose text and inline elements of a container block in a <span>"""
+    namespace = el.tag[:el.tag.index('}') + 1] if el.tag.startswith('{') else ''
+    items = [el.text]
+    for child in list(el):
+        items.extend([child, child.tail])
+        child.tail = None
+        el.remove(child)
+    el.text = None
+
+    def append_text(target, text):
+        if len(target):
+            target[-1].tail = (target[-1].tail or '') + text
+        else:
+            target.text = (target.text or '') + text
+
+    wrappers, current = [], None
+    for item in items:
+        if item is None or isinstance(item, str) and not item:
+            continue
+        if isinstance(item, str):
+            if current is None and not item.strip():
+                append_text(el, item)
+                continue
+            if current is None:
+                current = el.makeelement(namespace + "span", {})
+                el.append(current)
+                wrappers.append(current)
+            append_text(current, item)
+        elif _tag(item) in _BLOCK_TAGS or _tag(item) in _SKIP_TAGS or _has_block_descendant(item):
+            current = None
+            el.append(item)
+        elif current is None and _tag(item) is None:
+            el.append(item)
+        else:
+            if current is None:
+                current = el.makeelement(namespace + "span", {})
+                el.append(current)
+                wrappers.append(current)
+            current.append(item)
+    return [w for w in wrappers if _has_text(w)]
+
+
+def collect_epub_blocks(el, blocks=None):
+    """Return the elements of an (X)HTML tree to translate, in document order.
+
+    These are the block elements without block descendants; loose text inside
+    container blocks is wrapped in <span> elements which are returned too.
+    """
+    if blocks is None:
+        blocks = []
+    if _tag(el) is None or _tag(el) in _SKIP_TAGS:
+        return blocks
+    if not _has_block_descendant(el):
+        if _has_text(el):
+            blocks.append(el)
+        return blocks
+
+    loose = (el.text or '').strip() or any(
+        (child.tail or '').strip()
+        or (_tag(child) not in _BLOCK_TAGS and _tag(child) not in _SKIP_TAGS
+            and not _has_block_descendant(child) and _has_text(child))
+        for child in el
+    )
+    wrappers = set(_wrap_inline_runs(el)) if loose else set()
+    for child in el:
+        if child in wrappers:
+            blocks.append(child)
+        elif _tag(child) in _BLOCK_TAGS or _has_block_descendant(child):
+            collect_epub_blocks(child, blocks)
+    return blocks
+
+
+def block_to_segment(el):
+    """Return (segment, inline) for a block element.
+
+    Without inline markup the segment is the plain text. Otherwise each inline
+    element becomes <gN>…</gN> (or <xN/> when empty, e.g. images) and inline[N]
+    is the original element, so the markup can be restored after translation.
+    """
+    inline = []
+
+    def walk(node):
+        parts = [xml_escape(node.text or '')]
+        for child in node:
+            if _tag(child) is not None:
+                index = len(inline)
+                inline.append(child)
+                if len(child) == 0 and not (child.text or '').strip():
+                    parts.append(f"<x{index}/>")
+                else:
+                    parts.append(f"<g{index}>{walk(child)}</g{index}>")
+            parts.append(xml_escape(child.tail or ''))
+        return ''.join(parts)
+
+    marked = re.sub(r"\s+", " ", walk(el)).strip()
+    if not inline:
+        return html.unescape(marked), inline
+    return marked, inline
+
+
+def apply_translation(el, translation, inline):
+    """Replace the content of el with translation, restoring the inline markup of block_to_segment()"""
+    from lxml import etree
+
+    replacement = el.makeelement(el.tag, el.attrib)
+    if not inline:
+        replacement.text = translation
+    else:
+        used = set()
+
+        def build(source, target):
+            target.text = source.text
+            for node in source:
+                match = re.fullmatch(r"([gx])(\d+)", node.tag) if isinstance(node.tag, str) else None
+                if match is None or int(match.group(2)) >= len(inline) or int(match.group(2)) in used:
+                    raise ValueError(f"unexpected tag {node.tag!r}")
+                index = int(match.group(2))
+                used.add(index)
+                original = inline[index]
+                if match.group(1) == "x":
+                    restored = copy.deepcopy(original)
+                else:
+                    restored = el.makeelement(original.tag, original.attrib)
+                    build(node, restored)
+                restored.tail = node.tail
+                target.append(restored)
+
+        try:
+            build(etree.fromstring(f"<root>{translation}</root>"), replacement)
+        except (etree.XMLSyntaxError, ValueError):
+            # 模型没有保留标记：只保留译文，行内格式丢失
+            replacement = el.makeelement(el.tag, el.attrib)
+            replacement.text = html.unescape(_PLACEHOLDER_RE.sub("", translation))
+            used = set()
+        # 模型漏掉的空元素（图片等）补在末尾
+        for index, original in enumerate(inline):
+            if index not in used and len(original) == 0 and not (original.text or '').strip():
+                restored = copy.deepcopy(original)
+                restored.tail = None
+                replacement.append(restored)
+
+    for child in list(el):
+        el.remove(child)
+    el.text = replacement.text
+    for child in list(replacement):
+        el.append(child)
+
+
+def _content_hash(text):
+    return hashlib.sha1(text.encode("utf-8")).hexdigest()
+
+
+def match_units(old_hashes, new_hashes):
+    """Diff two sequences of content hashes.
+
+    Returns ({new index: old index} for the unchanged units, counts of
+    unchanged, changed, inserted and deleted units).
+    """
+    matcher = difflib.SequenceMatcher(None, old_hashes, new_hashes, autojunk=False)
+    matched = {}
+    counts = dict.fromkeys(("unchanged", "changed", "inserted", "deleted"), 0)
+    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+        if tag == "equal":
+            matched.update(zip(range(j1, j2), range(i1, i2)))
+            counts["unchanged"] += j2 - j1
+        elif tag == "replace":
+            counts["changed"] += j2 - j1
+        elif tag == "insert":
+            counts["inserted"] += j2 - j1
+        else:
+            counts["deleted"] += i2 - i1
+    return matched, counts
+
+
+def _bilingual_translation(el):
+    """The <span> holding the translation that bilingual output appends to a block, or None"""
+    children = [child for child in el if _tag(child) is not None]
+    if (len(children) >= 2 and _tag(children[-1]) == "span" and _tag(children[-2]) == "br"
+            and "color: blue" in (children[-1].get("style") or "")):
+        return children[-1]
+    return None
+
+
+def previous_block_translations(source, translated):
+    """Pair the blocks of a document of the previous edition with their translation.
+
+    `translated` is the document as written by translate_chapter_html(),
+    bilingual or not. Returns a (hash of the source segment, translated
+    segment) per block, where the translation is None when it is empty or its
+    inline markup does not match the source; None when the two documents do
+    not have the same blocks.
+    """
+    from lxml import html as lxml_html
+
+    blocks = []
+    for content in (source, translated):
+        with profiler.stage("html_parse", content):
+            doc = lxml_html.document_fromstring(content, parser=lxml_html.HTMLParser(encoding="utf-8"))
+        body = doc.find("body")
+        blocks.append(collect_epub_blocks(body if body is not None else doc))
+    if len(blocks[0]) != len(blocks[1]):
+        return None
+    pairs = []
+    for source_el, translated_el in zip(*blocks):
+        segment, inline = block_to_segment(source_el)
+        target = _bilingual_translation(translated_el)
+        translation, translated_inline = block_to_segment(target if target is not None else translated_el)
+        usable = ([_tag(e) for e in inline] == [_tag(e) for e in translated_inline]
+                  and _PLACEHOLDER_RE.sub("", translation).strip())
+        pairs.append((_content_hash(segment), translation if usable else None))
+    return pairs
+
+
+def _segment_units(segment):
+    return [s for paragraph in segment.split("\n") for s in split_sentences(paragraph)]
+
+
+def _join_units(units):
+    # 与 split_text() 相同：西文句子之间保留空格，中日文句子直接相连
+    text = ""
+    for unit in units:
+        if text and not _CJK_RE.match(unit) and unit[0] not in '「『（“':
+            text += " "
+        text += unit
+    return text
+
+
+def revise_segments(old_segments, new_segments, max_tokens=800):
+    """Segments of a revised text that keep the unchanged segments of the previous edition.
+
+    Both editions are diffed sentence by sentence by content hash. A segment
+    of the previous edition whose sentences are all unchanged and still
+    consecutive is kept as it is, so its stored translation applies; the
+    other sentences are packed again with split_text(). Returns (segments,
+    the kept previous segments, diff counts).
+    """
+    old_units, spans = [], []
+    for segment in old_segments:
+        units = _segment_units(segment)
+        spans.append((len(old_units), len(old_units) + len(units)))
+        old_units.extend(units)
+    new_units = [unit for segment in new_segments for unit in _segment_units(segment)]
+    matched, counts = match_units([_content_hash(u) for u in old_units], [_content_hash(u) for u in new_units])
+    old_to_new = {i: j for j, i in matched.items()}
+
+    kept = {}
+    for k, (start, end) in enumerate(spans):
+        first = old_to_new.get(start)
+        if end > start and first is not None and all(old_to_new.get(start + n) == first + n
+                                                     for n in range(end - start)):
+            kept[first] = k
+
+    segments, reused, pending = [], [], []
+    j = 0
+    while j < len(new_units):
+        k = kept.get(j)
+        if k is None:
+            pending.append(new_units[j])
+            j += 1
+            continue
+        if pending:
+            segments.extend(split_text(_join_units(pending), max_tokens))
+            pending = []
+        segments.append(old_segments[k])
+        reused.append(old_segments[k])
+        j += spans[k][1] - spans[k][0]
+    if pending:
+        segments.extend(split_text(_join_units(pending), max_tokens))
+    return segments, reused, counts
+
+
+class PreviousEdition:
+    """The previous edition of a book and its translation, for re-translating a revised edition.
+
+    For an EPUB the translation is the translated EPUB (by default
+    <base>_translated.epub), paired with the source document by document;
+    for the other formats it is the translation memory of the previous run
+    (by default <base>_process.db).
+    """
+
+    def __init__(self, source, translation=None):
+        base, extension = os.path.splitext(source)
+        self.source = source
+        self.epub = extension.lower() == ".epub"
+        self.translation = translation or base + ("_translated.epub" if self.epub else "_process.db")
+        for path in (source, self.translation):
+            if not os.path.exists(path):
+                raise FileNotFoundError(f"previous edition: {path} not found")
+        self.source_zip = self.translated_zip = self.translations = None
+        if self.epub:
+            if not self.translation.lower().endswith(".epub"):
+                raise ValueError("the translation of a previous EPUB edition must be its translated EPUB")
+            self.lock = threading.Lock()
+            self.source_zip = zipfile.ZipFile(source)
+            self.translated_zip = zipfile.ZipFile(self.translation)
+        else:
+            if not self.translation.lower().endswith(".db"):
+                raise ValueError("the translation of a previous edition must be its <name>_process.db")
+            self.translations = TranslationMemory(self.translation, "translations")
+
+    def chapter(self, name):
+        """(source, translation) of a document of the previous edition, None when it has no such document"""
+        with profiler.stage("document_load"), self.lock:
+            try:
+                return self.source_zip.read(name), self.translated_zip.read(name)
+            except KeyError:
+                return None
+
+    def close(self):
+        for handle in (self.source_zip, self.translated_zip, self.translations):
+            if handle is not None:
+                handle.close()
+
+
+class UntranslatedSegment(str):
+    """The source text of a segment that could not be translated, written to the output in its place"""
+
+
+class Translator:
+    """Reusable translation engine.
+
+    Holds the settings and the translation memory of one input file, so it can
+    be driven from the command line (main()) or imported by another program:
+
+        translator = Translator(read_settings("settings.cfg"), concurrency=4)
+        translator.translate_file("book.epub")
+    """
+
+    def __init__(self, settings=None, test=False, tlist=False, concurrency=None, batch_size=None,
+                 chapter_concurrency=None, pdf_workers=None, memory_path=None,
+                 stream=None, adaptive_concurrency=None):
+        settings = dict(settings if settings is not None else read_settings())
+        if concurrency:
+            settings["concurrency"] = concurrency
+        if batch_size:
+            settings["batch_size"] = batch_size
+        if chapter_concurrency:
+            settings["chapter_concurrency"] = chapter_concurrency
+        if pdf_workers:
+            settings["pdf_workers"] = pdf_workers
+        if stream:
+            settings["stream"] = True
+        if adaptive_concurrency:
+            settings["adaptive_concurrency"] = True
+
+        self.settings = settings
+        self.test = test
+        self.tlist = tlist
+        self.bilingual_output = str(settings["bilingual_output"]).lower() == 'true'
+        self.language_code = settings["language_code"]
+        self.startpage = settings["startpage"]
+        self.endpage = settings["endpage"]
+        self.transliteration_list_file = settings["transliteration_list_file"]
+        self.case_matching = settings["case_matching"]
+        self.concurrency = settings["concurrency"]
+        self.adaptive_concurrency = str(settings.get("adaptive_concurrency", False)).lower() == 'true'
+        # 自适应时按上限创建工作线程，实际同时进行的请求数由 concurrency_control 决定
+        self.workers = self.concurrency
+        if self.adaptive_concurrency:
+            self.workers = max(self.concurrency, settings.get("max_concurrency", 16))
+        concurrency_control.configure(
+            enabled=self.adaptive_concurrency,
+            initial=self.concurrency,
+            maximum=self.workers,
+            latency_target=settings.get("latency_target", 0.0),
+        )
+        self.batch_size = settings["batch_size"]
+        self.chapter_concurrency = settings.get("chapter_concurrency", 1)
+        self.pdf_workers = settings.get("pdf_workers", 1)
+        self.stream = str(settings.get("stream", False)).lower() == 'true'
+        self.structured_output = str(settings.get("structured_output", True)).lower() == 'true'
+        self.pre_filter = str(settings.get("pre_filter", True)).lower() == 'true'
+        self.translation_model = settings["translation_model"]
+        self.openai_model = settings.get("openai_model", "gpt-3.5-turbo")
+        # 翻译的源语言与目标语言，以及 settings.cfg 中的 prompt
+        self.source_language = "英文"
+        self.target_language = "繁體中文"
+        self.prompt = settings.get("prompt", "")
+        self.segment_tokens = settings["segment_tokens_per_model"].get(
+            self.translation_model, settings["segment_tokens"]
+        )
+        # 将openai的API密钥分割成数组，未设置时使用 $OPENAI_API_KEY
+        self.key_array = [k.strip() for k in settings["openai_apikey"].split(',') if k.strip() not in ("", "sk-")]
+        key_scheduler.configure(self.key_array, settings.get("openai_rpm", 0), settings.get("openai_tpm", 0))
+
+        self.warm_up = str(settings.get("warm_up", True)).lower() == 'true'
+        # 连接池大小按同时进行的请求数设置
+        backends.configure(
+            ollama_host=settings.get("ollama_host", ""),
+            openai_base_url=settings.get("api_proxy", ""),
+            keep_alive=settings.get("keep_alive", "30m"),
+            num_ctx=settings.get("num_ctx", 0),
+            pool_size=max(1, self.workers) * max(1, self.chapter_concurrency),
+        )
+
+        self.cost_per_1k_tokens = settings.get("cost_per_1k_tokens", 0.002)
+        self.fuzzy_match_threshold = settings.get("fuzzy_match_threshold", 0.0)
+        resilience.configure(
+            max_retries=settings.get("max_retries", 4),
+            backoff_base=settings.get("backoff_base", 1.0),
+            backoff_max=settings.get("backoff_max", 60.0),
+            breaker_threshold=settings.get("breaker_threshold", 5),
+            breaker_reset=settings.get("breaker_reset", 30.0),
+            failover=settings.get("failover", ()),
+        )
+        # 指定时所有文件共用这个翻译记忆库，否则每个文件使用 <base>_process.db
+        self.memory_path = memory_path
+        # 由 Library 驱动时，进程级的统计（后端、流式、解析等）只写入书库的统计报告
+        self.in_library = False
+        self._reset_file_state()
+
+    def _reset_file_state(self):
+        # 翻译失败（未写入翻译记忆库，下次运行会重试）的段落数
+        self.failed_segments = 0
+        # 最近一次 translate_file() 的统计报告
+        self.report = None
+
+        # translated_dict 在多个线程之间共享
+        self.translated_dict = None
+        self.sentences_dict = None
+        self.chapters_dict = None
+        self.pages_dict = None
+        self.pdf_index_dict = None
+        self.translated_dict_lock = threading.Lock()
+        # 从检查点恢复、没有重新解析的章节数
+        self.resumed_chapters = 0
+        # 归一化后的段落与近似重复索引
+        self.normalized_dict = None
+        self.minhash_dict = None
+        self.minhash_index = None
+        # 翻译记忆库命中统计：exact / normalized / fuzzy 以及实际翻译的段落数
+        self.reuse = dict.fromkeys(("exact", "normalized", "fuzzy", "translated"), 0)
+        # 预分类器（translate_file() 中创建）与跳过模型的段落数
+        self.classifier = None
+        # 已加载译名表内容的摘要，用于章节检查点的键
+        self.glossary_digest = None
+        self.skipped = dict.fromkeys((PASS_THROUGH, GLOSSARY_ONLY), 0)
+        # 翻译修订版时的上一版（PreviousEdition）与差异统计
+        self.previous = None
+        self.revision = None
+
+    def fork(self):
+        """Translator with the same settings and its own per-file state, for translating another file concurrently.
+
+        Unlike a new Translator it does not reconfigure the shared retry
+        policy and key scheduler.
+        """
+        translator = copy.copy(self)
+        translator._reset_file_state()
+        return translator
+
+    def create_chat_completion(self, prompt, text, model=None, **kwargs):
+        # 与其他 OpenAI 请求一样由 key_scheduler 选择 API key 并统计用量
+        return openai_chat_completion(
+            kind="chat",
+            model=model or self.openai_model,
+            messages=[
+                {
+                    "role": "user",
+                    "content": f"{prompt}: \n{text}",
+                }
+            ],
+            **kwargs
+        )
+
+    def open_memory(self, base_filename):
+        """Open <base>_process.db and import the old JSON checkpoints once"""
+        self.close_memory()
+        # 翻译记忆库，每个段落只写一行
+        self.tm_file = self.memory_path or base_filename + "_process.db"
+        # 从翻译记忆库中加载已经翻译的文本，旧的 JSON 检查点只导入一次
+        self.translated_dict = TranslationMemory(self.tm_file, "translations")
+        imported = self.translated_dict.import_json(base_filename + "_process.json")
+        # 从翻译记忆库中加载已经分割的句子
+        self.sentences_dict = TranslationMemory(self.tm_file, "sentences")
+        self.sentences_dict.import_json(base_filename + "_sentences.json")
+        # 已完成的 EPUB 章节，按内容哈希保存
+        self.chapters_dict = TranslationMemory(self.tm_file, "chapters")
+        # 提取过的 PDF 页面文本与 PDF 索引
+        self.pages_dict = TranslationMemory(self.tm_file, "pdf_pages")
+        self.pdf_index_dict = TranslationMemory(self.tm_file, "pdf_index")
+
+        # 归一化查找：键为 segment_key()，值为原文与译文
+        self.normalized_dict = TranslationMemory(self.tm_file, "normalized")
+        # 之后的译文由 remember() 同时写入，只有旧数据库与导入的 JSON 检查点需要补齐
+        if imported or not self.normalized_dict.backfilled("translations"):
+            self.normalized_dict.update(
+                ((segment_key(source), {"source": source, "translation": translation})
+                 for source, translation in self.translated_dict.items()),
+                replace=False,
+            )
+            self.normalized_dict.mark_backfilled("translations")
+        self.minhash_index = None
+        if self.fuzzy_match_threshold > 0:
+            # MinHash 签名只计算一次，保存在 minhash 表中
+            self.minhash_dict = TranslationMemory(self.tm_file, "minhash")
+            self.minhash_index = MinHashIndex(self.fuzzy_match_threshold)
+            signatures = dict(self.minhash_dict.items())
+            if len(signatures) < len(self.normalized_dict):
+                missing = []
+                for key, entry in self.normalized_dict.items():
+                    if key not in signatures:
+                        signatures[key] = self.minhash_index.signature(entry["source"])
+                        missing.append((key, signatures[key]))
+                self.minhash_dict.update(missing)
+            for key, signature in signatures.items():
+                self.minhash_index.add(key, signature)
+
+    def close_memory(self):
+        if self.translated_dict is not None:
+            for memory in (self.translated_dict, self.sentences_dict, self.chapters_dict, self.pages_dict,
+                           self.pdf_index_dict, self.normalized_dict, self.minhash_dict):
+                if memory is not None:
+                    memory.close()
+            self.translated_dict = self.sentences_dict = self.chapters_dict = self.pages_dict = None
+            self.pdf_index_dict = None
+            self.normalized_dict = self.minhash_dict = self.minhash_index = None
+
+    def lookup(self, text):
+        """Find a stored translation of `text`: exact, then normalised, then near-duplicate.
+
+        Must be called with translated_dict_lock held. Returns None on a miss.
+        """
+        translation = self.translated_dict.get(text)
+        if translation is not None:
+            self.reuse["exact"] += 1
+            return translation
+        key = segment_key(text)
+        entry = self.normalized_dict.get(key)
+        if entry is not None:
+            translation = adapt_numbers(entry["source"], entry["translation"], text)
+            if translation is not None:
+                self.reuse["normalized"] += 1
+                return translation
+        if self.minhash_index is not None:
+            match, _ = self.minhash_index.query(self.minhash_index.signature(text))
+            entry = self.normalized_dict.get(match) if match is not None else None
+            if entry is not None:
+                translation = adapt_numbers(entry["source"], entry["translation"], text)
+                if translation is not None:
+                    self.reuse["fuzzy"] += 1
+                    return translation
+        return None
+
+    def remember(self, text, translation):
+        """Store a translation under its exact and normalised keys. Must be called with translated_dict_lock held."""
+        self.translated_dict[text] = translation
+        key = segment_key(text)
+        self.normalized_dict[key] = {"source": text, "translation": translation}
+        self.reuse["translated"] += 1
+        if self.minhash_index is not None and key not in self.minhash_index.signatures:
+            signature = self.minhash_index.signature(text)
+            self.minhash_dict[key] = signature
+            self.minhash_index.add(key, signature)
+
+    def split_text(self, text):
+        return split_text(text, self.segment_tokens)
+
+    def text_replace(self, text):
+        return text_replace(text, self.transliteration_list_file, self.case_matching)
+
+    def split_text_into_sentences(self, text):
+
+        if text in self.sentences_dict:
+            return self.sentences_dict[text]
+
+        if True:
+            return [text]
+
+        paragraphs = text.split('\n')
+        sentences = []
+
+        for paragraph in paragraphs:
+            if not paragraph.strip():
+                continue
+
+            try:
+                response = resilience.call("ollama", lambda: ollama_generate(
+                    kind="split",
+                    model='gpt-oss:120b-cloud',
+                    #prompt=f"Divide este texto en oraciones completas y válidas según su significado, y sepáralas con '|' sin modificar el contenido original.\n--------------------------\n{paragraph}",   
+                    prompt=f"Divide this text into valid complete sentences and then separate them by '|' without modifying the original content:\n--------------------------\n{paragraph}",
+                    #prompt=f"請根據語意將以下段落劃分為有效且完整的小段落，並以「|」作為分隔符號，且不修改原始內容，也不必生成其他的解釋：\n--------------------------\n{paragraph}",
+                    think=False
+                ))
+            except BackendError as e:
+                print(f"Error in split_text_into_sentences: {e}")
+                raise
+
+            split_sentences = response['response'].strip().split('|')
+            for sentence in split_sentences:
+                if sentence.strip():
+                    sentences.append(sentence.strip())
+
+        self.sentences_dict[text] = sentences
+
+        return sentences
+
+    # 翻译短文本
+    def translate_text(self, text):
+        if (text ==  ""):
+            return text
+        result = translate_text_ollama(
+            text,
+            self.target_language,
+            self.source_language,
+            self.translation_model,
+            openai_model=self.openai_model,
+            stream=self.stream,
+            structured=self.structured_output
+        )
+
+        if(result["success"] == True):
+            source = result["translation"]
+            # result = translate_text_ollama(
+            #     text,
+
+            #     "智利智利變體西班牙文變體",
+            #     "智利變體西班牙文",
+            #     "gpt-oss:120b-cloud"
+            # )
+            # if(result["success"] == True):
+            #     source = source + "\n" + result["translation"]
+            return source
+        else: 
+            return None
+
+    def translate_and_store(self, text):
+        # 如果文本已经翻译过，直接返回翻译结果
+        with self.translated_dict_lock:
+            cached = self.lookup(text)
+        if cached is not None:
+            return cached
+
+        # 否则，调用 translate_text 函数进行翻译，并将结果存储在字典中
+        translated_text = self.translate_text(text)
+        if translated_text is None:
+            # 翻译失败的段落不写入翻译记忆库，下次运行时重试；输出中保留原文
+            self.segment_failed(1)
+            return UntranslatedSegment(text)
+        #print("\033[37m" + translated_text + "\033[0m")
+        #translated_text = complet_text_ollama_simple(concatenar_parrafos(return_text(translated_text)) )
+        # 写入翻译记忆库（单行写入）
+        with self.translated_dict_lock:
+            self.remember(text, translated_text)
+
+        return translated_text
+
+    # 一次翻译多个短文本
+    def translate_batch(self, texts):
+        result = translate_batch_ollama(
+            texts,
+            self.target_language,
+            self.source_language,
+            self.translation_model,
+            openai_model=self.openai_model,
+            stream=self.stream,
+            structured=self.structured_output
+        )
+        return result
+
+    def segment_failed(self, count):
+        with self.translated_dict_lock:
+            self.failed_segments += count
+
+    def translate_batch_and_store(self, batch):
+        """Translate a batch in one request, bisecting and retrying when the response is misaligned"""
+        if len(batch) == 1:
+            return [self.translate_and_store(batch[0])]
+
+        result = self.translate_batch(batch)
+        if result.get("misaligned"):
+            # 返回的条目与输入对不上，拆成两半重试
+            middle = len(batch) // 2
+            return self.translate_batch_and_store(batch[:middle]) + self.translate_batch_and_store(batch[middle:])
+        if not result["success"]:
+            # 后端不可用，这些段落下次运行时重试
+            self.segment_failed(len(batch))
+            return [UntranslatedSegment(text) for text in batch]
+        translations = result["translations"]
+
+        # 每个段落单独存入翻译记忆库
+        with self.translated_dict_lock:
+            for text, translated_text in zip(batch, translations):
+                self.remember(text, translated_text)
+        return translations
+
+    def translate_segments(self, segments, headings=()):
+        """Translate a list of segments with up to `workers` threads, keeping source order"""
+        return list(self.iter_translate_segments(segments, headings))
+
+    def iter_translate_segments(self, segments, headings=()):
+        """Yield the translation of each segment in source order, as soon as it is ready
+
+        `segments` may be a stream: it is read ahead only as far as needed to
+        keep `workers` requests in flight, and a new batch is submitted as soon
+        as one completes. `headings` holds the segments that form a whole
+        heading (EPUB h1-h6), where a lone Roman numeral is a chapter number
+        rather than a word.
+        """
+        size = max(1, self.batch_size)
+        limit = max(1, self.workers)
+        # 最多预读的段落数：保持 limit 个请求在进行，其余的等待按顺序输出
+        lookahead = 2 * limit * size
+        source = iter(segments)
+        exhausted = False
+        order = deque()          # 等待按原文顺序输出的段落
+        references = Counter()   # order 中每个段落出现的次数，输出完后释放译文
+        translations = {}
+        batch = []               # 还没有提交的段落
+        pending = set()          # batch 中与请求中的段落
+        in_flight = {}           # future -> batch
+        executor = ThreadPoolExecutor(max_workers=limit) if limit > 1 else None
+        # 工作线程沿用当前的文件/章节标签记录 token 与耗时
+        worker = usage_tracker.wrap(self.translate_batch_and_store)
+        progress = tqdm(total=len(segments) if hasattr(segments, "__len__") else None, unit="segment")
+
+        def resolve(s):
+            """Translation of s without the model (pre-filter, translation memory), or None"""
+            if self.classifier is not None:
+                # 不需要模型的段落直接输出，也不写入翻译记忆库
+                kind, output = self.classifier.classify(s, s in headings)
+                if kind != NEEDS_TRANSLATION:
+                    with self.translated_dict_lock:
+                        self.skipped[kind] += 1
+                    return output
+            with self.translated_dict_lock:
+                return self.lookup(s)
+
+        def submit():
+            nonlocal batch
+            if executor is None:
+                complete(batch, self.translate_batch_and_store(batch))
+            else:
+                in_flight[executor.submit(worker, batch)] = batch
+            batch = []
+
+        def complete(done, result):
+            translations.update(zip(done, result))
+            pending.difference_update(done)
+            if self.adaptive_concurrency:
+                # 在进度条上显示当前的并发上限
+                progress.set_postfix_str(concurrency_control.describe(), refresh=False)
+
+        try:
+            while True:
+                # 预读段落，凑满一批就提交，直到 limit 个请求在进行
+                while not exhausted and len(in_flight) < limit and len(order) < lookahead:
+                    s = next(source, None)
+                    if s is None:
+                        exhausted = True
+                        break
+                    order.append(s)
+                    references[s] += 1
+                    if s in translations or s in pending:
+                        continue
+                    output = resolve(s)
+                    if output is not None:
+                        translations[s] = output
+                        continue
+                    batch.append(s)
+                    pending.add(s)
+                    if len(batch) == size:
+                        submit()
+                # 已完成的段落按原文顺序输出
+                while order and order[0] in translations:
+                    s = order.popleft()
+                    yield translations[s]
+                    progress.update(1)
+                    references[s] -= 1
+                    if not references[s]:
+                        del references[s], translations[s]
+                if not order and exhausted:
+                    return
+                if in_flight and (len(in_flight) >= limit or not batch or order[0] not in batch):
+                    # 任一请求完成后立即补充新的请求
+                    done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        complete(in_flight.pop(future), future.result())
+                elif batch and (exhausted or len(order) >= lookahead or order[0] in batch):
+                    # 不完整的一批：原文读完、预读已满或下一个要输出的段落在其中
+                    submit()
+        finally:
+            progress.close()
+            if executor is not None:
+                executor.shutdown(cancel_futures=True)
+
+    def translate_file(self, filename, output_base=None, previous=None, previous_translation=None):
+        """Translate one PDF/EPUB/TXT/DOCX/MOBI file, writing <base>_translated.epub and .txt.
+
+        A token/latency report of the run is written to <base>_stats.json and
+        kept in ``self.report``. `output_base` replaces <base> for the output
+        files. When `filename` is a revised edition, `previous` is the previous
+        edition and `previous_translation` its translation (see
+        PreviousEdition); only the paragraphs that changed are sent to the
+        model.
+        """
+        base_filename, file_extension = os.path.splitext(filename)
+        if file_extension.lower() not in BOOK_EXTENSIONS:
+            # 在打开翻译记忆库、写入任何输出之前拒绝
+            raise ValueError(f"unsupported file type {file_extension or '(none)'}: {filename}")
+        if previous and os.path.splitext(previous)[1].lower() != file_extension.lower():
+            raise ValueError("the previous edition must have the same format")
+        output_base = output_base or base_filename
+        new_filename = output_base + "_translated.epub"
+        new_filenametxt = output_base + "_translated.txt"
+        self.open_memory(base_filename)
+        self.failed_segments = 0
+        self.resumed_chapters = 0
+        self.reuse = dict.fromkeys(self.reuse, 0)
+        self.skipped = dict.fromkeys(self.skipped, 0)
+        glossary = load_glossary(self.transliteration_list_file, self.case_matching) if self.tlist else None
+        if glossary is not None:
+            _, mapping, case_sensitive = glossary
+            self.glossary_digest = hashlib.sha256(
+                json.dumps([case_sensitive, sorted(mapping.items())], ensure_ascii=False).encode("utf-8")
+            ).hexdigest()
+        if self.pre_filter:
+            self.classifier = SegmentClassifier(self.language_code, glossary)
+        self.revision = None
+        if previous:
+            self.previous = PreviousEdition(previous, previous_translation)
+            self.revision = {"previous": previous, "reused_segments": 0,
+                             "paragraphs": dict.fromkeys(("unchanged", "changed", "inserted", "deleted"), 0)}
+            if self.previous.epub:
+                self.revision["chapters"] = dict.fromkeys(("unchanged", "changed", "added"), 0)
+        started = time.perf_counter()
+        run_id = usage_tracker.new_run()
+        if self.warm_up:
+            # 先加载模型，避免第一批请求都等待冷启动
+            backends.warm_up(self.translation_model)
+        try:
+            with usage_tracker.context(run_id=run_id, file=filename):
+                if file_extension.lower() == '.epub':
+                    self._translate_epub(filename, new_filename, new_filenametxt)
+                else:
+                    self._translate_text_file(filename, new_filename, new_filenametxt)
+        finally:
+            self.close_memory()
+            if self.previous is not None:
+                self.previous.close()
+                self.previous = None
+            self.write_report(filename, output_base + "_stats.json", time.perf_counter() - started, run_id)
+        return new_filename, new_filenametxt
+
+    def count_revision(self, section, counts):
+        with self.translated_dict_lock:
+            for name, count in counts.items():
+                self.revision[section][name] += count
+
+    def write_report(self, filename, stats_file, elapsed, run_id):
+        self.report = usage_tracker.report(self.cost_per_1k_tokens, file=filename, run_id=run_id)
+        del self.report["run_id"]
+        # 报告写好后只保留按后端汇总的计数，各章节的分组不再占用内存
+        usage_tracker.fold(run_id=run_id)
+        self.report["model"] = self.translation_model
+        self.report["elapsed_seconds"] = round(elapsed, 3)
+        self.report["failed_segments"] = self.failed_segments
+        self.report["resumed_chapters"] = self.resumed_chapters
+        reused = self.reuse["exact"] + self.reuse["normalized"] + self.reuse["fuzzy"]
+        self.report["memory_reuse"] = dict(
+            self.reuse,
+            calls_saved=reused,
+            reuse_rate=round(reused / max(1, reused + self.reuse["translated"]), 4),
+        )
+        if self.revision is not None:
+            self.report["revision"] = self.revision
+        self.report["skipped_segments"] = dict(self.skipped, calls_saved=sum(self.skipped.values()))
+        if not self.in_library:
+            # 书库中各本书同时翻译，这些计数无法分到单本书上
+            self.report.update(process_report(self.adaptive_concurrency))
+        with open(stats_file, "w", encoding="utf-8") as f:
+            json.dump(self.report, f, ensure_ascii=False, indent=4)
+
+    def translate_chapter_html(self, content, limit=None, previous=None):
+        """Translate the block elements of one (X)HTML document in place.
+
+        Headings, lists, tables, images, footnotes and classes are kept; only the
+        text is replaced. Returns a dict with the new "html", its "text" for the
+        .txt output, the "stylesheets" it links, the number of "segments" and
+        whether every segment was translated ("complete").
+
+        `previous` is the (source, translation) of this document in the previous
+        edition of the book: blocks that did not change reuse their translation.
+        """
+        from lxml import html as lxml_html
+
+        with profiler.stage("html_parse", content):
+            doc = lxml_html.document_fromstring(content, parser=lxml_html.HTMLParser(encoding="utf-8"))
+        body = doc.find("body")
+        stylesheets = doc.xpath('//link[contains(@rel, "stylesheet")]/@href')
+
+        units, hashes = [], []
+        for el in collect_epub_blocks(body if body is not None else doc):
+            segment, inline = block_to_segment(el)
+            if not segment:
+                continue
+            hashes.append(_content_hash(segment))
+            # 如果设置了译名表替换，则对文本进行翻译前的替换
+            if self.tlist:
+                segment = self.text_replace(segment)
+            # 没有行内标记的长段落按 token 预算切分
+            pieces = [segment] if inline else self.split_text(segment) or [segment]
+            units.append((el, inline, segment, pieces))
+        if limit is not None:
+            kept, total = [], 0
+            for unit in units:
+                if total >= limit:
+                    break
+                kept.append(unit)
+                total += len(unit[3])
+            units = kept
+            hashes = hashes[:len(units)]
+
+        # 修订版：与上一版相同的段落直接使用上一版的译文
+        reused = {}
+        if self.revision is not None:
+            pairs = previous_block_translations(*previous) if previous is not None else None
+            if pairs is not None:
+                matched, counts = match_units([h for h, _ in pairs], hashes)
+                reused = {j: pairs[i][1] for j, i in matched.items() if pairs[i][1] is not None}
+            else:
+                counts = {"inserted" if previous is None else "changed": len(units)}
+            self.count_revision("paragraphs", counts)
+
+        # 并发翻译，结果按原文顺序返回
+        translations = self.translate_segments(
+            [p for n, unit in enumerate(units) if n not in reused for p in unit[3]],
+            {unit[2] for unit in units if _tag(unit[0]) in _HEADING_TAGS}
+        )
+        # 翻译失败的段落返回原文（UntranslatedSegment），空字符串是正常的译文
+        failed = sum(isinstance(t, UntranslatedSegment) for t in translations)
+        complete = failed == 0
+        translations = iter(translations)
+
+        text_parts = []
+        for n, (el, inline, segment, pieces) in enumerate(units):
+            if n in reused:
+                translated_segment = reused[n]
+            else:
+                translated = [next(translations) for _ in pieces]
+                # 中文等无空格语言直接相连
+                translated_segment = translated[0]
+                for part in translated[1:]:
+                    joiner = '' if _CJK_RE.match(part) or _CJK_RE.match(translated_segment[-1:]) else ' '
+                    translated_segment += joiner + part
+            # Imprimir el original en azul y la traducción en verde
+            print("\033[34m" + segment + "\033[0m")
+            print("\033[32m" + translated_segment + "\033[0m")
+
+            source_text = ' '.join(''.join(el.itertext()).split())
+            if self.bilingual_output:
+                # 原文保留，译文以蓝色显示在同一元素内的原文之后
+                namespace = el.tag[:el.tag.index('}') + 1] if el.tag.startswith('{') else ''
+                target = el.makeelement(namespace + "span", {"style": "color: blue;"})
+                apply_translation(target, translated_segment, inline)
+                for node in list(target.iter()):
+                    if _tag(node) == "img":
+                        # 图片已在原文中出现
+                        node.drop_tree()
+                    elif isinstance(node.tag, str):
+                        node.attrib.pop("id", None)
+                el.append(el.makeelement(namespace + "br", {}))
+                el.append(target)
+            else:
+                target = el
+                apply_translation(target, translated_segment, inline)
+            translated_text = ' '.join(''.join(target.itertext()).split())
+            if self.bilingual_output:
+                text_parts.append(f"{return_text(source_text)}\n{return_text(translated_text)}\n")
+            else:
+                text_parts.append(f"{return_text(translated_text)}\n")
+
+        return {
+            "html": self.to_xhtml(doc),
+            "text": ''.join(text_parts),
+            "stylesheets": stylesheets,
+            "segments": sum(len(unit[3]) for unit in units),
+            "complete": complete,
+        }
+
+    @staticmethod
+    def to_xhtml(doc):
+        """Serialise a document parsed with the HTML parser back to XHTML"""
+        from lxml import etree
+
+        if "xmlns" not in doc.attrib:
+            doc.set("xmlns", "http://www.w3.org/1999/xhtml")
+        with profiler.stage("html_serialize"):
+            content = etree.tostring(doc, method="xml", encoding="utf-8", xml_declaration=True)
+        profiler.add_bytes("html_serialize", content)
+        return content.decode("utf-8")
+
+    def chapter_key(self, name, content):
+        """Checkpoint key of a chapter: its name plus a hash of its content, the translation options and the transliteration list"""
+        digest = hashlib.sha256(content)
+        digest.update(json.dumps([
+            "xhtml", self.translation_model, self.bilingual_output, self.tlist, self.glossary_digest,
+            self.source_language, self.target_language, self.language_code, self.prompt, self.pre_filter,
+        ], ensure_ascii=False).encode("utf-8"))
+        return f"{name}:{digest.hexdigest()}"
+
+    def translate_epub_chapter(self, name, content, limit=None):
+        """Translate one EPUB document (`name` is its path in the zip).
+
+        A finished chapter is checkpointed under chapter_key(); on a later run
+        it is restored from there without being parsed again.
+        """
+        if not content or not content.strip():
+            return None
+        key = self.chapter_key(name, content)
+        previous = None
+        if self.previous is not None:
+            previous = self.previous.chapter(name)
+            if previous is None:
+                change = "added"
+            else:
+                change = "unchanged" if previous[0] == content else "changed"
+            self.count_revision("chapters", {change: 1})
+
+        chapter = self.chapters_dict.get(key) if limit is None else None
+        if chapter is not None:
+            with self.translated_dict_lock:
+                self.resumed_chapters += 1
+        else:
+            with usage_tracker.context(chapter=name):
+                chapter = self.translate_chapter_html(content, limit, previous)
+            # 只保存完整翻译的章节，有失败段落的章节下次重新翻译
+            if limit is None and chapter["complete"]:
+                self.chapters_dict[key] = chapter
+        return chapter
+
+    def _translate_epub(self, filename, new_filename, new_filenametxt):
+        print("Converting epub to text")
+        # 译文章节写入 <epub>.parts/，最后与原书的其他文件一起打包
+        writer = EpubRewriter(filename, new_filename)
+
+        def translate_document(name, limit=None):
+            chapter = self.translate_epub_chapter(name, writer.read(name), limit)
+            if chapter is None:
+                return "", 0
+            writer.stage(name, chapter["html"].encode("utf-8"))
+            return chapter["text"], chapter["segments"]
+
+        if self.test:
+            # 测试模式只翻译前三个短文本，不保存章节检查点
+            def run_test():
+                count = 0
+                for name in writer.documents:
+                    if count >= 3:
+                        break
+                    text, segments = translate_document(name, limit=3 - count)
+                    count += segments
+                    yield text, segments
+            chapters = run_test()
+        elif self.chapter_concurrency <= 1:
+            chapters = (translate_document(name) for name in tqdm(writer.documents, desc="Chapters"))
+        else:
+            # 各章节互不依赖，可以同时翻译；executor.map 按章节顺序返回
+            executor = ThreadPoolExecutor(max_workers=self.chapter_concurrency)
+            chapters = tqdm(executor.map(usage_tracker.wrap(translate_document), writer.documents),
+                            total=len(writer.documents), desc="Chapters")
+
+        try:
+            # 每完成一个章节就按顺序写入txt文件
+            with open(new_filenametxt, "w", encoding="utf-8") as txt_file:
+                for text, _ in chapters:
+                    txt_file.write(text)
+                    txt_file.flush()
+        finally:
+            if self.chapter_concurrency > 1 and not self.test:
+                executor.shutdown()
+        # 将epub书籍写入文件
+        writer.close()
+
+    def source_segments(self, filename):
+        """Title and segments (an iterator, packed by token budget) of a PDF/TXT/DOCX/MOBI file"""
+        text = ""
+        chunks = pages = None
+        title = "Title"
+        extension = os.path.splitext(filename)[1].lower()
+
+        # 根据文件类型调用相应的函数
+        if extension == '.pdf':
+            print("Converting PDF to text")
+            # 页数、标题与页面对象只解析一次，之后的运行从 <base>_process.db 读取
+            with profiler.stage("pdf_extract"):
+                index = pdf_index(filename, self.pdf_index_dict)
+                title = get_pdf_title(filename)
+            # PDF 按页提取（可多进程，已提取的页面从缓存读取），后台线程提前解析下一页，边提取边翻译
+            pages = prefetch(iter_pdf_pages(filename, self.startpage, self.endpage,
+                                            self.pdf_workers, self.pages_dict, index=index))
+            chunks = tqdm(pages, desc="Converting PDF to text", unit="page")
+        elif extension == '.txt':
+            with profiler.stage("document_load"):
+                with open(filename, 'r', encoding='utf-8') as file:
+                    text = file.read()
+            title = os.path.basename(filename)
+        elif extension == '.docx':
+            print("Converting DOCX file to text")
+            with profiler.stage("document_load"):
+                title = get_docx_title(filename)
+                text = convert_docx_to_text(filename)
+        elif extension == '.mobi':
+            print("Converting MOBI file to text")
+            with profiler.stage("document_load"):
+                title = get_mobi_title(filename)
+                text = convert_mobi_to_text(filename)
+        else:
+            raise ValueError(f"unsupported file type: {filename}")
+
+        if chunks is None:
+            profiler.add_bytes("document_load", text)
+            chunks = [text]
+
+        def clean_chunk(chunk):
+            # PDF 的换行是版面折行，只有空行才是段落边界
+            chunk = clean_paragraphs(chunk, wrapped_lines=extension == '.pdf')
+            # 如果设置了译名表替换，则对文本进行翻译前的替换
+            if self.tlist:
+                chunk = self.text_replace(chunk)
+            return chunk
+
+        def segments():
+            try:
+                # 按 token 预算将文本流式分成短文本
+                yield from iter_segments((clean_chunk(chunk) for chunk in chunks), self.segment_tokens)
+            finally:
+                if pages is not None:
+                    # 提前结束（--test 或出错）时停止提取，取消还没开始的页面
+                    pages.close()
+
+        return title, segments()
+
+    def revised_segments(self, segments):
+        """Segments of a revised edition in which the unchanged segments of the previous edition are kept.
+
+        Their translations are copied from the previous translation memory, so
+        only new and changed text is sent to the model.
+        """
+        _, previous_segments = self.source_segments(self.previous.source)
+        segments, kept, counts = revise_segments(list(previous_segments), list(segments), self.segment_tokens)
+        pairs = []
+        for segment in dict.fromkeys(kept):
+            translation = self.previous.translations.get(segment)
+            if translation is not None:
+                pairs.append((segment, translation))
+        with self.translated_dict_lock:
+            self.translated_dict.update(pairs)
+            self.normalized_dict.update(
+                (segment_key(s), {"source": s, "translation": translation}) for s, translation in pairs
+            )
+            self.revision["reused_segments"] = len(pairs)
+        self.count_revision("paragraphs", counts)
+        return segments
+
+    def _translate_text_file(self, filename, new_filename, new_filenametxt):
+        title, source = self.source_segments(filename)
+        short_texts = source
+        if self.previous is not None:
+            short_texts = self.revised_segments(short_texts)
+        if self.test:
+            short_texts = islice(short_texts, 3)
+        # 译文边翻译边写入，epub 的章节先写入 <epub>.parts/
+        epub_writer = EpubBookWriter(new_filename, title, self.language_code)
+
+        # 所有段落共用一个线程池持续翻译，结果按原文顺序返回并立即写入txt文件
+        sources, queued = tee(short_texts)
+        translated_segments = self.iter_translate_segments(queued)
+        try:
+            with open(new_filenametxt, "w", encoding="utf-8") as txt_file:
+                # 每个段落一完成就写入，不等后面的段落
+                for short_text, translated_short_text in zip(sources, translated_segments):
+                    print(return_text(short_text))
+                    short_text = return_text(short_text)
+                    translated_short_text = return_text(translated_short_text)
+                    # 将当前短文本和翻译后的文本加入总文本中
+                    if self.bilingual_output:
+                        output = f"{short_text}\n{translated_short_text}\n"
+                    else:
+                        output = f"{translated_short_text}\n"
+                    epub_writer.write(output)
+                    txt_file.write(output)
+                    txt_file.flush()
+                    print(translated_short_text)
+        finally:
+            # 停止线程池；--test 只取前几个段落，其余页面不再提取
+            translated_segments.close()
+            source.close()
+
+        # 将翻译后的文本写入epub文件
+        print("Writing translated text to epub")
+        epub_writer.close()
+
+
+BOOK_EXTENSIONS = ('.pdf', '.epub', '.txt', '.docx', '.mobi')
+
+
+def find_books(path):
+    """Books of a library: the supported files under a directory, or the paths listed in a manifest.
+
+    A manifest is a text file with one path per line (relative to the
+    manifest); empty lines and lines starting with # are ignored.
+    """
+    if os.path.isdir(path):
+        books = []
+        for root, dirs, files in os.walk(path):
+            dirs[:] = sorted(d for d in dirs if not d.endswith(".parts"))
+            for name in sorted(files):
+                stem, extension = os.path.splitext(name)
+                # 跳过本工具自己的输出文件
+                if extension.lower() in BOOK_EXTENSIONS and not stem.endswith("_translated"):
+                    books.append(os.path.join(root, name))
+        return books
+    base = os.path.dirname(os.path.abspath(path))
+    with open(path, encoding="utf-8") as f:
+        lines = [line.strip() for line in f]
+    return [os.path.join(base, line) for line in lines if line and not line.startswith("#")]
+
+
+def process_report(adaptive_concurrency=False):
+    """Process-wide counters for a stats report: circuit breakers, API keys, backends, concurrency, streaming, parsing"""
+    report = {
+        "circuit_breakers": {b: breaker.state for b, breaker in resilience.breakers.items()},
+        "api_keys": key_scheduler.utilisation(),
+        "backends": backends.report(),
+    }
+    if adaptive_concurrency:
+        report["concurrency"] = concurrency_control.report()
+    with _stream_stats_lock:
+        report["streaming"] = dict(stream_stats)
+    with _parse_stats_lock:
+        report["parsing"] = dict(
+            parse_stats, failure_rate=round(parse_stats["failures"] / max(1, parse_stats["responses"]), 4)
+        )
+    return report
+
+
+class Library:
+    """Translate many books in one process, sharing one translation memory and one pool of backend requests"""
+
+    def __init__(self, translator, memory_path, book_concurrency=2):
+        self.translator = translator
+        translator.memory_path = memory_path
+        translator.in_library = True
+        self.memory_path = memory_path
+        self.book_concurrency = max(1, book_concurrency)
+        self.books_dict = TranslationMemory(memory_path, "books")
+        # 最近一次 translate() 的统计报告
+        self.report = None
+
+    def finished(self, book, sha256):
+        state = self.books_dict.get(os.path.abspath(book))
+        return (
+            state is not None
+            and state["status"] == "done"
+            and state["sha256"] == sha256
+            and state["failed_segments"] == 0
+            and all(os.path.exists(output) for output in state["outputs"])
+        )
+
+    def translate_book(self, book, output_base=None):
+        sha256 = file_sha256(book)
+        if self.finished(book, sha256):
+            return dict(self.books_dict[os.path.abspath(book)], book=book, skipped=True)
+        translator = self.translator.fork()
+        started = time.perf_counter()
+        try:
+            outputs = translator.translate_file(book, output_base)
+            state = {"status": "done", "sha256": sha256, "outputs": list(outputs),
+                     "failed_segments": translator.failed_segments,
+                     "total_tokens": translator.report["run"]["total_tokens"]}
+        except Exception as e:
+            # 一本书出错不影响其他书
+            state = {"status": "failed", "sha256": sha256, "outputs": [], "error": f"{type(e).__name__}: {e}",
+                     "failed_segments": None, "total_tokens": None}
+        state["elapsed_seconds"] = round(time.perf_counter() - started, 3)
+        self.books_dict[os.path.abspath(book)] = state
+        return dict(state, book=book, skipped=False)
+
+    def translate(self, books, stats_file=None):
+        """Translate the books, printing a line per finished book; returns the per-book results in order"""
+        results = {}
+        progress = tqdm(total=len(books), desc="Books", unit="book")
+        # 同一目录下同名不同格式的书（book.pdf 与 book.epub）输出到 book_pdf_translated.* 等
+        stems = {}
+        for book in books:
+            stem = os.path.splitext(os.path.abspath(book))[0]
+            stems[stem] = stems.get(stem, 0) + 1
+
+        def run(book):
+            stem, extension = os.path.splitext(os.path.abspath(book))
+            output_base = f"{stem}_{extension[1:].lower()}" if stems[stem] > 1 else None
+            result = self.translate_book(book, output_base)
+            if result["skipped"]:
+                line = f"= {book} (already translated)"
+            elif result["status"] == "done":
+                line = f"✓ {book} in {result['elapsed_seconds']} s, {result['failed_segments']} failed segments"
+            else:
+                line = f"✗ {book}: {result['error']}"
+            progress.write(line)
+            progress.update(1)
+            results[book] = result
+
+        started = time.perf_counter()
+        library_id = usage_tracker.new_run()
+        try:
+            # 所有书籍的后端请求共用 workers 个名额，每次请求尝试时占用，结束后恢复
+            with concurrency_control.share(self.translator.workers), \
+                    ThreadPoolExecutor(max_workers=self.book_concurrency) as executor, \
+                    usage_tracker.context(library_id=library_id):
+                # 工作线程沿用当前的统计标签
+                list(executor.map(usage_tracker.wrap(run), books))
+        finally:
+            progress.close()
+            self.books_dict.close()
+        ordered = [results[book] for book in books if book in results]
+        self.report = usage_tracker.report(self.translator.cost_per_1k_tokens, library_id=library_id)
+        del self.report["library_id"]
+        usage_tracker.fold(drop=("library_id",), library_id=library_id)
+        self.report["elapsed_seconds"] = round(time.perf_counter() - started, 3)
+        self.report["books"] = ordered
+        self.report.update(process_report(self.translator.adaptive_concurrency))
+        if stats_file:
+            with open(stats_file, "w", encoding="utf-8") as f:
+                json.dump(self.report, f, ensure_ascii=False, indent=4)
+        return ordered
+
+
+# 导入本模块所用的时间（不含按需导入的格式与后端库）
+import_time = time.perf_counter() - _import_started
+
+
+@contextmanager
+def profile_run(base, enabled=True, trace=False, cprofile=False):
+    """Profile the stages of the enclosed run; then write <base>_profile.json (see StageProfiler.write()) and print it"""
+    if not enabled:
+        yield
+        return
+    profiler.start(trace=trace, cprofile=cprofile)
+    try:
+        yield
+    finally:
+        profiler.stop()
+        files = profiler.write(base)
+        report = profiler.report()
+        print(f"Profile: {report['elapsed_seconds']} s wall, {report['cpu_seconds']} s CPU "
+              "(stage times are summed over threads).")
+        for name, stage in report["stages"].items():
+            print(f"  {name:<15} {stage['wall_seconds']:>9.3f} s wall {stage['cpu_seconds']:>9.3f} s CPU "
+                  f"{stage['calls']:>8} calls {stage['bytes']:>12} bytes")
+        print(f"  {'other':<15} {'':>16} {report['other_cpu_seconds']:>9.3f} s CPU")
+        print("Profile written to " + ", ".join(files))
+
+
+def main(argv=None):
+    # 创建参数解析器
+    parser = argparse.ArgumentParser()
+    parser.add_argument("filename", help="Name of the input file, or a directory / manifest of books with --library")
+    parser.add_argument("--test", help="Only translate the first 3 short texts", action="store_true")
+    # 是否使用译名表？
+    parser.add_argument("--tlist", help="Use the translated name table", action="store_true")
+    parser.add_argument("--concurrency", type=int, help="Number of segments translated at the same time (overrides settings.cfg)")
+    parser.add_argument("--batch-size", type=int, help="Number of segments sent in one request (overrides settings.cfg)")
+    parser.add_argument("--chapter-concurrency", type=int, help="Number of EPUB chapters translated at the same time (overrides settings.cfg)")
+    parser.add_argument("--pdf-workers", type=int, help="Number of processes extracting PDF text (overrides settings.cfg)")
+    parser.add_argument("--stream", action="store_true",
+                        help="Stream model output and abort off-format or runaway responses early")
+    parser.add_argument("--adaptive-concurrency", action="store_true",
+                        help="Adjust the number of requests in flight to the latency, rate limits and timeouts of "
+                             "each backend, starting at --concurrency (overrides settings.cfg)")
+    parser.add_argument("--library", action="store_true",
+                        help="Translate every book in the directory (or listed in the manifest) given as filename")
+    parser.add_argument("--book-concurrency", type=int, help="Number of books translated at the same time in --library mode (overrides settings.cfg)")
+    parser.add_argument("--previous", metavar="FILE",
+                        help="Previous edition of the book: only paragraphs changed since then are translated")
+    parser.add_argument("--previous-translation", metavar="FILE",
+                        help="Translation of the previous edition (default: its _translated.epub for EPUB, "
+                             "its _process.db for other formats)")
+    parser.add_argument("--profile", action="store_true",
+                        help="Time each stage (PDF extraction, HTML parsing, glossary, checkpoints, console, LLM) "
+                             "and write the breakdown to <base>_profile.json")
+    parser.add_argument("--profile-pstats", action="store_true",
+                        help="With --profile, also run cProfile on the main thread and write <base>_profile.pstats")
+    parser.add_argument("--profile-trace", action="store_true",
+                        help="With --profile, also write a Chrome trace of the stages to <base>_trace.json")
+    parser.add_argument("--settings", default="settings.cfg", help="Path of the settings file")
+    args = parser.parse_args(argv)
+    if args.previous_translation and not args.previous:
+        parser.error("--previous-translation requires --previous")
+    profile = dict(enabled=args.profile or args.profile_pstats or args.profile_trace,
+                   trace=args.profile_trace, cprofile=args.profile_pstats)
+
+    translator = Translator(
+        read_settings(args.settings),
+        test=args.test,
+        tlist=args.tlist,
+        concurrency=args.concurrency,
+        batch_size=args.batch_size,
+        chapter_concurrency=args.chapter_concurrency,
+        pdf_workers=args.pdf_workers,
+        stream=args.stream,
+        adaptive_concurrency=args.adaptive_concurrency,
+    )
+    if args.library or os.path.isdir(args.filename):
+        if args.previous:
+            parser.error("--previous cannot be used with --library")
+        with profile_run(library_base(args.filename), **profile):
+            main_library(translator, args)
+        return
+    with profile_run(os.path.splitext(args.filename)[0], **profile):
+        translator.translate_file(args.filename, previous=args.previous,
+                                  previous_translation=args.previous_translation)
+
+    run = translator.report["run"]
+    print(f"Translation completed. Total cost: {run['total_tokens']} tokens, ${run['cost']}.")
+    print(f"{run['requests']} requests, p50 {run['latency_ms']['p50']} ms, p95 {run['latency_ms']['p95']} ms, "
+          f"{run['tokens_per_second']} tokens/s.")
+    reuse = translator.report["memory_reuse"]
+    print(f"Translation memory: {reuse['exact']} exact, {reuse['normalized']} normalised, "
+          f"{reuse['fuzzy']} near-duplicate matches ({reuse['reuse_rate']:.0%} reused).")
+    revision = translator.report.get("revision")
+    if revision is not None:
+        paragraphs = revision["paragraphs"]
+        print(f"Compared with {revision['previous']}: {paragraphs['unchanged']} unchanged, {paragraphs['changed']} changed, "
+              f"{paragraphs['inserted']} inserted and {paragraphs['deleted']} deleted paragraphs.")
+    for key, limit in translator.report.get("concurrency", {}).items():
+        print(f"Adaptive concurrency of {key}: {limit['limit']} requests in flight (peak {limit['peak_limit']}, "
+              f"{sum(limit['decreases'].values())} back-offs, p95 {limit['p95_ms']} ms).")
+    skipped = translator.report["skipped_segments"]
+    if skipped["calls_saved"]:
+        print(f"{skipped['calls_saved']} segments needed no model call ({skipped[PASS_THROUGH]} copied as they are, "
+              f"{skipped[GLOSSARY_ONLY]} covered by the transliteration list).")
+    if translator.failed_segments:
+        print(f"{translator.failed_segments} segments could not be translated; run again to retry them.")
+
+
+def library_base(path):
+    """Base name of the shared files of a library: <dir>/library or the manifest without its extension"""
+    if os.path.isdir(path):
+        return os.path.join(path, "library")
+    return os.path.splitext(path)[0]
+
+
+def main_library(translator, args):
+    books = find_books(args.filename)
+    base = library_base(args.filename)
+    book_concurrency = args.book_concurrency or translator.settings.get("book_concurrency", 2)
+    library = Library(translator, base + "_process.db", book_concurrency)
+    results = library.translate(books, base + "_stats.json")
+
+    done = sum(1 for r in results if r["status"] == "done")
+    skipped = sum(1 for r in results if r["skipped"])
+    failed = [r["book"] for r in results if r["status"] != "done"]
+    run = library.report["run"]
+    print(f"{done} of {len(books)} books translated ({skipped} already done). "
+          f"Total cost: {run['total_tokens']} tokens, ${run['cost']}.")
+    if failed:
+        print(f"{len(failed)} books failed; run again to retry them: {', '.join(failed)}")
+
+
+if __name__ == "__main__":
+    main()